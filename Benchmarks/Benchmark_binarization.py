@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the Excess Green binarization kernel of get_binary (EasyMPE) with the
+previous float64 implementation on a synthetic field: wall time, peak memory
+of the numpy temporaries (tracemalloc) and differences between the binaries.
+
+The previous implementation needs about 40 bytes per pixel: a 20000 x 20000
+field needs 16 GB of RAM for it. Reduce 'size' if needed.
+"""
+###############################################################################
+#################################### ENV ######################################
+###############################################################################
+
+import sys, time, tracemalloc
+from pathlib import Path
+import cv2, numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'EasyMPE'))
+from EasyMPE_binarization import get_exG
+
+###############################################################################
+################################## INPUTS #####################################
+###############################################################################
+
+# size of the square synthetic field (pixels)
+size = 20000
+# ExG threshold
+thresh = 0.20
+
+###############################################################################
+################################### CODE ######################################
+###############################################################################
+
+def previous_kernel(img, thresh):
+    # get all the channels
+    r, g, b = img[:, :, 0]/255, img[:, :, 1]/255, img[:, :, 2]/255
+    # calculate the excess green image
+    exG = 2*g - r - b
+    threshold, binary = cv2.threshold(exG, thresh, 255, cv2.THRESH_BINARY)
+    return exG, binary
+
+def measure(function, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    out = function(*args)
+    duration = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return out, duration, peak
+
+# synthetic field: soil with green stripes and some noise
+rng = np.random.default_rng(0)
+img = np.empty((size, size, 3), np.uint8)
+for y in range(0, size, 1024):
+    block = rng.integers(40, 140, (min(1024, size - y), size, 3), dtype = np.uint8)
+    block[:, (np.arange(size) // 50) % 4 == 0, 1] += 100
+    img[y:y + 1024] = block
+print('Field: ' + str(size) + ' x ' + str(size) + ' px (' + str(img.nbytes // 2**20) + ' MB)')
+
+(exG_new, binary_new), t_new, peak_new = measure(get_exG, img, thresh)
+print('Fused kernel:    %.2f s, peak %d MB' % (t_new, peak_new // 2**20))
+del exG_new
+(exG_old, binary_old), t_old, peak_old = measure(previous_kernel, img, thresh)
+print('Previous kernel: %.2f s, peak %d MB' % (t_old, peak_old // 2**20))
+
+print('Speed-up: x%.1f, memory: x%.1f less' % (t_old/t_new, peak_old/peak_new))
+# pixels can only differ where ExG equals the threshold exactly (float64
+# rounding decided them before)
+print('Different pixels: ' + str(int(np.count_nonzero(binary_old.astype(np.uint8) != binary_new))))
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the profile of the columns detection of EasyMPE (column_profile :
+run starts counted on an image decimated along x, OpenCV morphology) with the
+previous skeleton of the plant rows (skimage erosion, skeletonize, erosion,
+dilation and local maxima) on synthetic fields of several orientations.
+
+For every field, both profiles go through the same threshold and
+draw_separation_lines : the number of columns found and the largest
+difference (pixels) between their limits are given with the timings.
+"""
+###############################################################################
+#################################### ENV ######################################
+###############################################################################
+
+import sys, time
+from pathlib import Path
+import cv2, numpy as np
+from skimage import morphology
+from skimage.morphology import extrema
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'EasyMPE'))
+from EasyMPE_plot_identification import (column_profile, draw_separation_lines,
+                                         estimate_angle, rotate_bound)
+
+###############################################################################
+################################## INPUTS #####################################
+###############################################################################
+
+# size of the synthetic fields (pixels) and orientations of their columns
+# (degrees)
+height, width = 3000, 4000
+angles = [0, -3, 7, 20]
+# columns and plant rows (pixels)
+column_width, column_gap = 230, 160
+plot_height, plot_gap = 130, 40
+row_thickness, row_period = 14, 32
+# number of weed spots
+weeds = 500
+# number of repetitions of each measure (best time is kept)
+repeat = 3
+
+###############################################################################
+################################### CODE ######################################
+###############################################################################
+
+def previous_profile(img_rotated):
+    binary_erode = morphology.binary_erosion(img_rotated, footprint = np.ones((1, 20)))
+    skeleton = morphology.skeletonize((binary_erode*1).astype(np.uint8))*255
+    skeleton = morphology.binary_erosion(skeleton, footprint = np.ones((1, 5)))
+    skeleton = morphology.binary_dilation(skeleton, footprint = np.ones((1, 100)))*255
+    local_maxima = extrema.local_maxima(skeleton)
+    return np.sum(local_maxima, axis = 0).astype(float)
+
+def column_limits(sum_maxima, img_rotated):
+    # same threshold as in detect_columns
+    sum_maxima = sum_maxima.copy()
+    sum_maxima_nan = sum_maxima.copy()
+    sum_maxima_nan[sum_maxima == 0] = np.nan
+    sum_maxima[sum_maxima < np.nanmean(sum_maxima_nan)/3] = 0
+    _, cut_points, _, _ = draw_separation_lines(sum_maxima, rows_img = img_rotated, col = True)
+    return np.asarray(cut_points)[:, :2, 0]
+
+def synthetic_field(angle, rng):
+    field = np.zeros((height, width), dtype = np.uint8)
+    for x in range(250, width - 250 - column_width, column_width + column_gap):
+        for y in range(250, height - 250 - plot_height, plot_height + plot_gap):
+            for yy in range(y + 10, y + plot_height - row_thickness, row_period):
+                cv2.rectangle(field, (x, yy), (x + column_width, yy + row_thickness), 1, -1)
+    for _ in range(weeds):
+        cv2.circle(field, (int(rng.integers(0, width)), int(rng.integers(0, height))), 2, 1, -1)
+    M = cv2.getRotationMatrix2D((width/2, height/2), angle, 1)
+    return cv2.warpAffine(field, M, (width, height), flags = cv2.INTER_NEAREST)
+
+def best_time(function, *args):
+    times = []
+    for k in range(repeat):
+        start = time.perf_counter()
+        out = function(*args)
+        times.append(time.perf_counter() - start)
+    return out, min(times)
+
+rng = np.random.default_rng(0)
+for angle in angles:
+    img = synthetic_field(angle, rng)
+    # straight image, as in detect_columns
+    angle_straight, _ = estimate_angle(img, 'V')
+    img_rotated, _, _ = rotate_bound(img, angle_straight, change_bigger = True)
+    old, t_old = best_time(previous_profile, img_rotated)
+    new, t_new = best_time(column_profile, img_rotated)
+    old_limits, new_limits = column_limits(old, img_rotated), column_limits(new, img_rotated)
+    print('Field at ' + str(angle) + ' degrees, straight image ' + str(img_rotated.shape))
+    print('  previous skeleton: %.3f s, column_profile: %.4f s (x%.0f)' % (t_old, t_new, t_old/t_new))
+    if len(old_limits) == len(new_limits):
+        print('  ' + str(len(new_limits)) + ' columns in both, largest difference of the limits: '
+              + str(int(np.abs(old_limits - new_limits).max())) + ' px')
+    else:
+        print('  ' + str(len(old_limits)) + ' columns before, ' + str(len(new_limits)) + ' now')
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the pruning of the pairs of plots and raw images in the reverse
+calculation (STRtree of the ground footprints of the images) on a synthetic
+field flown by a drone, and compares the results with the projection of every
+plot in every image.
+
+The synthetic PMatrices are built as Pix4D does (K [R | -R C]), the cameras
+looking down with small random tilts.
+"""
+###############################################################################
+#################################### ENV ######################################
+###############################################################################
+
+import sys, time
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'EasyMPE'))
+from EasyMPE_revCal import candidate_pairs, plots_in_images
+
+###############################################################################
+################################## INPUTS #####################################
+###############################################################################
+
+# plots of the field (columns x rows) and their size (m)
+columns, rows = 60, 50
+plot_width, plot_length = 1.5, 3.
+# flight grid (images along and across the field) and height (m)
+images_x, images_y = 40, 20
+flight_height = 30.
+# raw images size (pixels) and focal length (pixels)
+image_width, image_height, focal = 4000, 3000, 3600.
+# standard deviation of the tilts of the camera (radians)
+tilt = 0.05
+
+###############################################################################
+################################### CODE ######################################
+###############################################################################
+
+def rotation(axis, angle):
+    c, s = np.cos(angle), np.sin(angle)
+    R = np.eye(3)
+    i, j = [k for k in range(3) if k != axis]
+    R[i, i], R[i, j], R[j, i], R[j, j] = c, -s, s, c
+    return R
+
+rng = np.random.default_rng(0)
+# plots corners, 0.2 m between plots, ground height of 0 to 0.5 m
+x0, y0 = np.meshgrid(np.arange(columns)*(plot_width + 0.2), np.arange(rows)*(plot_length + 0.2), indexing = 'ij')
+x0, y0 = x0.ravel(), y0.ravel()
+corners = np.ones((len(x0), 4, 4))
+corners[:, :, 0] = x0[:, None] + [0, plot_width, plot_width, 0]
+corners[:, :, 1] = y0[:, None] + [0, 0, plot_length, plot_length]
+corners[:, :, 2] = rng.uniform(0, 0.5, len(x0))[:, None]
+# cameras above the field
+K = np.array([[focal, 0, image_width/2], [0, focal, image_height/2], [0, 0, 1]])
+field_x, field_y = corners[:, :, 0].max(), corners[:, :, 1].max()
+pmatrices = []
+for cx in np.linspace(0, field_x, images_x):
+    for cy in np.linspace(0, field_y, images_y):
+        center = np.array([cx, cy, flight_height]) + rng.normal(0, 0.5, 3)
+        R = rotation(0, rng.normal(0, tilt)) @ rotation(1, rng.normal(0, tilt)) \
+            @ rotation(2, rng.uniform(-np.pi, np.pi)) @ np.diag([1., -1., -1.])
+        pmatrices.append(K @ np.hstack((R, (-R @ center)[:, None])))
+pmatrices = np.array(pmatrices)
+width = np.full(len(pmatrices), image_width)
+height = np.full(len(pmatrices), image_height)
+print(str(len(corners)) + ' plots, ' + str(len(pmatrices)) + ' raw images')
+
+start = time.perf_counter()
+plots, images = candidate_pairs(corners, pmatrices, width, height)
+t_pairs = time.perf_counter() - start
+print('Pairs tested: %d of %d (%.1f %%, footprints and STRtree: %.2f s)'
+      % (len(plots), len(corners)*len(pmatrices), 100*len(plots)/(len(corners)*len(pmatrices)), t_pairs))
+
+start = time.perf_counter()
+old = plots_in_images(corners, pmatrices, width, height, prune = False)
+t_old = time.perf_counter() - start
+start = time.perf_counter()
+new = plots_in_images(corners, pmatrices, width, height)
+t_new = time.perf_counter() - start
+print('Reverse calculation - every pair: %.2f s, pruned: %.2f s (x%.1f)' % (t_old, t_new, t_old/t_new))
+print('Plots found in images: %d, same results: %s'
+      % (len(new[0]), all(np.array_equal(a, b) for a, b in zip(old, new))))
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the segmentation of the projection profiles (draw_separation_lines)
+and the rotation of the cut points (rotate) of EasyMPE with their previous
+Python loops, on the long profile of a wide synthetic field.
+
+Only the loops of the previous implementation are timed (search of the
+start/end transitions and point by point rotation), the new timings include
+the whole functions.
+
+The corners of the plots of a field aligned with the image (vertical columns
+and horizontal rows, angle of exactly 0 degree) are also checked.
+"""
+###############################################################################
+#################################### ENV ######################################
+###############################################################################
+
+import sys, math, time
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'EasyMPE'))
+from EasyMPE_plot_identification import draw_separation_lines, rotate
+from EasyMPE_geometry import get_equations, band_corners, plot_corners
+
+###############################################################################
+################################## INPUTS #####################################
+###############################################################################
+
+# length of the profile (width of the rotated field, pixels)
+length = 500000
+# width of the columns and of the gaps between them (pixels)
+column_width = 300
+gap_width = 60
+# number of repetitions of each measure (best time is kept)
+repeat = 5
+
+###############################################################################
+################################### CODE ######################################
+###############################################################################
+
+def previous_transitions(img):
+    start, end = [], []
+    for i in range(len(img) - 1):
+        if img[i] == 0 and img[i+1] != 0:
+            start.append(i)
+        elif img[i] != 0 and img[i+1] == 0:
+            end.append(i)
+    return start, end
+
+def previous_rotate(origin, points, angle):
+    oy, ox = origin
+    for column in range(len(points)):
+        for point in range(len(points[column])):
+            px, py = points[column][point]
+            qx = ox + math.cos(angle) * (px - ox) - math.sin(angle) * (py - oy)
+            qy = oy + math.sin(angle) * (px - ox) + math.cos(angle) * (py - oy)
+            points[column][point] = int(qx), int(qy)
+    return points
+
+def best_time(function, *args):
+    times = []
+    for k in range(repeat):
+        start = time.perf_counter()
+        out = function(*args)
+        times.append(time.perf_counter() - start)
+    return out, min(times)
+
+# synthetic profile: columns of random sums separated by empty gaps
+rng = np.random.default_rng(0)
+period = column_width + gap_width
+profile = rng.integers(1, 500, length).astype(float)
+profile[(np.arange(length) % period) >= column_width] = 0
+rows_img = np.zeros((8, length), dtype = np.uint8)
+print('Profile: ' + str(length) + ' px, ' + str(length // period) + ' columns')
+
+_, t_old = best_time(previous_transitions, profile)
+(_, cut_points, _), t_new = best_time(draw_separation_lines, profile, rows_img)
+print('Segmentation - previous loop: %.3f s, vectorized: %.4f s (x%.0f)' % (t_old, t_new, t_old/t_new))
+
+center, angle = (length/2, length/2), math.radians(7.)
+old_points = [[tuple(p) for p in points] for points in cut_points.tolist()]
+old_rotated, t_old = best_time(lambda: previous_rotate(center, [list(p) for p in old_points], angle))
+new_rotated, t_new = best_time(lambda: rotate(center, cut_points.copy(), angle))
+print('Rotation - previous loop: %.4f s, vectorized: %.5f s (x%.0f)' % (t_old, t_new, t_old/t_new))
+print('Same points: ' + str(np.array_equal(np.array(old_rotated), new_rotated)))
+
+# field aligned with the image : columns x in [100, 200] and [300, 400], rows
+# y in [50, 80] and [120, 150]
+columns_a, columns_b = get_equations(np.array([[[100, 0], [100, 500], [200, 0], [200, 500]],
+                                               [[300, 0], [300, 500], [400, 0], [400, 500]]]))
+rows_a, rows_b = get_equations(np.array([[[0, 50], [500, 50], [0, 80], [500, 80]],
+                                         [[0, 120], [500, 120], [0, 150], [500, 150]]]))
+pairs = np.array([[0, 0], [1, 1]])
+columns_corners, rows_corners = band_corners(columns_a, columns_b, pairs, 500), band_corners(rows_a, rows_b, pairs, 500)
+col, row = np.repeat([0, 1], 2), np.tile([0, 1], 2)
+points, _, valid = plot_corners(columns_a[col], columns_a[col], columns_b[col], columns_b[col],
+                                rows_a[row], rows_a[row], rows_b[row], rows_b[row], 0, 0, 0)
+# pt4, pt3, pt2, pt1 with the y axis going up
+expected = np.array([[[x0, -y1], [x1, -y1], [x1, -y0], [x0, -y0]] for x0, x1 in ((100, 200), (300, 400))
+                     for y0, y1 in ((50, 80), (120, 150))], dtype = float)
+print('Aligned field - column bands: ' + str(columns_corners[:, :, 0].tolist())
+      + ', row bands: ' + str(rows_corners[:, :, 1].tolist()))
+print('Aligned field - all plots found: ' + str(bool(valid.all())) + ', right corners: '
+      + str(bool(np.array_equal(np.sort(points, axis = 1), np.sort(expected, axis = 1)))))
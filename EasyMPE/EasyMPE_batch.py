@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+2019, L. Tresch for University of Tokyo, Field Phenomics Research Laboratory
+Please read the read_me.txt for furter information.
+Annex code to MPE_main.py
+
+Headless version of the GUI: runs the field cropping, the binarization, the
+plot identification and (if the Pix4D inputs are given) the reverse calculation
+for every field listed in a manifest, several fields at the same time.
+
+Usage :
+    python EasyMPE_batch.py manifest.csv [--workers 4] [--summary summary.csv]
+                            [--min-confidence 0.5] [--no-cache]
+
+The manifest is a csv (or a json list of objects) with one field per line and
+the following columns (only 'image' and 'field' are mandatory) :
+    image : path to the field image (orthomosaic or binary)
+    field : path to a polygon file (*.geojson, *.shp, *.gpkg) in the image CRS,
+        or the corners in image pixels written as 'x1 y1; x2 y2; x3 y3; ...'
+    threshold : ExG threshold, 1.00 for automatic (Otsu) [0.20]
+    noise : minimum feature size for noise removal in pixels [200]
+    rows_per_plot : number of plant rows per plot [1]
+    columns_per_plot : number of ranges per plot [1]
+    orientation : global orientation of the ranges, 'H' or 'V' [H]
+    binary : 'yes' if the image is already a binary [no]
+    save_columns : 'no' to skip the export of the Plot_columns_* folders [yes]
+    save_whole : 'yes' to also save every plot on an image of the size of the
+        field (Plot_rows_original_whole folder) [no]
+    vector_format : format of the file with all the plots, 'GPKG' or
+        'FlatGeobuf' [GPKG]
+    shp : 'yes' to also save the plots in All_plots.shp and in one *.shp per
+        plot (SHP_files folder) [no]
+    pix4d : Pix4D project folder, for the reverse calculation []
+    raw_images : raw drone images folder, for the reverse calculation []
+    top_views : number of best raw images of every plot written in
+        reverse_cal_best_views.csv [3]
+    output : output folder [Micro_plots_<image name> next to the image]
+Relative paths are relative to the manifest folder.
+Fields whose estimated angle has a confidence below --min-confidence are
+flagged in the message column of the summary. A field whose process dies (out
+of memory...) is run again alone, and reported as an error if it dies again :
+the summary always has one line per field of the manifest.
+Every stage of a field (crop, binary, angle, columns, rows, plots) is cached in
+the Stage_cache folder of its output (see EasyMPE_cache.py) : running the
+manifest again only computes the stages whose inputs changed, and a field which
+stopped midway starts again from its last finished stage. --no-cache computes
+everything again.
+"""
+###############################################################################
+##################################### ENV #####################################
+###############################################################################
+
+import argparse, csv, json, os, re, sys, time, traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import fiona
+from EasyMPE_plot_identification import MPE
+from EasyMPE_revCal import ReverseCalculation
+from EasyMPE_binarization import get_drawn_image, binarize, cut_field, save_binary
+from EasyMPE_raster import FieldRaster
+from EasyMPE_cache import (StageCache, CACHE_FOLDER, clear_outputs, stage_key,
+        field_crop_key, run_stage)
+
+###############################################################################
+################################## FUNCTIONS ##################################
+###############################################################################
+
+# default values of the optional manifest columns (same as the GUI)
+DEFAULTS = {'threshold': 0.20, 'noise': 200, 'rows_per_plot': 1,
+            'columns_per_plot': 1, 'orientation': 'H', 'binary': 'no',
+            'save_columns': 'yes', 'save_whole': 'no', 'vector_format': 'GPKG', 'shp': 'no',
+            'pix4d': '', 'raw_images': '', 'top_views': 3, 'output': ''}
+# messages corresponding to the MPE return values
+MPE_STATUS = {'1': 'no range detected', '2': 'no row detected', '3': 'cancelled', 'OK': 'OK'}
+# columns of the summary file
+SUMMARY_HEADER = ['image', 'field', 'output', 'status', 'angle',
+                  'angle_confidence', 'crop_s', 'binary_s', 'mpe_s',
+                  'revcal_s', 'total_s', 'message']
+# below this confidence, the angle of a field is flagged as suspicious
+MIN_ANGLE_CONFIDENCE = 0.5
+
+def read_manifest(manifest):
+    """ Read the manifest and complete every job with the default values
+
+    Input : 1
+        manifest : Path
+            absolute path to the *.csv or *.json manifest
+
+    Output : 1
+        jobs : list of dict
+            one dict per field, with all the columns listed in DEFAULTS
+    """
+    if manifest.suffix.lower() == '.json':
+        with open(manifest) as f:
+            rows = json.load(f)
+    else:
+        with open(manifest, newline = '') as f:
+            rows = list(csv.DictReader(f))
+    jobs, used_outputs = [], {}
+    for nb, row in enumerate(rows):
+        # empty cells take the default value
+        job = dict(DEFAULTS)
+        job.update({k.strip(): v for k, v in row.items() if k and str(v).strip() != ''})
+        if 'image' not in job or 'field' not in job:
+            raise ValueError('Line ' + str(nb + 1) + ' of the manifest needs an image and a field.')
+        job['image'] = resolve(manifest, job['image'])
+        for key in ('pix4d', 'raw_images', 'output'):
+            job[key] = resolve(manifest, job[key]) if job[key] != '' else None
+        if not is_pixel_field(job['field']):
+            job['field'] = resolve(manifest, job['field'])
+        # same default output folder as the GUI; a number is added if the same
+        # image is used for several fields
+        if job['output'] is None:
+            job['output'] = job['image'].parent / str('Micro_plots_' + job['image'].stem)
+        if job['output'] in used_outputs:
+            used_outputs[job['output']] += 1
+            job['output'] = job['output'].parent / str(job['output'].name + '_' + str(used_outputs[job['output']]))
+        used_outputs[job['output']] = 0
+        job['threshold'] = float(job['threshold'])
+        job['noise'] = int(job['noise'])
+        job['rows_per_plot'] = int(job['rows_per_plot'])
+        job['columns_per_plot'] = int(job['columns_per_plot'])
+        job['top_views'] = int(job['top_views'])
+        job['orientation'] = str(job['orientation']).strip().upper()[0]
+        job['binary'] = str(job['binary']).strip().lower() in ('1', 'yes', 'y', 'true')
+        job['save_columns'] = str(job['save_columns']).strip().lower() in ('1', 'yes', 'y', 'true')
+        job['save_whole'] = str(job['save_whole']).strip().lower() in ('1', 'yes', 'y', 'true')
+        job['shp'] = str(job['shp']).strip().lower() in ('1', 'yes', 'y', 'true')
+        job['vector_format'] = {'gpkg': 'GPKG', 'flatgeobuf': 'FlatGeobuf', 'fgb': 'FlatGeobuf'}.get(
+                str(job['vector_format']).strip().lower(), job['vector_format'])
+        jobs.append(job)
+    return jobs
+
+def resolve(manifest, path):
+    """ Make a path of the manifest absolute (relative to the manifest folder)"""
+    path = Path(str(path).strip()).expanduser()
+    if not path.is_absolute():
+        path = manifest.parent / path
+    return path
+
+def is_pixel_field(field):
+    """ True if the field is given as pixel coordinates ('x1 y1; x2 y2; ...')"""
+    return isinstance(field, str) and re.fullmatch(r'[\d\s.,;+-]+', field) is not None
+
+def get_field_coord(field, transform, georeferenced):
+    """ Get the field corners in pixels of the field image
+
+    Inputs : 3
+        field : str or Path
+            pixel coordinates as 'x1 y1; x2 y2; ...' or path to a polygon file
+        transform : Affine object
+            affine transformation of the field image
+        georeferenced : bolean
+            True if the field image has a CRS (polygon files are then in this
+            CRS), otherwise polygon files are read as pixel coordinates
+
+    Output : 1
+        coord : list of tuples
+            field corners (x, y) in pixels, as clicked in the GUI
+    """
+    if is_pixel_field(field):
+        coord = [tuple(float(v) for v in pt.replace(',', ' ').split()) for pt in field.split(';') if pt.strip()]
+    else:
+        # first polygon of the file, without the closing point
+        with fiona.open(str(field)) as src:
+            geometry = next(iter(src))['geometry']
+        rings = geometry['coordinates'] if geometry['type'] == 'Polygon' else geometry['coordinates'][0]
+        coord = [tuple(pt[:2]) for pt in rings[0][:-1]]
+        if georeferenced:
+            coord = [~transform * pt for pt in coord]
+    return [(int(x), int(y)) for x, y in coord]
+
+def run_field(job):
+    """ Run the whole micro-plot extraction for one field, as the GUI does
+
+    Input : 1
+        job : dict
+            one line of the manifest (see read_manifest), with the number of
+            threads of the field ('threads', all the cores if missing)
+
+    Output : 1
+        summary : dict
+            status, timing (s) of each step and error message of the field,
+            organized as SUMMARY_HEADER
+    """
+    summary = new_summary(job)
+    start = time.perf_counter()
+    try:
+        ## field cropping
+        t = time.perf_counter()
+        with FieldRaster(job['image']) as field_raster:
+            aff = field_raster.transform
+            crs = field_raster.crs
+            coord = get_field_coord(job['field'], aff, crs is not None)
+            if len(coord) < 3:
+                raise ValueError('The field must have at least 3 corners.')
+            # make a repository ; the outputs of a previous run are erased,
+            # not its cache
+            main_folder = job['output']
+            clear_outputs(main_folder)
+            main_folder.mkdir(parents = True, exist_ok = True)
+            cache = StageCache(main_folder / CACHE_FOLDER) if job.get('cache', True) else None
+            crop_key = field_crop_key(cache, job['image'], coord)
+            crop = run_stage(cache, crop_key, lambda: dict(zip(('img', 'y_window', 'x_window'),
+                                                   get_drawn_image(field_raster, coord, 1))))
+            img, y_window, x_window = crop['img'], int(crop['y_window']), int(crop['x_window'])
+        summary['crop_s'] = round(time.perf_counter() - t, 3)
+
+        ## binarization
+        t = time.perf_counter()
+        YN_binary = job['binary'] or img.ndim == 2
+        binary_key = stage_key(cache, 'binary', crop_key, YN_binary, job['noise'], job['threshold'])
+        binary = run_stage(cache, binary_key, lambda: binarize(img, YN_binary, job['noise'],
+                                                                 job['threshold'], main_folder,
+                                                                 job.get('threads')),
+                           restore = lambda binary: save_binary(binary, img, YN_binary, main_folder))
+        img, img_binary = cut_field(img, binary, YN_binary), binary['img_binary']
+        y0, x0 = int(binary['y0']), int(binary['x0'])
+        # the ExG image is not needed anymore
+        del binary
+        summary['binary_s'] = round(time.perf_counter() - t, 3)
+
+        ## plot identification
+        t = time.perf_counter()
+        stats = {}
+        output = MPE(img_binary, main_folder, img, YN_binary,
+                     job['rows_per_plot'], job['columns_per_plot'],
+                     job['orientation'], job['noise'], job['image'],
+                     aff if crs is not None else 0, y0 + y_window, x0 + x_window,
+                     stats = stats, save_columns = job['save_columns'],
+                     save_whole = job['save_whole'], crs = crs,
+                     vector_format = job['vector_format'], legacy_shp = job['shp'],
+                     plot_shp = job['shp'], cache = cache, binary_key = binary_key,
+                     workers = job.get('threads'))
+        summary['mpe_s'] = round(time.perf_counter() - t, 3)
+        summary['status'] = MPE_STATUS[output]
+        summary['angle'] = round(stats['angle'], 3)
+        summary['angle_confidence'] = round(stats['angle_confidence'], 3)
+        if stats['angle_confidence'] < job.get('min_confidence', MIN_ANGLE_CONFIDENCE):
+            summary['message'] = 'Suspicious angle, check the orientation of the plots.'
+
+        ## reverse calculation
+        if output == 'OK' and job['pix4d'] is not None and job['raw_images'] is not None:
+            if crs is None:
+                summary['message'] = ' '.join((summary['message'], 'The field image is not georeferenced: no reverse calculation.')).strip()
+            else:
+                t = time.perf_counter()
+                ReverseCalculation(main_folder, job['pix4d'], job['raw_images'], job['top_views'])
+                summary['revcal_s'] = round(time.perf_counter() - t, 3)
+    except Exception as e:
+        summary['status'] = 'error'
+        summary['message'] = repr(e)
+        traceback.print_exc()
+    summary['total_s'] = round(time.perf_counter() - start, 3)
+    return summary
+
+def new_summary(job, status = '', message = ''):
+    """ Summary of a field (see run_field) before any step"""
+    return {'image': str(job['image']), 'field': str(job['field']),
+            'output': str(job['output']), 'status': status, 'angle': '',
+            'angle_confidence': '', 'crop_s': '',
+            'binary_s': '', 'mpe_s': '', 'revcal_s': '', 'total_s': '',
+            'message': message}
+
+def run_batch(jobs, workers, summary_file):
+    """ Run all the jobs on a pool of 'workers' processes and write the
+    summary file as the fields are finished (in the manifest order). \n
+    If a process dies (out of memory, crash in a library), the pool is
+    broken : the fields which were running or queued are run again one by
+    one, each in its own process, and a field whose process dies again is
+    reported as an error. Every field of the manifest gets a summary.
+
+    Inputs : 3
+        jobs : list of dict
+            fields to process (see read_manifest)
+        workers : int
+            maximum number of fields processed at the same time
+        summary_file : Path
+            absolute path to the summary *.csv
+
+    Output : 1
+        summaries : list of dict
+            summary of every field, in the manifest order
+    """
+    # the cores are shared between the fields processed at the same time
+    threads = max(1, (os.cpu_count() or 1) // max(1, min(workers, len(jobs))))
+    summaries = [None]*len(jobs)
+    def field_done(nb, summary):
+        summaries[nb] = summary
+        print('[' + str(sum(s is not None for s in summaries)) + '/' + str(len(jobs)) + '] '
+              + summary['output'] + ': ' + summary['status']
+              + ' (' + str(summary['total_s']) + ' s)')
+        write_summary(summary_file, [s for s in summaries if s is not None])
+    crashed = []
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        futures = {pool.submit(run_field, dict(job, threads = threads)): nb for nb, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            nb = futures[future]
+            try:
+                summary = future.result()
+            except BrokenProcessPool:
+                crashed.append(nb)
+                continue
+            except Exception as e:
+                summary = new_summary(jobs[nb], 'error', repr(e))
+            field_done(nb, summary)
+    # fields of a broken pool, alone with all the cores
+    for nb in sorted(crashed):
+        with ProcessPoolExecutor(max_workers = 1) as pool:
+            try:
+                summary = pool.submit(run_field, dict(jobs[nb], threads = os.cpu_count() or 1)).result()
+            except Exception as e:
+                summary = new_summary(jobs[nb], 'error', 'The process of the field died: ' + repr(e))
+        field_done(nb, summary)
+    return summaries
+
+def write_summary(summary_file, summaries):
+    """ Save the per-field status and timings in a csv file"""
+    with open(summary_file, 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = SUMMARY_HEADER)
+        writer.writeheader()
+        writer.writerows(summaries)
+
+def main(argv = None):
+    """ Console entry point, see the usage at the top of the file"""
+    parser = argparse.ArgumentParser(description = 'Run EasyMPE on all the fields of a manifest.')
+    parser.add_argument('manifest', type = Path, help = 'csv or json manifest, one field per line')
+    parser.add_argument('--workers', type = int, default = min(4, os.cpu_count() or 1),
+                        help = 'number of fields processed at the same time (default: %(default)s)')
+    parser.add_argument('--summary', type = Path, default = None,
+                        help = 'status/timing summary csv (default: <manifest>_summary.csv)')
+    parser.add_argument('--min-confidence', type = float, default = MIN_ANGLE_CONFIDENCE,
+                        help = 'flag the fields whose angle confidence is lower (default: %(default)s)')
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = 'compute all the stages again instead of reading them from the cache')
+    args = parser.parse_args(argv)
+
+    manifest = args.manifest.resolve()
+    summary_file = args.summary or manifest.parent / str(manifest.stem + '_summary.csv')
+    jobs = read_manifest(manifest)
+    for job in jobs:
+        job['min_confidence'] = args.min_confidence
+        job['cache'] = not args.no_cache
+    summaries = run_batch(jobs, max(1, args.workers), summary_file)
+    print('Summary saved at: ' + str(summary_file))
+    # non-zero exit code if any field failed
+    return int(any(s['status'] != 'OK' for s in summaries))
+
+###############################################################################
+##################################### MAIN ####################################
+###############################################################################
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""
+2019, L. Tresch for University of Tokyo, Field Phenomics Research Laboratory
+Please read the read_me.txt for furter information.
+Annex code to MPE_main.py
+
+Field cropping and binarization, shared by the GUI and the batch mode.
+The binarization works on horizontal strips of the field processed in
+parallel ; the results are identical to a processing of the whole image.
+"""
+###############################################################################
+##################################### ENV #####################################
+###############################################################################
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2, numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+###############################################################################
+################################## FUNCTIONS ##################################
+###############################################################################
+
+def get_drawn_image(field_raster, coord, coeff):
+    """ Used in class 'MainWindow' in function 'drawField_clicked' and in
+    EasyMPE_batch.py
+    Make a mask out of inputted coordinates and apply it on the image. Only
+    the bounding window of the field is read.
+    
+    Inputs : 3
+        field_raster : FieldRaster object
+            the field image on which points were drawn
+        coord : list
+            the selected points coordinates
+        coeff : int
+            the coefficient used to resize the image for it to fit the 
+            screen resolution
+                
+    Output : 3
+        masked_image : list of list 
+            cut out image according to the inputted points, limited to the
+            bounding window of the points
+        y_window, x_window : int
+            position of the window in the field image (top and left pixels
+            not read)
+        """
+    roi_corners = []
+    # get the right synthax for the array
+    for k in coord:
+        roi_corners.append((int(k[0]/coeff), int(k[1]/coeff)))
+    roi_corners = np.array([roi_corners], dtype = np.int32)
+    # read the region to keep and apply the mask
+    masked_image, y_window, x_window = field_raster.read_field(roi_corners)
+    return masked_image, y_window, x_window
+
+def get_binary(img, noise, thresh, workers = None):
+    """ Make a binarization of a RGB image using the ExGreen index and remove
+    noise as indicated.
+    
+    Inputs : 4
+        img : list of list
+            image to binarize, already read
+        noise : int
+            smaller blobs than this int will be removed
+        thresh : float
+            ExG threshold, Otsu's threshold is used if it is bigger than 0.999
+        workers : int or None
+            number of threads (all the cores if None)
+    
+    Outputs : 2
+        exG : list of list
+            excess green index of the original image (float32 in [-2, 2] 
+            with a set threshold, uint8 in [0, 255] with Otsu)
+        binary : list of list
+            binary version of the original image, based on ExG index (uint8)
+    """
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        strips = get_strips(img.shape[0], workers)
+        # get binary using Otsu if set threshold value is 0, otherwise use set value
+        if  thresh > 0.999:
+            # calculate the excess green image
+            exG, _ = get_exG(img, None, strips, pool)
+            # Floodfill from point (0, 0) aka get black background
+            flood_fill(exG, strips, pool)
+            ## apply Otsu threshold, computed on the histogram of all strips
+            blur = [None]*len(strips)
+            def blur_strip(k):
+                y0, y1 = strips[k]
+                # one more row on each side so that the blur is the same as
+                # on the whole image
+                top, bottom = max(y0 - 1, 0), min(y1 + 1, exG.shape[0])
+                blur[k] = cv2.GaussianBlur(exG[top:bottom], (3, 3), 0)[y0 - top:y1 - top]
+                return np.bincount(blur[k].ravel(), minlength = 256)
+            hist = sum(pool.map(blur_strip, range(len(strips))))
+            threshold = otsu_threshold(hist)
+            # get the negative image (plant in white)
+            binary = np.empty(exG.shape, np.uint8)
+            def threshold_strip(k):
+                y0, y1 = strips[k]
+                binary[y0:y1] = (blur[k] <= threshold)*np.uint8(255)
+            list(pool.map(threshold_strip, range(len(strips))))
+            del blur
+        else:
+            # calculate the excess green image and threshold it in the same pass
+            exG, binary = get_exG(img, thresh, strips, pool)
+        
+        # remove noise
+        binary = remove_noise(binary, noise, workers, strips, pool)
+    return(exG, binary)
+
+def preview_image(img, size):
+    """ Used in class 'MainWindow' in function 'getBinary_clicked'
+    Level of the image pyramid (size divided by a power of 2) which fits in
+    'size', to try the binarization thresholds at the scale of the screen.
+    ExG being linear in the channels, the ExG of the averaged pixels is the
+    average of the ExG of the full resolution pixels.
+    
+    Inputs : 2
+        img : list of list
+            field image (see get_drawn_image)
+        size : int
+            maximum height and width of the preview
+    
+    Outputs : 2
+        preview : list of list
+            reduced image
+        scale : int
+            reduction of the image (1 if it already fits)
+    """
+    h, w = img.shape[:2]
+    scale = 1
+    while max(h, w) > size*scale:
+        scale *= 2
+    if scale == 1:
+        return img, 1
+    preview = cv2.resize(img, (-(-w//scale), -(-h//scale)), interpolation = cv2.INTER_AREA)
+    return preview, scale
+
+def preview_noise(noise, scale):
+    """ Noise removal value (area in pixels) at the scale of a preview"""
+    return max(1, int(round(noise/scale**2)))
+
+def binarize(img, YN_binary, noise, threshold, folder, workers = None):
+    """ Used in class 'MainWindow' in function 'getBinary_clicked' and in
+    EasyMPE_batch.py
+    Binarize the field image, cut the useless black pixels and save the
+    images in 'folder'
+
+    Inputs : 6
+        img : list of list
+            field image (see get_drawn_image)
+        YN_binary : bolean
+            True if the field image is already a binary
+        noise : int
+            noise removal value
+        threshold : float
+            ExG threshold, 1.00 for automatic (Otsu)
+        folder : Path
+            output folder of the field
+        workers : int or None
+            number of threads (all the cores if None)
+
+    Output : 1
+        binary : dict
+            binary image ('img_binary'), ExG image ('img_exG', if the field
+            image is not a binary) and the cut window ('y0', 'x0', 'y1',
+            'x1') ; the cut field image is not kept, see cut_field
+    """
+    if YN_binary:
+        if img.ndim == 3:
+            img = img[:, :, 0]
+        # get rid of the useless black pixels
+        y0, x0, y1, x1 = nonzero_window(img)
+        # apply the noise removal
+        binary = {'img_binary': remove_noise(img[y0:y1, x0:x1], noise, workers)}
+    else:
+        y0, x0, y1, x1 = nonzero_window(img)
+        img_exG, img_binary = get_binary(img, noise, threshold, workers)
+        # cut all images according to avoid useless black pixels
+        binary = {'img_binary': img_binary[y0:y1, x0:x1], 'img_exG': img_exG[y0:y1, x0:x1]}
+    binary.update(y0 = y0, x0 = x0, y1 = y1, x1 = x1)
+    save_binary(binary, img, YN_binary, folder)
+    return binary
+
+def nonzero_window(img):
+    """ Bounding window (y0, x0, y1, x1) of the non black pixels of an 8 bits
+    image. The channels are seen as more columns of a one channel image, so
+    that cv2.boundingRect reads the image without making any copy of it"""
+    h, w = img.shape[:2]
+    channels = img.size // max(1, h*w)
+    x, y, width, height = cv2.boundingRect(np.ascontiguousarray(img).reshape(h, w*channels))
+    return y, x // channels, y + height, -(-(x + width) // channels)
+
+def cut_field(img, binary, YN_binary):
+    """ Cut the field image as binarize did (useless black pixels removed,
+    one channel if it is a binary)"""
+    if YN_binary and img.ndim == 3:
+        img = img[:, :, 0]
+    return img[int(binary['y0']):int(binary['y1']), int(binary['x0']):int(binary['x1'])]
+
+def save_binary(binary, img, YN_binary, folder):
+    """ Used in binarize, and to write the images again when the binary is
+    read from the cache (see run_stage)
+    Save the binary image if the field image is a binary, otherwise the ExG
+    image and the cut field image, in 'folder'"""
+    if YN_binary:
+        cv2.imwrite(str(folder / 'Binary_image.tiff'), binary['img_binary'])
+    else:
+        cv2.imwrite(str(folder / 'ExcessGreen.tiff'), binary['img_exG'])
+        cv2.imwrite(str(folder / 'Field_area.tiff'), cut_field(img, binary, YN_binary))
+
+def get_exG(img, thresh, strips = None, pool = None):
+    """ Fused Excess Green (2*g - r - b) and threshold kernel. \n
+    The image is processed by strips of rows with 16 bits integers, so that
+    only the outputs are allocated at the size of the image.
+    
+    Inputs : 4
+        img : list of list
+            8 bits image to binarize (BGR or BGRA, ExG is symmetric in r and b)
+        thresh : float or None
+            ExG threshold (ExG in [-2, 2]) ; if None, no binary is made and 
+            ExG is returned in 8 bits for Otsu's method
+        strips : list of tuples or None
+            (first row, last row + 1) of every strip, see get_strips
+        pool : Executor or None
+            pool processing the strips in parallel (strips are processed one
+            after the other if None)
+    
+    Outputs : 2
+        exG : list of list
+            float32 ExG (2*g - r - b)/255 if a threshold is given, otherwise
+            2*g - r - b clipped to [0, 255] in uint8
+        binary : list of list or None
+            uint8 image, 255 where ExG > thresh
+    """
+    h, w = img.shape[:2]
+    if strips is None:
+        strips = [(y, min(y + 1024, h)) for y in range(0, h, 1024)]
+    if thresh is None:
+        exG, binary = np.empty((h, w), np.uint8), None
+    else:
+        exG, binary = np.empty((h, w), np.float32), np.empty((h, w), np.uint8)
+        # binary value of every possible integer 2*g - r - b (-510 to 510) ;
+        # the comparison is exact, pixels equal to the threshold are black
+        lut = np.where(np.arange(-510, 511)/255 > thresh, 255, 0).astype(np.uint8)
+    def exG_strip(strip):
+        y0, y1 = strip
+        # 1024 rows at most at the same time
+        for y in range(y0, y1, 1024):
+            block = img[y:min(y + 1024, y1)]
+            # 2*g - r - b in 16 bits, no wrap around
+            exG_int = 2*block[:, :, 1].astype(np.int16) - block[:, :, 0] - block[:, :, 2]
+            if thresh is None:
+                exG[y:y + len(block)] = np.clip(exG_int, 0, 255, out = exG_int)
+            else:
+                np.divide(exG_int, np.float32(255), out = exG[y:y + len(block)])
+                np.take(lut, exG_int + 510, out = binary[y:y + len(block)])
+    list(map(exG_strip, strips) if pool is None else pool.map(exG_strip, strips))
+    return exG, binary
+
+def remove_noise(binary, noise, workers = None, strips = None, pool = None):
+    """ Remove the white blobs (4-connected) smaller than 'noise' pixels, as
+    skimage.morphology.remove_small_objects does. \n
+    Blobs are labelled strip by strip in parallel and the labels of blobs
+    crossing the limit between two strips are merged before measuring them.
+    
+    Inputs : 5
+        binary : list of list
+            image, any non-zero pixel is white
+        noise : int
+            smaller blobs than this int will be removed
+        workers : int or None
+            number of threads (all the cores if None)
+        strips, pool : 
+            strips and pool of threads already used by the caller, if any
+    
+    Output : 1
+        binary : list of list
+            uint8 binary (0 or 255) without the small blobs
+    """
+    if pool is None:
+        workers = workers or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            return remove_noise(binary, noise, workers, get_strips(binary.shape[0], workers), pool)
+    labels, offsets, blob, area = label_strips(binary != 0, strips, pool)
+    # total area of every blob (sum of its parts in all strips)
+    blob_area = np.bincount(blob, weights = area)
+    keep = np.concatenate(([False], blob_area[blob] >= int(noise)))
+    out = np.empty(binary.shape, np.uint8)
+    def apply_strip(k):
+        y0, y1 = strips[k]
+        lut = np.where(keep[np.r_[0, offsets[k] + 1:offsets[k + 1] + 1]], 255, 0).astype(np.uint8)
+        np.take(lut, labels[k], out = out[y0:y1])
+    list(pool.map(apply_strip, range(len(strips))))
+    return out
+
+def flood_fill(img, strips, pool):
+    """ Same as cv2.floodFill(img, mask, (0, 0), 255) (4-connectivity, no
+    tolerance) but strip by strip in parallel.
+    
+    Inputs : 3
+        img : list of list
+            uint8 image, modified in place
+        strips : list of tuples
+            (first row, last row + 1) of every strip, see get_strips
+        pool : Executor
+            pool processing the strips in parallel
+    """
+    labels, offsets, blob, _ = label_strips(img == img[0, 0], strips, pool)
+    # blob containing the pixel (0, 0)
+    seed = blob[labels[0][0, 0] - 1]
+    fill = np.concatenate(([False], blob == seed))
+    def fill_strip(k):
+        y0, y1 = strips[k]
+        img[y0:y1][fill[np.r_[0, offsets[k] + 1:offsets[k + 1] + 1]][labels[k]]] = 255
+    list(pool.map(fill_strip, range(len(strips))))
+
+def label_strips(mask, strips, pool):
+    """ Label the 4-connected white blobs of every strip in parallel and merge
+    the labels of the blobs touching each other at the limit between strips.
+    
+    Inputs : 3
+        mask : list of list
+            bolean image
+        strips : list of tuples
+            (first row, last row + 1) of every strip, see get_strips
+        pool : Executor
+            pool processing the strips in parallel
+    
+    Outputs : 4
+        labels : list of list of list
+            labels of every strip (0 for black pixels, 1 to n in each strip)
+        offsets : list of int
+            the label k of the strip s is the part number offsets[s] + k - 1
+            of the whole image (parts are the blobs of each strip)
+        blob : list of int
+            blob number (whole image) of every part
+        area : list of int
+            area of every part
+    """
+    def label_strip(strip):
+        y0, y1 = strip
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(mask[y0:y1].view(np.uint8),
+                                                               connectivity = 4, ltype = cv2.CV_32S)
+        return labels, stats[1:, cv2.CC_STAT_AREA]
+    results = list(pool.map(label_strip, strips))
+    labels = [r[0] for r in results]
+    area = np.concatenate([r[1] for r in results])
+    offsets = np.cumsum([0] + [len(r[1]) for r in results])
+    # parts on both sides of a limit between strips are the same blob
+    above, below = [], []
+    for k in range(1, len(strips)):
+        a, b = labels[k - 1][-1], labels[k][0]
+        touching = (a > 0) & (b > 0)
+        above.append(a[touching] + offsets[k - 1] - 1)
+        below.append(b[touching] + offsets[k] - 1)
+    n = len(area)
+    edges = coo_matrix((np.ones(sum(len(a) for a in above), np.int8),
+                        (np.concatenate(above + [[]]).astype(np.int64), np.concatenate(below + [[]]).astype(np.int64))),
+                       shape = (n, n))
+    _, blob = connected_components(edges, directed = False)
+    return labels, offsets, blob, area
+
+def otsu_threshold(hist):
+    """ Otsu's threshold of a 256 bins histogram, computed exactly as OpenCV
+    does it in cv2.threshold(..., cv2.THRESH_OTSU) """
+    scale = 1./hist.sum()
+    mu = sum(i*float(hist[i]) for i in range(256))*scale
+    mu1, q1 = 0., 0.
+    max_sigma, max_val = 0., 0
+    eps = float(np.finfo(np.float32).eps)
+    for i in range(256):
+        p_i = hist[i]*scale
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1. - q1
+        if min(q1, q2) < eps or max(q1, q2) > 1. - eps:
+            continue
+        mu1 = (mu1 + i*p_i)/q1
+        mu2 = (mu - q1*mu1)/q2
+        sigma = q1*q2*(mu1 - mu2)*(mu1 - mu2)
+        if sigma > max_sigma:
+            max_sigma = sigma
+            max_val = i
+    return max_val
+
+def get_strips(height, workers):
+    """ Split 'height' rows in strips, a few per worker (64 rows at least)
+    
+    Output : 1
+        strips : list of tuples
+            (first row, last row + 1) of every strip
+    """
+    nb = max(1, min(height // 64, 4*workers))
+    limits = np.linspace(0, height, nb + 1).astype(int)
+    return list(zip(limits[:-1], limits[1:]))
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+2019, L. Tresch for University of Tokyo, Field Phenomics Research Laboratory
+Please read the read_me.txt for furter information.
+Annex code to MPE_main.py
+
+Content-addressed cache of the stages of the program (field crop, binary,
+angle, columns, rows, plots). Every stage is saved under a key made from all
+its inputs and parameters ; a run only computes again the stages whose key
+changed, and a run stopped midway starts again from the last saved stage.
+The cache is a folder ('Stage_cache' in the output folder) with one entry per
+stage and key : the values of the stage (compressed data.npz) and the files
+written by the stage, copied back in the output folder when the entry is used.
+The least recently used entries are removed once the cache is bigger than
+CACHE_SIZE.
+"""
+###############################################################################
+##################################### ENV #####################################
+###############################################################################
+
+import hashlib, os, shutil, threading, uuid, zipfile
+from pathlib import Path
+import numpy as np
+
+###############################################################################
+#################################### CODE #####################################
+###############################################################################
+
+# name of the cache folder, in the output folder
+CACHE_FOLDER = 'Stage_cache'
+# maximum size of the cache of one output folder (bytes)
+CACHE_SIZE = 4*2**30
+
+class StageCache:
+    """ Folder of cached stages, see the top of the file. \n
+    An entry is written in a temporary folder and renamed once complete, so
+    that several threads or processes can use the same cache and an entry is
+    never read half written."""
+
+    def __init__(self, folder, max_size = CACHE_SIZE):
+        """
+        Inputs : 2
+            folder : Path object
+                folder of the cache, made if needed
+            max_size : int
+                size (bytes) above which the least recently used entries
+                are removed
+        """
+        self.folder = Path(folder)
+        self.folder.mkdir(parents = True, exist_ok = True)
+        self.max_size = max_size
+
+    def key(self, stage, *inputs):
+        """ Key of a stage : name of the stage and hash of all its inputs
+        (arrays, numbers, strings, paths, lists, dict, keys of other stages)"""
+        h = hashlib.sha1(stage.encode())
+        for value in inputs:
+            _update(h, value)
+        return stage + '_' + h.hexdigest()[:24]
+
+    def load(self, key, folder = None):
+        """ Values of a stage, or None if the stage is not in the cache ; the
+        files of the stage are copied back in 'folder' if given"""
+        entry = self.folder / key
+        try:
+            with np.load(entry / 'data.npz', allow_pickle = False) as data:
+                values = {name: data[name] for name in data.files}
+            if folder is not None and (entry / 'files').is_dir():
+                shutil.copytree(entry / 'files', folder, dirs_exist_ok = True)
+            # the entry is the most recently used (see prune)
+            os.utime(entry)
+        except (OSError, ValueError, zipfile.BadZipFile, shutil.Error):
+            # entry missing, or removed meanwhile by another worker
+            return None
+        return values
+
+    def save(self, key, values, folder = None, files = ()):
+        """ Save the values (dict of arrays) of a stage and the files it wrote
+        (paths relative to 'folder', missing files are skipped)"""
+        entry = self.folder / key
+        tmp = self.folder / str('.' + key + '_' + str(os.getpid()) + '_'
+                                + str(threading.get_ident()) + '_' + uuid.uuid4().hex[:8])
+        tmp.mkdir()
+        try:
+            for name in files:
+                # a stage which failed did not write all its files
+                if not (Path(folder) / name).exists():
+                    continue
+                (tmp / 'files' / name).parent.mkdir(parents = True, exist_ok = True)
+                shutil.copy2(Path(folder) / name, tmp / 'files' / name)
+            # the data is written last, an entry without it is not used
+            np.savez_compressed(tmp / 'data.npz', **values)
+            if entry.exists():
+                shutil.rmtree(entry, ignore_errors = True)
+            os.replace(tmp, entry)
+        except OSError:
+            # same entry written at the same time by another worker
+            shutil.rmtree(tmp, ignore_errors = True)
+        self.prune(keep = key)
+
+    def prune(self, keep = None):
+        """ Remove the least recently used entries (but 'keep') until the
+        cache is not bigger than max_size"""
+        entries = []
+        for entry in self.folder.iterdir():
+            # entries being written start with a dot
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in entry.rglob('*') if f.is_file())
+                entries.append((entry.stat().st_mtime, size, entry))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            if entry.name == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors = True)
+            total -= size
+
+def stage_key(cache, stage, *inputs):
+    """ Key of a stage (see StageCache.key), None without cache"""
+    return None if cache is None else cache.key(stage, *inputs)
+
+def field_crop_key(cache, field_image, coord):
+    """ Key of the field crop (see get_drawn_image), the same in the GUI and
+    in the batch so that both share the crop and the following stages
+
+    Inputs : 3
+        cache : StageCache object or None
+            cache of the run
+        field_image : str or Path object
+            path of the field image
+        coord : list of tuples
+            corners (x, y) of the field, in pixels of the full image
+
+    Output : 1
+        key : str or None
+            key of the stage, None without cache
+    """
+    return stage_key(cache, 'crop', Path(field_image), [(int(x), int(y)) for x, y in coord])
+
+def run_stage(cache, key, compute, folder = None, files = (), restore = None):
+    """ Values of a stage, read in the cache if possible, otherwise computed
+    and saved
+
+    Inputs : 6
+        cache : StageCache object or None
+            cache of the run (the stage is always computed if None)
+        key : str
+            key of the stage (see stage_key)
+        compute : function
+            computes the stage (no input), returns a dict of arrays
+        folder : Path object
+            output folder, in which the files of the stage are written
+        files : list of str
+            files written by the stage, relative to folder
+        restore : function or None
+            writes the files of the stage again from its values (input),
+            when the stage is read from the cache ; used instead of 'files'
+            for the files which would only duplicate the values
+
+    Output : 1
+        values : dict of arrays
+    """
+    if cache is None:
+        return compute()
+    values = cache.load(key, folder)
+    if values is None:
+        values = compute()
+        cache.save(key, values, folder, files)
+    elif restore is not None:
+        restore(values)
+    return values
+
+def clear_outputs(folder):
+    """ Remove the outputs of a previous run from 'folder' but keep its cache"""
+    folder = Path(folder)
+    if not folder.is_dir():
+        return
+    for path in folder.iterdir():
+        if path.name == CACHE_FOLDER:
+            continue
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors = True)
+        else:
+            path.unlink()
+
+def _update(h, value):
+    """ Add a value to a hash, with its type so that 1, 1.0 and '1' differ"""
+    if isinstance(value, np.ndarray):
+        h.update(b'array' + str(value.dtype).encode() + str(value.shape).encode())
+        h.update(np.ascontiguousarray(value).view(np.uint8).ravel())
+    elif isinstance(value, Path):
+        # a file is identified by its path, size and modification date
+        h.update(b'path' + str(value.resolve()).encode())
+        if value.exists():
+            stat = value.stat()
+            h.update(str((stat.st_size, stat.st_mtime_ns)).encode())
+    elif isinstance(value, dict):
+        h.update(b'dict')
+        for k in sorted(value, key = str):
+            _update(h, k)
+            _update(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update(b'list' + str(len(value)).encode())
+        for item in value:
+            _update(h, item)
+    else:
+        h.update(type(value).__name__.encode() + repr(value).encode())
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+2019, L. Tresch for University of Tokyo, Field Phenomics Research Laboratory
+Please read the read_me.txt for furter information.
+Annex code to MPE_main.py
+
+Geometry of the plots : equations of the separation lines and corners of all
+the columns, rows and plots, computed on arrays (one pass for the whole field).
+Note : lines are written y = a*x + b, every column or row being delimited by
+two lines (element 0 : first line, element 1 : second line). Vertical lines
+(x = c, columns of a field aligned with the image) have a = inf and b = c.
+"""
+###############################################################################
+##################################### ENV #####################################
+###############################################################################
+
+import numpy as np
+
+###############################################################################
+################################## FUNCTIONS ##################################
+###############################################################################
+
+def get_equations(points):
+    """ Calculate affine equations of inputted points
+
+    Input : 1
+        points : array of shape (n, 4, 2)
+            coordinates of the separation lines of n elements i.e.
+            [[start line point 1, start line point 2, end line point 1,
+            end line point 2], [...], [...]]
+    Output : 2
+        a : array of shape (n, 2)
+            a coefficients of the start and end lines of every element, in the
+            same order as the input
+        b : array of shape (n, 2)
+            b coefficients of the start and end lines of every element, x of
+            the vertical lines"""
+    points = np.asarray(points)
+    dx = points[:, 0::2, 0] - points[:, 1::2, 0]
+    vertical = dx == 0
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        a = (points[:, 0::2, 1] - points[:, 1::2, 1])/dx
+        b = points[:, 0::2, 1] - a*points[:, 0::2, 0]
+    # vertical lines : a = inf and b = x
+    a[vertical] = np.inf
+    b[vertical] = points[:, 0::2, 0][vertical]
+    return a, b
+
+def line_pairs(nb_lines, per_plot):
+    """ Group the detected elements (columns or rows) by 'per_plot' ; if the
+    number of elements is not proportional, what is left is taken one by one
+
+    Inputs : 2
+        nb_lines : int
+            number of detected elements
+        per_plot : int
+            number of elements per plot, as inputted in the GUI
+
+    Output : 1
+        pairs : array of shape (m, 2)
+            first and last element of every group
+    """
+    n = per_plot - 1
+    starts = np.arange(0, nb_lines, per_plot)
+    complete = starts[starts + n < nb_lines]
+    pairs = np.column_stack((complete, complete + n))
+    # the rest, one by one
+    rest = np.arange(complete[-1] + n + 1 if len(complete) else 0, nb_lines)
+    return np.concatenate((pairs, np.column_stack((rest, rest)))).astype(int)
+
+def band_corners(a, b, pairs, maxY):
+    """ Corners, in the image, of the bands between the first line of the
+    start element and the second line of the end element of every pair. \n
+    The corners are on the lines y = 0 and y = maxY, or on x = 0 and x = maxY
+    for the bands (nearly) horizontal, whose corners would be too far away.
+
+    Inputs : 4
+        a, b : arrays of shape (n, 2)
+            equations of the lines (see get_equations)
+        pairs : array of shape (m, 2)
+            start and end elements of every band (see line_pairs)
+        maxY : int
+            size of the (square) rotated image, bigger than the image
+
+    Output : 1
+        corners : array of shape (m, 4, 2)
+            the 4 corners (x, y) of every band, the 2 lines being followed
+            in the same direction, in int32
+    """
+    start, end = pairs[:, 0], pairs[:, 1]
+    # start line, end line, end line, start line
+    line_a = np.stack((a[start, 0], a[end, 1], a[end, 1], a[start, 0]), axis = 1)
+    line_b = np.stack((b[start, 0], b[end, 1], b[end, 1], b[start, 0]), axis = 1)
+    t = np.array([0, 0, maxY, maxY], dtype = float)
+    corners = np.empty((len(pairs), 4, 2))
+    with np.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+        # x of the lines at y = t (b is x for the vertical lines)
+        x = np.where(np.isinf(line_a), line_b, (t - line_b)/line_a)
+        steep = (np.isfinite(x) & (np.abs(x) < 2**30)).all(axis = 1)[:, None]
+        corners[:, :, 0] = np.where(steep, x, t)
+        corners[:, :, 1] = np.where(steep, t, np.rint(line_a*t + line_b))
+    return corners.astype(np.int32)
+
+def plot_corners(startCol_a, endCol_a, startCol_b, endCol_b, startRow_a, endRow_a,
+                 startRow_b, endRow_b, aff, y_offset, x_offset):
+    ''' Intersection points of the lines of the columns and rows, i.e. the 4
+    corners, of all the plots at once
+    Note: "start" and "end" refers here to the considered plot here
+    Note : when a parameters are considered, the two value of an element are
+        either identical or very close.
+
+    Inputs : 11
+        startCol_a, endCol_a, startCol_b, endCol_b : arrays of shape (m, 2)
+            a and b parameters of the start and end column of every plot
+        startRow_a, endRow_a, startRow_b, endRow_b : arrays of shape (m, 2)
+            a and b parameters of the start and end row of every plot
+        aff : Affine object OR int (0)
+            Affine transformation matrix associated with the original image
+            georeferencement, project the calculated points into its CRS
+            Equals zero if the original image is not georeferenced
+        - Following inputs are the number of pixels cropped in the very first
+        step of the program (at binarization) to make the running time faster
+        y_offset : int
+            top pixels
+        x_offset :
+            left pixels
+
+    Outputs : 3
+        points : array of shape (m, 4, 2)
+            pixels coordinates of the corners of every plot, clockwise
+            [pt4, pt3, pt2, pt1], the y axis going up
+        points_geo : array of shape (m, 4, 2) or None
+            georeferenced corners, None if the original image is not
+            georeferenced
+        valid : array of m boleans
+            False for the plots with a column and a row (nearly) parallel,
+            their corners do not exist
+        '''
+    # lines crossing at every corner : x = (b_row - b_col)/(a_col - a_row)
+    # y = a_row*x + b_row ; x = b for a vertical line, whose y is given by
+    # the other line
+    col_a = np.stack((startCol_a[:, 0], startCol_a[:, 1], endCol_a[:, 1], endCol_a[:, 0]), axis = 1)
+    col_b = np.stack((startCol_b[:, 0], startCol_b[:, 0], endCol_b[:, 1], endCol_b[:, 1]), axis = 1)
+    row_a = np.stack((startRow_a[:, 0], endRow_a[:, 0], endRow_a[:, 1], startRow_a[:, 1]), axis = 1)
+    row_b = np.stack((startRow_b[:, 0], endRow_b[:, 1], endRow_b[:, 1], startRow_b[:, 0]), axis = 1)
+    # the y of the 4th point uses the a parameter of the first line
+    row_a_y = np.stack((startRow_a[:, 0], endRow_a[:, 0], endRow_a[:, 1], startRow_a[:, 0]), axis = 1)
+    col_v, row_v = np.isinf(col_a), np.isinf(row_a)
+    with np.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+        x = np.where(col_v, col_b, np.where(row_v, row_b, (row_b - col_b)/(col_a - row_a)))
+        y = np.where(row_v, col_a*x + col_b, row_a_y*x + row_b)
+        # parallel lines (relatively to their slopes) do not cross
+        scale = np.maximum(np.maximum(np.abs(col_a), np.abs(row_a)), 1)
+        crossing = np.where(col_v | row_v, ~(col_v & row_v), np.abs(col_a - row_a) > 1e-9*scale)
+        valid = crossing.all(axis = 1)
+        valid &= np.isfinite(x).all(axis = 1) & np.isfinite(y).all(axis = 1)
+        x = x + x_offset
+        # pt4, pt3, pt2, pt1 ; -1*y because for images the axis goes down
+        points = np.stack((x, - y - y_offset), axis = 2)[:, ::-1]
+        # if aff = 0, it means the original image was not georeferenced
+        if aff == 0:
+            return points, None, valid
+        # multiply by the affine transformation matrix
+        x_geo, y_geo = aff*(x, y + y_offset)
+    points_geo = np.stack((x_geo, y_geo), axis = 2)[:, ::-1]
+    return points, points_geo, valid
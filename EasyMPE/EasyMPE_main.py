@@ -13,21 +13,56 @@ Reverse calculation code is based on Pix4D outputs and Pix4D explanations.
 ################################ ENVIRONMENT ##################################
 ###############################################################################
 
+import threading, traceback
 from pathlib import Path
-import cv2, numpy as np, rasterio.transform
-from shutil import rmtree
+import cv2, numpy as np
 from PyQt5.QtWidgets import (QApplication, QGridLayout, QLabel, QSpinBox, 
         QDoubleSpinBox, QWidget, QPushButton, QMessageBox, QFileDialog,
-        QComboBox, QRadioButton, QCheckBox)
-from PyQt5.QtCore import Qt
-from skimage import  morphology
+        QComboBox, QRadioButton, QCheckBox, QProgressBar)
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
 from EasyMPE_plot_identification import MPE
 from EasyMPE_revCal import ReverseCalculation
+from EasyMPE_binarization import (get_drawn_image, get_binary, preview_image,
+        preview_noise, binarize, cut_field, save_binary)
+from EasyMPE_raster import FieldRaster
+from EasyMPE_cache import StageCache, CACHE_FOLDER, clear_outputs, field_crop_key, run_stage
+from EasyMPE_viewer import TileViewer
 
 ###############################################################################
 #################################### CODE #####################################
 ###############################################################################
 
+class Worker(QThread):
+    """ Runs a function out of the GUI thread ; its result is sent with the
+    signal 'done', or its error with the signal 'failed'. \n
+    With report = True, the function is also given progress (sends the signal
+    'progress' with the stage, the steps done and the total of steps) and
+    cancel (threading.Event set by the method cancel), as MPE and
+    ReverseCalculation accept."""
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    progress = pyqtSignal(str, int, int)
+    
+    def __init__(self, function, *args, report = False, **kwargs):
+        super(Worker, self).__init__()
+        self.function, self.args, self.kwargs = function, args, kwargs
+        self.cancel_event = threading.Event()
+        if report:
+            self.kwargs.update(progress = self.progress.emit, cancel = self.cancel_event)
+    
+    def cancel(self):
+        """ The function stops at its next check (see EasyMPE_progress.py)"""
+        self.cancel_event.set()
+    
+    def run(self):
+        try:
+            result = self.function(*self.args, **self.kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            self.failed.emit(repr(e))
+            return
+        self.done.emit(result)
+
 class MainWindow(QWidget):
     """ This class contain the GUI and the functions for the Main window \n
     and uses all the other classes."""
@@ -40,11 +75,16 @@ class MainWindow(QWidget):
         
         ## initialization
         self.field_image = None
+        self.field_raster = None
         self.displaySize = 400
         self.threshold = 0.20
         self.noise = 200
         self.pix4D = None
         self.rawImgFold = None
+        # jobs waiting to be run ((label, folder, worker)), running job
+        self.jobs = []
+        self.job = None
+        self.revcal_folder = None
 
         ## definition
         self.text_intro = QLabel('LOAD FIELD IMAGE')
@@ -94,6 +134,8 @@ class MainWindow(QWidget):
         self.radio_horizontal.setChecked(True)
         self.radio_vertical = QRadioButton('Vertical')
         self.radio_vertical.setChecked(False)
+        self.check_shp = QCheckBox('Also save *.shp files')
+        self.check_whole = QCheckBox('Also save the plots on the whole field image')
         self.button_apply = QPushButton('Identify plots')
 
         self.text_intro_revCal = QLabel('CALCULATE PLOT COORDINATES IN RAW IMAGES')
@@ -103,6 +145,10 @@ class MainWindow(QWidget):
         self.text_rawImgFold = QLabel('Raw images folder:')
         self.button_rawImgFold = QPushButton('Choose')
         self.button_apply_revCal = QPushButton('Apply')
+        self.viewer = TileViewer(self)
+        self.text_job = QLabel()
+        self.progress_job = QProgressBar()
+        self.button_cancel = QPushButton('Cancel')
         
         ## connections
         self.button_fieldImage.clicked.connect(self.fieldImage_clicked)
@@ -113,6 +159,11 @@ class MainWindow(QWidget):
         self.button_pix4D.clicked.connect(self.button_pix4D_clicked)
         self.button_rawImgFold.clicked.connect(self.button_rawImgFold_clicked)
         self.button_apply_revCal.clicked.connect(self.button_apply_revCal_clicked)
+        self.viewer.drawn.connect(self.field_drawn)
+        self.viewer.cancelled.connect(self.drawing_cancelled)
+        self.viewer.accepted.connect(self.binary_accepted)
+        self.viewer.retried.connect(self.binary_retried)
+        self.button_cancel.clicked.connect(self.cancel_clicked)
         
         ## options
         self.text_screenSize.hide()
@@ -137,49 +188,61 @@ class MainWindow(QWidget):
         self.text_plotArrangment.hide()
         self.radio_horizontal.hide()
         self.radio_vertical.hide()
+        self.check_shp.hide()
+        self.check_whole.hide()
         self.text_intro_revCal.hide()
         self.text_pix4D.hide()
         self.button_pix4D.hide()
         self.text_rawImgFold.hide()
         self.button_rawImgFold.hide()
         self.button_apply_revCal.hide()
+        self.viewer.hide()
+        self.text_job.hide()
+        self.progress_job.hide()
+        self.button_cancel.hide()
         
         ## layout
         self.layout = QGridLayout()
-        self.layout.addWidget(self.text_intro, 1, 0, 1, -1)
+        self.layout.addWidget(self.text_intro, 1, 0, 1, 5)
         self.layout.addWidget(self.text_fieldImage, 2, 0)
-        self.layout.addWidget(self.button_fieldImage, 2, 1, 1, -1)
+        self.layout.addWidget(self.button_fieldImage, 2, 1, 1, 4)
         self.layout.addWidget(self.text_image, 3, 0)
-        self.layout.addWidget(self.text_imagePath, 3, 1, 1, -1)
-        self.layout.addWidget(self.check_binary, 4, 1, 1, -1)
+        self.layout.addWidget(self.text_imagePath, 3, 1, 1, 4)
+        self.layout.addWidget(self.check_binary, 4, 1, 1, 4)
         self.layout.addWidget(self.text_noise, 5, 0)
         self.layout.addWidget(self.spinbox_noise, 5, 1)
         self.layout.addWidget(self.text_screenSize, 6, 0)
         self.layout.addWidget(self.comboBox_screenSize, 6, 1)
         self.layout.addWidget(self.text_screenSize2, 6, 2, 1, 3)
-        self.layout.addWidget(self.button_drawField, 7, 0, 1, -1)
+        self.layout.addWidget(self.button_drawField, 7, 0, 1, 5)
         
         self.layout.addWidget(self.text_threshold, 8, 0)
         self.layout.addWidget(self.spinbox_threshold, 8, 1)
-        self.layout.addWidget(self.text_threshold2, 8, 2, 1, -1)
-        self.layout.addWidget(self.button_getBinary, 9, 0, 1, -1)
+        self.layout.addWidget(self.text_threshold2, 8, 2, 1, 3)
+        self.layout.addWidget(self.button_getBinary, 9, 0, 1, 5)
         
-        self.layout.addWidget(self.text_plot,10, 0, 1, -1)
+        self.layout.addWidget(self.text_plot,10, 0, 1, 5)
         self.layout.addWidget(self.text_nbOfRowPerPlot, 11, 0)
-        self.layout.addWidget(self.spinbox_nbOfRowPerPlot, 11, 1, 1, -1)
+        self.layout.addWidget(self.spinbox_nbOfRowPerPlot, 11, 1, 1, 4)
         self.layout.addWidget(self.text_nbOfColumnPerPlot, 12, 0)
-        self.layout.addWidget(self.spinbox_nbOfColumnPerPlot, 12, 1, 1, -1)
+        self.layout.addWidget(self.spinbox_nbOfColumnPerPlot, 12, 1, 1, 4)
         self.layout.addWidget(self.text_plotArrangment, 13, 0)
         self.layout.addWidget(self.radio_horizontal, 13, 1)
         self.layout.addWidget(self.radio_vertical, 13, 2)
-        self.layout.addWidget(self.button_apply, 14, 0, 1, -1)
+        self.layout.addWidget(self.check_shp, 13, 3)
+        self.layout.addWidget(self.check_whole, 13, 4)
+        self.layout.addWidget(self.button_apply, 14, 0, 1, 5)
         
-        self.layout.addWidget(self.text_intro_revCal, 15, 0, 1, -1)
+        self.layout.addWidget(self.text_intro_revCal, 15, 0, 1, 5)
         self.layout.addWidget(self.text_pix4D, 16, 0)
-        self.layout.addWidget(self.button_pix4D, 16, 1, 1, -1)
+        self.layout.addWidget(self.button_pix4D, 16, 1, 1, 4)
         self.layout.addWidget(self.text_rawImgFold, 17, 0)
-        self.layout.addWidget(self.button_rawImgFold, 17, 1, 1, -1)
-        self.layout.addWidget(self.button_apply_revCal, 18, 0, 1, -1)
+        self.layout.addWidget(self.button_rawImgFold, 17, 1, 1, 4)
+        self.layout.addWidget(self.button_apply_revCal, 18, 0, 1, 5)
+        self.layout.addWidget(self.viewer, 1, 5, 18, 1)
+        self.layout.addWidget(self.text_job, 19, 0)
+        self.layout.addWidget(self.progress_job, 19, 1, 1, 4)
+        self.layout.addWidget(self.button_cancel, 19, 5)
         self.setLayout(self.layout)  
         
         self.show()
@@ -212,7 +275,12 @@ class MainWindow(QWidget):
         self.field_image, _ = QFileDialog.getOpenFileName(self, "Select the field image", "",".tif or .tiff or .jpg or .jpeg or .png (*.tif *.tiff *.TIF *.TIFF *.jpg *.jpeg *.JPG *.JPEG *.PNG *.png)", options=QFileDialog.DontUseNativeDialog)
         self.field_image = Path(self.field_image)
         self.text_imagePath.setText(str(self.field_image))
+        # the image is opened once, only the needed parts are read afterwards
+        if self.field_raster is not None:
+            self.field_raster.close()
+            self.field_raster = None
         if self.field_image.is_file():
+            self.field_raster = FieldRaster(self.field_image)
             self.check_binary.show()
             self.text_noise.show()
             self.spinbox_noise.show()
@@ -233,6 +301,7 @@ class MainWindow(QWidget):
             self.comboBox_screenSize.hide()
             self.button_drawField.hide()
         self.coord = []
+        self.viewer.hide()
         self.text_threshold.hide()
         self.text_threshold2.hide()
         self.spinbox_threshold.hide()
@@ -246,6 +315,8 @@ class MainWindow(QWidget):
         self.text_plotArrangment.hide()
         self.radio_horizontal.hide()
         self.radio_vertical.hide()
+        self.check_shp.hide()
+        self.check_whole.hide()
         self.text_intro_revCal.hide()
         self.text_pix4D.hide()
         self.button_pix4D.hide()
@@ -255,216 +326,203 @@ class MainWindow(QWidget):
 
     def drawField_clicked(self):
         """This function is part of the class 'MainWindow' \n
-        It is connected to the button button_drawField and opens the beforehand
-        chosen image of fieldImage_clicked into a new window so the user can
-        select the field points as they wish. The image is then binarized using
-        ExGreen calculation and cropped to avoid useless data storage"""
+        It is connected to the button button_drawField and shows the beforehand
+        chosen image of fieldImage_clicked in the viewer so the user can
+        select the field points as they wish, at full resolution (see
+        field_drawn)"""
         
         # instructions
-        QMessageBox.about(self, 'Information', "A drawing window will appear. \nTo (Q)uit without saving, press Q.\nTo (R)estart, press R. \nWhen you are (D)one, press D. \n\nPlease mark the corners of the field. \nNo need to close the polygon.")
+        QMessageBox.about(self, 'Information', "The image will appear in the viewer. \nZoom with the mouse wheel, move the image by dragging it and (F)it it to the viewer with F. \nTo (Q)uit without saving, press Q.\nTo (R)estart, press R. \nWhen you are (D)one, press D. \n\nPlease click on the corners of the field. \nNo need to close the polygon.")
         
         # initialization
         self.coord = []
         self.YN_binary = self.check_binary.isChecked()
-        self.img = cv2.imread(str(self.field_image))
         img_name = self.field_image.stem
-        WindowsName = 'Mark the corners of the field. (Q)uit  (R)estart  (D)one'
  
-        # make a repository
-        self.main_folder = self.field_image.parent / str('Micro_plots_' + img_name)
-        if self.main_folder.is_dir():
-            rmtree(self.main_folder, ignore_errors = True)
-        try:
-            self.main_folder.mkdir()   
-        except PermissionError:
-            QMessageBox.about(self, 'Information', "Previous results for this image already existed and have been erased.")
-            self.main_folder.mkdir()   
-        except FileExistsError:
-            QMessageBox.about(self, 'Information', "Results for this image already exist. Please delete or rename it and try again.")
+        # make a repository ; previous results are erased but not their cache,
+        # the stages whose inputs did not change are not computed again
+        main_folder = self.field_image.parent / str('Micro_plots_' + img_name)
+        if main_folder in self.busy_folders():
+            QMessageBox.about(self, 'Information', "The plots of this image are being computed. \nPlease wait for the end of the job or cancel it.")
             return
+        self.main_folder = main_folder
+        clear_outputs(self.main_folder)
+        self.main_folder.mkdir(exist_ok = True)
+        self.cache = StageCache(self.main_folder / CACHE_FOLDER)
         
-        # resize the image according to the screen size 
-        if len(self.img[:, 0]) >= len(self.img[0,:]) : #if the picture's height is bigger than its width 
-            self.H = self.displaySize
-            coeff = self.H/len(self.img[:, 0])
-            self.W = int(coeff*len(self.img[0, :]))
-        else: # if width is bigger than height
-            self.W = self.displaySize
-            coeff = self.W/len(self.img[0, :])
-            self.H = int(coeff*len(self.img[:, 0]))
-        self.img = cv2.resize(self.img, (self.W, self.H)) 
+        # show the image in the viewer (only the visible tiles are read)
+        W, H, _ = self.field_raster.display_size(self.displaySize)
+        self.viewer.setMinimumSize(W, H)
+        self.viewer.show()
+        self.viewer.set_raster(self.field_raster)
+        self.viewer.start_drawing()
+
+    def field_drawn(self, coord):
+        """This function is part of the class 'MainWindow' \n
+        It is connected to the end of the drawing in the viewer (D key). The
+        field is read at full resolution inside the clicked corners and
+        cropped to avoid useless data storage
         
+        Input : 1
+            coord : list of tuples
+                corners (x, y) of the field, in pixels of the full image
+        """
+        # field must be at least rectangular
+        if len(coord) < 3:
+            QMessageBox.about(self, 'Information', "Please select at least 3 points. \nIf you want to escape, press 'q' key.")
+            return
+        self.viewer.stop()
+        self.coord = coord
+        QMessageBox.about(self, 'Information', "Selected points are: \n" + str(self.coord) + '\n\nThe image will be processed. \nPress OK and wait a few seconds.')
+        # save the coordinate image, at the size of the screen
+        img_display, coeff = self.field_raster.read_display(self.displaySize)
         # if binary is [0,1], map 1's to 255
-        if np.amax(self.img) == 1 :
-            self.img [self.img == 1] = 255
-
-        # display the picture in a new window
-        cv2.namedWindow(WindowsName) 
-        cv2.setMouseCallback(WindowsName, self.draw_point, param = None)
+        if np.amax(img_display) == 1 :
+            img_display [img_display == 1] = 255
+        points = np.int32([[(x*coeff, y*coeff) for x, y in self.coord]])
+        cv2.polylines(img_display, points, True, (255, 0, 255), 1)
+        for point in points[0]:
+            cv2.circle(img_display, tuple(int(v) for v in point), 6, (0, 0, 255), -1)
+        cv2.imwrite(str(self.main_folder / 'Field_points.jpg'), img_display)
         
-        # events while drawing (infinite loop)
-        while (1):
-            # show the image window
-            cv2.imshow(WindowsName, self.img)
-            key = cv2.waitKey(20) & 0xFF
-            
-            # to restart the drawing
-            if key == ord('r') or key == ord('R'): 
-                # reload the original image (without any points on it)
-                self.img = cv2.imread(str(self.field_image))
-                self.img = cv2.resize(self.img, (self.W, self.H)) 
-                cv2.namedWindow(WindowsName, cv2.WINDOW_NORMAL) # define the name of the window again
-                cv2.setMouseCallback(WindowsName, self.draw_point, param = None) # call the function 
-                self.coord = [] # do not save any coordinates
-
-            # to exit and stop the drawing mode
-            if key == ord('q') or key == ord('Q'):
-                self.coord = [] # no pixels are saved
-                QMessageBox.about(self, 'Information', "No corners were selected.")
-                # close the window
-                cv2.destroyAllWindows()
-                cv2.waitKey(1)
-                self.text_threshold.hide()
-                self.text_threshold2.hide()
-                self.spinbox_threshold.hide()
-                self.button_getBinary.hide()
-                self.text_plot.hide()
-                self.text_nbOfRowPerPlot.hide()
-                self.spinbox_nbOfRowPerPlot.hide()
-                self.text_nbOfColumnPerPlot.hide()
-                self.spinbox_nbOfColumnPerPlot.hide()
-                self.button_apply.hide()
-                self.text_plotArrangment.hide()
-                self.radio_horizontal.hide()
-                self.radio_vertical.hide()
-                self.text_intro_revCal.hide()
-                self.text_pix4D.hide()
-                self.button_pix4D.hide()
-                self.text_rawImgFold.hide()
-                self.button_rawImgFold.hide()
-                self.button_apply_revCal.hide()
-                return
-            
-            # to finish the drawing and save the points drawn
-            if key == ord('d') or key == ord('D'): 
-                # field must be at least rectangular
-                if len(self.coord) < 3:
-                    QMessageBox.about(self, 'Information', "Please select at least 3 points. \nIf you want to escape, press 'e' key.")
-                else: 
-                    ## when done, saving the images and producing exG + binary images
-                    # close the drawing with the last magenta line
-                    cv2.line(self.img, self.coord[-1], self.coord[0], (255, 0, 255), 1)
-                    cv2.imshow(WindowsName, self.img)
-                    QMessageBox.about(self, 'Information', "Selected points are: \n" + str(self.coord) + '\n\nThe image will be processed. \nPress OK and wait a few seconds.')
-                    # save the coordinate image
-                    cv2.imwrite(str(self.main_folder / 'Field_points.jpg'), self.img)
-                    cv2.destroyWindow(WindowsName)
-                    self.img = get_drawn_image(self.field_image, self.coord, coeff)
-                    
-                    if self.YN_binary:
-                        # get rid of the useless black pixels
-                        coords = np.argwhere(self.img)
-                        y0, x0 = coords.min(axis = 0)
-                        y1, x1 = coords.max(axis = 0) + 1
-                        self.img = self.img[y0:y1, x0:x1]
-                        # apply the noise removal
-                        B = (self.img != 0)
-                        self.img_binary = morphology.remove_small_objects(B, min_size = int(self.noise))*255
-                        # save binary image
-                        cv2.imwrite(str(self.main_folder / 'Binary_image.tiff'), self.img_binary)
-                        # save the value of cutted black parts for the end of the program (shp files)
-                        self.y_offset, self.x_offset = y0, x0
+        self.crop_key = field_crop_key(self.cache, self.field_image, self.coord)
+        self.binary_key = None
+        self.img_preview = None
+        crop = run_stage(self.cache, self.crop_key,
+                         lambda: dict(zip(('img', 'y_window', 'x_window'),
+                                          get_drawn_image(self.field_raster, self.coord, 1))))
+        self.img = crop['img']
+        self.y_window, self.x_window = int(crop['y_window']), int(crop['x_window'])
         
-                        self.text_plot.show()
-                        self.text_nbOfRowPerPlot.show()
-                        self.spinbox_nbOfRowPerPlot.show()
-                        self.text_nbOfColumnPerPlot.show()
-                        self.spinbox_nbOfColumnPerPlot.show()
-                        self.button_apply.show()
-                        self.text_plotArrangment.show()
-                        self.radio_horizontal.show()
-                        self.radio_vertical.show()
-                        self.text_threshold.hide()
-                        self.text_threshold2.hide()
-                        self.spinbox_threshold.hide()
-                        self.button_getBinary.hide()
-                    else:
-                        self.text_threshold.show()
-                        self.text_threshold2.show()
-                        self.spinbox_threshold.show()
-                        self.button_getBinary.show()
-                    self.text_intro_revCal.hide()
-                    self.text_pix4D.hide()
-                    self.button_pix4D.hide()
-                    self.text_rawImgFold.hide()
-                    self.button_rawImgFold.hide()
-                    self.button_apply_revCal.hide()
-                    return
+        if self.YN_binary:
+            self.text_threshold.hide()
+            self.text_threshold2.hide()
+            self.spinbox_threshold.hide()
+            self.button_getBinary.hide()
+            # same path as the batch (one channel, black pixels cut, noise
+            # removal), the plot parameters are shown in binary_done
+            self.binary_accepted()
+        else:
+            self.viewer.set_array(self.img)
+            self.text_threshold.show()
+            self.text_threshold2.show()
+            self.spinbox_threshold.show()
+            self.button_getBinary.show()
+        self.text_intro_revCal.hide()
+        self.text_pix4D.hide()
+        self.button_pix4D.hide()
+        self.text_rawImgFold.hide()
+        self.button_rawImgFold.hide()
+        self.button_apply_revCal.hide()
+
+    def drawing_cancelled(self):
+        """This function is part of the class 'MainWindow' \n
+        It is connected to the end of the drawing in the viewer without any
+        field (Q key)"""
+        self.coord = [] # no pixels are saved
+        QMessageBox.about(self, 'Information', "No corners were selected.")
+        self.viewer.hide()
+        self.text_threshold.hide()
+        self.text_threshold2.hide()
+        self.spinbox_threshold.hide()
+        self.button_getBinary.hide()
+        self.text_plot.hide()
+        self.text_nbOfRowPerPlot.hide()
+        self.spinbox_nbOfRowPerPlot.hide()
+        self.text_nbOfColumnPerPlot.hide()
+        self.spinbox_nbOfColumnPerPlot.hide()
+        self.button_apply.hide()
+        self.text_plotArrangment.hide()
+        self.radio_horizontal.hide()
+        self.radio_vertical.hide()
+        self.check_shp.hide()
+        self.check_whole.hide()
+        self.text_intro_revCal.hide()
+        self.text_pix4D.hide()
+        self.button_pix4D.hide()
+        self.text_rawImgFold.hide()
+        self.button_rawImgFold.hide()
+        self.button_apply_revCal.hide()
                     
     def getBinary_clicked(self):
         """This function is part of the class 'MainWindow' \n
-        It is connected to the button button_getBinary and opens the beforehand
-        chosen image of fieldImage_clicked into a new window so the user can
-        select the field points as they wish. The image is then binarized using
-        ExGreen calculation and cropped to avoid useless data storage"""
+        It is connected to the button button_getBinary. The field image is
+        binarized using ExGreen calculation at the scale of the screen (see
+        preview_image) so that every threshold can be tried at once. When the
+        binary is accepted, the full resolution binary is computed in the
+        background and cropped to avoid useless data storage (see binary_done)"""
         
         self.threshold = self.spinbox_threshold.value()
         self.noise = self.spinbox_noise.value()
-        # get coordinates of the first non-black pixels
-        coords = np.argwhere(self.img)
-        try:
-            y0, x0, z = coords.min(axis = 0)
-            y1, x1, z = coords.max(axis = 0) + 1
-            # generate a binary image
-            self.img_exG, self.img_binary = get_binary(self.img, self.noise, self.threshold)
-           # cut all images according to avoid useless black pixels
-            self.img = self.img[y0:y1, x0:x1]
-            self.img_exG = self.img_exG[y0:y1, x0:x1]
-            self.img_binary = self.img_binary[y0:y1, x0:x1]
-            # save outputs
-            cv2.imwrite(str(self.main_folder / 'ExcessGreen.tiff'), self.img_exG)
-            cv2.imwrite(str(self.main_folder / 'Field_area.tiff'), self.img)
-             # show binary and ask to accept/reject
-            QMessageBox.about(self, 'Information', "The binary will be displayed. \nTo (A)ccept it, press A.\nTo (R)etry with a different threshold, press R.")
-            while (1):
-                # show the image window
-                self.img_binary_show = cv2.resize(self.img_binary, (self.W, self.H)) 
-                cv2.imshow('Binary. (A)ccept  (R)etry', self.img_binary_show)
-                key = cv2.waitKey(20) & 0xFF
-                # to retry with different values
-                if key == ord('r') or key == ord('R'): 
-                    cv2.destroyAllWindows()
-                    self.text_plot.hide()
-                    self.text_nbOfRowPerPlot.hide()
-                    self.spinbox_nbOfRowPerPlot.hide()
-                    self.text_nbOfColumnPerPlot.hide()
-                    self.spinbox_nbOfColumnPerPlot.hide()
-                    self.button_apply.hide()
-                    self.text_plotArrangment.hide()
-                    self.radio_horizontal.hide()
-                    self.radio_vertical.hide()
-                    self.text_intro_revCal.hide()
-                    self.text_pix4D.hide()
-                    self.button_pix4D.hide()
-                    self.text_rawImgFold.hide()
-                    self.button_rawImgFold.hide()
-                    self.button_apply_revCal.hide()
-                    return
-                if key == ord('a') or key == ord('A'): 
-                    cv2.destroyAllWindows()
-                    break
-        except ValueError:
+        if self.img.ndim == 2:
             QMessageBox.about(self, 'Information', "It seems that your image is already a binary. It will be treated as a binary for the rest of the program.")
-            self.YN_binary == True
-            y0, x0 = coords.min(axis = 0)
-            y1, x1 = coords.max(axis = 0) + 1
-            self.img = self.img[y0:y1, x0:x1]
-            # apply the noise removal
-            B = (self.img != 0)
-            self.img_binary = morphology.remove_small_objects(B, min_size = int(self.noise))*255
-        
+            self.YN_binary = True
+        else:
+            # reduced image, made once per drawn field
+            if self.img_preview is None:
+                self.img_preview, self.preview_scale = preview_image(self.img, self.displaySize)
+            # the noise is an area, reduced as the image
+            _, preview_binary = get_binary(self.img_preview, preview_noise(self.noise, self.preview_scale),
+                                           self.threshold)
+            # show binary in the viewer and ask to accept/reject
+            self.viewer.set_array(preview_binary, self.preview_scale)
+            self.viewer.start_review()
+            QMessageBox.about(self, 'Information', "The binary is displayed in the viewer. \nTo (A)ccept it, press A.\nTo (R)etry with a different threshold, press R.")
+            return
+        self.binary_accepted()
+
+    def binary_retried(self):
+        """This function is part of the class 'MainWindow' \n
+        It is connected to the R key in the viewer, when the binary is shown"""
+        self.viewer.set_array(self.img)
+        self.text_plot.hide()
+        self.text_nbOfRowPerPlot.hide()
+        self.spinbox_nbOfRowPerPlot.hide()
+        self.text_nbOfColumnPerPlot.hide()
+        self.spinbox_nbOfColumnPerPlot.hide()
+        self.button_apply.hide()
+        self.text_plotArrangment.hide()
+        self.radio_horizontal.hide()
+        self.radio_vertical.hide()
+        self.check_shp.hide()
+        self.check_whole.hide()
+        self.text_intro_revCal.hide()
+        self.text_pix4D.hide()
+        self.button_pix4D.hide()
+        self.text_rawImgFold.hide()
+        self.button_rawImgFold.hide()
+        self.button_apply_revCal.hide()
+
+    def binary_accepted(self):
+        """This function is part of the class 'MainWindow' \n
+        It is connected to the A key in the viewer, when the binary is shown,
+        and starts the full resolution binarization"""
+        # full resolution binary, computed once in the background (read from
+        # the cache if this threshold has already been used)
+        self.binary_key = self.cache.key('binary', self.crop_key, self.YN_binary, self.noise, self.threshold)
+        img, YN_binary, noise, threshold = self.img, self.YN_binary, self.noise, self.threshold
+        self.binary_worker = Worker(run_stage, self.cache, self.binary_key,
+                                    lambda: binarize(img, YN_binary, noise, threshold, self.main_folder),
+                                    restore = lambda binary: save_binary(binary, img, YN_binary, self.main_folder))
+        self.binary_worker.done.connect(self.binary_done)
+        self.binary_worker.failed.connect(self.binary_failed)
+        self.button_fieldImage.setEnabled(False)
+        self.button_drawField.setEnabled(False)
+        self.button_getBinary.setEnabled(False)
+        self.button_getBinary.setText('Computing the full resolution binary...')
+        self.binary_worker.start()
+
+    def binary_done(self, binary):
+        """ This function is part of the class 'MainWindow' \n
+        It is connected to the end of the full resolution binarization started
+        in getBinary_clicked and unlocks the plot parameters"""
+        self.img, self.img_binary = cut_field(self.img, binary, self.YN_binary), binary['img_binary']
         # save the value of cutted black parts for the end of the program (shp files)
-        self.y_offset, self.x_offset = y0, x0
+        self.y_offset, self.x_offset = int(binary['y0']) + self.y_window, int(binary['x0']) + self.x_window
+        self.img_preview = None
+        self.binary_ended()
+        # the full resolution binary can be checked in the viewer
+        self.viewer.set_array(self.img_binary)
         
         # displays buttons useful for next steps
         self.text_plot.show()
@@ -476,34 +534,29 @@ class MainWindow(QWidget):
         self.text_plotArrangment.show()
         self.radio_horizontal.show()
         self.radio_vertical.show()
+        self.check_shp.show()
+        self.check_whole.show()
         self.text_intro_revCal.hide()
         self.text_pix4D.hide()
         self.button_pix4D.hide()
         self.text_rawImgFold.hide()
         self.button_rawImgFold.hide()
         self.button_apply_revCal.hide()
+
+    def binary_failed(self, message):
+        """ This function is part of the class 'MainWindow' \n
+        It is connected to an error of the full resolution binarization"""
+        self.binary_ended()
+        QMessageBox.about(self, 'Information', 'Sorry, the binarization failed: \n' + message)
+
+    def binary_ended(self):
+        """ This function is part of the class 'MainWindow' \n
+        Unlocks the buttons locked during the full resolution binarization"""
+        self.button_fieldImage.setEnabled(True)
+        self.button_drawField.setEnabled(True)
+        self.button_getBinary.setEnabled(True)
+        self.button_getBinary.setText('Convert to binary')
             
-    def draw_point (self, event, x, y, flags, param):
-        """ This function is part of the class 'MainWindow' and is used in the
-        function 'drawField_clicked'. 
-        It draws a red circle everytime the right
-        button of the mouse is clicked down. If there is more than one point, a 
-        magenta line will link the two latest points clicked.
-        
-        Inputs : 5
-            event : mouth clicked down
-            x : position on the x-axis
-            y : position on the y-axis (going down)
-            flags : 
-            param : None [could pass a specific color if needed]
-            """
-        if event == cv2.EVENT_LBUTTONDOWN: 
-            #when the button is pushed, the first pixel is recorded and a circle is drawn on the picture
-            self.coord.append((int(x), int(y)))
-            cv2.circle(self.img, (x,y), 6, (0, 0, 255), -1) #draw the circle
-            if len(self.coord) > 1:
-                cv2.line(self.img, self.coord[-2], self.coord[-1], (255, 0, 255), 1)
-                
     def application(self):
         """ This function is part of the class 'MainWindow'.
         It is linked to the button 'button_apply' and starts the image 
@@ -512,58 +565,71 @@ class MainWindow(QWidget):
         if self.radio_horizontal.isChecked() == False and self.radio_vertical.isChecked() == False:
             QMessageBox.about(self, 'Information', "Please indicate if the ranges are more vertically or horizontally oriented. \nIf no particular orientation stands out, choose any.")
         else:
-            img_raster = rasterio.open(self.field_image)
-            aff = img_raster.transform
-            self.crs = img_raster.crs
+            aff = self.field_raster.transform
+            self.crs = self.field_raster.crs
             if type(self.crs) == type(None):
                 aff = 0
-            img_raster.close()
             nbRow = self.spinbox_nbOfRowPerPlot.value()
             nbColumn = self.spinbox_nbOfColumnPerPlot.value()
             if self.radio_horizontal.isChecked() == True:
                 orientation = 'H'
             elif self.radio_vertical.isChecked() == True:
                 orientation = 'V'
-            # inform the user the program is finished
-
-            output = MPE(self.img_binary, self.main_folder, self.img, self.YN_binary,
+            # the plots are saved in All_plots.gpkg, and in *.shp files if asked ;
+            # the job runs in the background, so that the next field can be
+            # prepared and queued meanwhile
+            shp = self.check_shp.isChecked()
+            stats = {}
+            # the plots on the whole field image cost a pass over the field
+            # per plot, they are only saved if asked
+            worker = Worker(MPE, self.img_binary, self.main_folder, self.img, self.YN_binary,
                 nbRow, nbColumn, orientation, self.noise,
-                self.field_image, aff, self.y_offset, self.x_offset)
-        
+                self.field_image, aff, self.y_offset, self.x_offset, stats = stats,
+                crs = self.crs, legacy_shp = shp, plot_shp = shp, cache = self.cache,
+                binary_key = self.binary_key, save_whole = self.check_whole.isChecked(),
+                report = True)
+            folder, crs = self.main_folder, self.crs
+            self.queue_job('Plots of ' + self.field_image.name, folder, worker,
+                           lambda output: self.mpe_done(output, stats, folder, crs))
+            # make sure everything is unchecked/back to the original value
+            self.spinbox_nbOfRowPerPlot.setValue(1)
+            self.spinbox_nbOfColumnPerPlot.setValue(1)
+            self.radio_horizontal.setChecked(True)
+            self.radio_vertical.setChecked(False)
+
+    def mpe_done(self, output, stats, folder, crs):
+        """ This function is part of the class 'MainWindow' \n
+        It is connected to the end of the plots identification started in
+        application"""
+        if output in ('1', '2', '3'):
             if output == '1':
                 QMessageBox.about(self, 'Information', 'Sorry, no range has been detected. Please change the input parameters and retry.')
-                self.text_intro_revCal.hide()
-                self.text_pix4D.hide()
-                self.button_pix4D.hide()
-                self.text_rawImgFold.hide()
-                self.button_rawImgFold.hide()
-                self.button_apply_revCal.hide()
-            if output == '2':
+            elif output == '2':
                 QMessageBox.about(self, 'Information', 'Sorry, no row has been detected. Please change the input parameters and retry.')
-                self.text_intro_revCal.hide()
-                self.text_pix4D.hide()
-                self.button_pix4D.hide()
-                self.text_rawImgFold.hide()
-                self.button_rawImgFold.hide()
-                self.button_apply_revCal.hide()
-            elif output == 'OK' :
-                QMessageBox.about(self, 'Information', '''Micro-plot extraction finished!''')
-                # if the original image is georeferenced
-                if type(self.crs) != type(None):
-                    # unlock inputs for reverse calculation
-                    self.text_intro_revCal.show()
-                    self.text_pix4D.show()
-                    self.button_pix4D.show()
-                    self.text_rawImgFold.show()
-                    self.button_rawImgFold.show()
-                    self.button_apply_revCal.show()
-                else :
-                    QMessageBox.about(self, 'Information', 'The original image is not georeferenced. Thus, reverse calculation cannot be performed.')
-                # make sure everything is unchecked/back to the original value
-                self.spinbox_nbOfRowPerPlot.setValue(1)
-                self.spinbox_nbOfColumnPerPlot.setValue(1)
-                self.radio_horizontal.setChecked(True)
-                self.radio_vertical.setChecked(False)
+            else:
+                QMessageBox.about(self, 'Information', 'The plots identification of ' + str(folder) + ' has been cancelled.')
+            self.text_intro_revCal.hide()
+            self.text_pix4D.hide()
+            self.button_pix4D.hide()
+            self.text_rawImgFold.hide()
+            self.button_rawImgFold.hide()
+            self.button_apply_revCal.hide()
+        elif output == 'OK' :
+            # inform the user the program is finished
+            QMessageBox.about(self, 'Information', 'Micro-plot extraction finished! Output: ' + str(folder)
+                              + '\n\n' + timings_text(stats))
+            # if the original image is georeferenced
+            if type(crs) != type(None):
+                # unlock inputs for reverse calculation, made on this folder
+                self.revcal_folder = folder
+                self.text_intro_revCal.show()
+                self.text_pix4D.show()
+                self.button_pix4D.show()
+                self.text_rawImgFold.show()
+                self.button_rawImgFold.show()
+                self.button_apply_revCal.show()
+            else :
+                QMessageBox.about(self, 'Information', 'The original image is not georeferenced. Thus, reverse calculation cannot be performed.')
 
     def button_pix4D_clicked(self):
         self.pix4D = QFileDialog.getExistingDirectory(self, "Select the pix4D project folder")
@@ -577,99 +643,115 @@ class MainWindow(QWidget):
         if self.pix4D is None or self.rawImgFold is None:
             QMessageBox.about(self, 'Error', 'There are missing parameters. Please make sure you provided all the inputs.')
         else :
-
-            revCal_csv = ReverseCalculation(self.main_folder, self.pix4D, self.rawImgFold)
-                        
-            QMessageBox.about(self, 'Information', 'Reverse calculation finished! Output: ' + 
-                              str(revCal_csv))
+            stats = {}
+            worker = Worker(ReverseCalculation, self.revcal_folder, self.pix4D, self.rawImgFold,
+                            stats = stats, report = True)
+            self.queue_job('Reverse calculation of ' + self.revcal_folder.name, self.revcal_folder,
+                           worker, lambda revCal_csv: self.revCal_done(revCal_csv, stats))
             self.pix4D = None
             self.rawImgFold = None
-                        
-###############################################################################
-################################## FUNCTIONS ##################################
-###############################################################################
 
-def get_drawn_image(image, coord, coeff):
-    """ Used in class 'MainWindow' in function 'drawField_clicked' 
-    Make a mask out of inputted coordinates and apply it on the image
-    
-    Inputs : 3
-        image : list of list
-            the field image on which points were drawn
-        coord : list
-            the selected points coordinates
-        coeff : int
-            the coefficient used to resize the image for it to fit the 
-            screen resolution
-                
-    Output : 1
-        masked_image : list of list 
-            cut out image according to the inputted points
+    def revCal_done(self, revCal_csv, stats):
+        """ This function is part of the class 'MainWindow' \n
+        It is connected to the end of the reverse calculation"""
+        if revCal_csv is None:
+            QMessageBox.about(self, 'Information', 'The reverse calculation has been cancelled.')
+        else:
+            QMessageBox.about(self, 'Information', 'Reverse calculation finished! Output: ' + 
+                              str(revCal_csv) + '\n\n' + timings_text(stats))
+
+    ## background jobs
+
+    def queue_job(self, label, folder, worker, on_done):
+        """ This function is part of the class 'MainWindow' \n
+        Add a job (Worker with report = True) to the queue ; the jobs are run
+        one at a time, in the queue order, and on_done gets the result
+        
+        Inputs : 4
+            label : str
+                name of the job, displayed with its progress
+            folder : Path object
+                output folder of the job, not drawn again until the job ended
+            worker : Worker object
+                job to run
+            on_done : function
+                called with the result of the job
         """
-    img = cv2.imread(str(image), -1)
-    # init
-    mask = np.zeros(img.shape, dtype = np.uint8)
-    roi_corners = []
-    # get the right synthax for the array
-    for k in coord:
-        roi_corners.append((int(k[0]/coeff), int(k[1]/coeff)))
-    roi_corners = np.array([roi_corners], dtype = np.int32)
-    # get the region to keep
-    try:
-        channel_count = img.shape[2]  # i.e. 3 or 4 depending on your image
-    except IndexError:
-        channel_count = 1
-    ignore_mask_color = (255,)*channel_count
-    cv2.fillPoly(mask, roi_corners, ignore_mask_color)
-    # apply the mask
-    masked_image = cv2.bitwise_and(img, mask)  
-    return masked_image
-
-def get_binary(img, noise, thresh):
-    """ Make a binarization of a RGB image using the ExGreen index and remove
-    noise as indicated.
-    
-    Inputs : 2
-        img : list of list
-            image to binarize, already read
-        noise : int
-            smaller blobs than this int will be removed
-    
-    Outputs : 2
-        exG : list of list
-            excess green index of the original image
-        binary : list of list
-            binary version of the original image, based on ExG index                
-    """
-    
-    # get binary using Otsu if set threshold value is 0, otherwise use set value
-    if  thresh > 0.999:
-        # get all the channels
-        r, g, b = img[:, :, 0], img[:, :, 1], img[:, :, 2]
-        # calculate the excess green image
-        exG = 2*g - r - b
-        # Floodfill from point (0, 0) aka get black background
-        h, w = exG.shape[:2]
-        mask = np.zeros((h+2, w+2), np.uint8)
-        cv2.floodFill(exG, mask, (0,0), 255)
-        ## apply Otsu threshold
-        blur = cv2.GaussianBlur(exG, (3, 3), 0)
-        threshold, binary = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        # get the negative image (plant in white)
-        binary = 255 - binary
-    else:
-        # get all the channels
-        r, g, b = img[:, :, 0]/255, img[:, :, 1]/255, img[:, :, 2]/255
-        # calculate the excess green image
-        exG = 2*g - r - b
-        threshold, binary = cv2.threshold(exG, thresh, 255, cv2.THRESH_BINARY)
-    
-    # remove noise
-    B = (binary != 0)
-    B = morphology.remove_small_objects(B, min_size = int(noise))
-    binary [B == False] = 0
-    return(exG, binary)
+        worker.done.connect(on_done)
+        worker.failed.connect(lambda message: QMessageBox.about(self, 'Information',
+                              'Sorry, ' + label + ' failed: \n' + message))
+        worker.progress.connect(self.job_progress)
+        # the next job starts once the thread really ended
+        worker.finished.connect(self.job_ended)
+        self.jobs.append((label, folder, worker))
+        if self.job is None:
+            self.start_next_job()
+        else:
+            self.show_job('waiting')
 
+    def start_next_job(self):
+        """ This function is part of the class 'MainWindow' \n
+        Start the first job of the queue, if any"""
+        if not self.jobs:
+            self.text_job.hide()
+            self.progress_job.hide()
+            self.button_cancel.hide()
+            return
+        self.job = self.jobs.pop(0)
+        self.progress_job.setRange(0, 0)
+        self.show_job('starting')
+        self.text_job.show()
+        self.progress_job.show()
+        self.button_cancel.show()
+        self.button_cancel.setEnabled(True)
+        self.job[2].start()
+
+    def show_job(self, stage):
+        """ Display the running job, its stage and the number of waiting jobs"""
+        text = self.job[0] + ': ' + stage
+        if self.jobs:
+            text += ' (' + str(len(self.jobs)) + ' queued)'
+        self.text_job.setText(text)
+
+    def job_progress(self, stage, done, total):
+        """ This function is part of the class 'MainWindow' \n
+        It is connected to the progress of the running job"""
+        self.progress_job.setRange(0, max(total, 1))
+        self.progress_job.setValue(done)
+        self.show_job(stage)
+
+    def job_ended(self):
+        """ This function is part of the class 'MainWindow' \n
+        It is connected to the end of the thread of the running job"""
+        self.job = None
+        self.start_next_job()
+
+    def cancel_clicked(self):
+        """ This function is part of the class 'MainWindow' \n
+        It is connected to the button button_cancel and stops the running job
+        (the queued jobs are still run)"""
+        if self.job is not None:
+            self.job[2].cancel()
+            self.button_cancel.setEnabled(False)
+            self.show_job('cancelling')
+
+    def busy_folders(self):
+        """ Output folders of the running and queued jobs"""
+        return [folder for _, folder, _ in self.jobs + ([self.job] if self.job else [])]
+
+    def closeEvent(self, event):
+        """ Drop the queued jobs and stop the running one before closing"""
+        self.jobs = []
+        if self.job is not None:
+            self.job[2].cancel()
+            self.job[2].wait()
+        super(MainWindow, self).closeEvent(event)
+
+def timings_text(stats):
+    """ Time of every stage of a job, to be displayed"""
+    return 'Time of the stages: \n' + '\n'.join(stage + ': ' + str(round(t, 1)) + ' s'
+                                                for stage, t in stats.get('timings', {}).items())
+                        
 ###############################################################################
 ##################################### MAIN ####################################
 ###############################################################################
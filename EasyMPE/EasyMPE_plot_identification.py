@@ -7,17 +7,26 @@ Annex code to MPE_main.py
 """
 ### ENVIRONMENT
 import numpy as np
-import cv2, os, math
-from skimage.morphology import extrema
-from skimage import  morphology
-import shapefile, fiona
+import cv2, os, math, threading, multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from EasyMPE_vector_export import PlotWriter
+from EasyMPE_geometry import get_equations, line_pairs, band_corners, plot_corners
+from EasyMPE_cache import stage_key, run_stage
+from EasyMPE_progress import Progress
+
+# decimation along the x axis of the straight binary image in the columns
+# detection (see column_profile)
+COLUMN_STEP = 4
     
 def MPE(img, folder, original_img, YN_binary, nbOfRowPerPlot, 
         nbOfColumnPerPlot, globalOrientation, noise, field_image, aff, 
-        y_offset, x_offset):
+        y_offset, x_offset, stats = None, save_columns = True, workers = None,
+        pool_type = 'thread', crs = None, vector_format = 'GPKG', legacy_shp = False,
+        plot_shp = False, cache = None, binary_key = None, progress = None, cancel = None,
+        save_whole = False):
     ''' Identifies and crop the columns and the rows of the field.
     
-    12 inputs:
+    25 inputs:
         img: array of lists
             Binary image of the original image read in openCV
         folder: path
@@ -46,10 +55,45 @@ def MPE(img, folder, original_img, YN_binary, nbOfRowPerPlot,
         x_offset: int
             The horizontal distance that has been cropped and should be considered
             for the coordinates calculation
+        stats: dict or None
+            If given, filled with the estimated angle ('angle'), its
+            confidence ('angle_confidence', see estimate_angle) and the time
+            (s) of every stage ('timings')
+        save_columns: bolean
+            If True, the column images are also saved in the folders
+            Plot_columns_original, _binary and _core (in a background thread)
+        workers: int or None
+            Number of columns processed at the same time (all the cores if None)
+        pool_type: str ('thread' or 'process')
+            Type of pool used to process the columns
+        crs: CRS object or None
+            CRS of the original image, saved with the plots polygons
+        vector_format: str ('GPKG' or 'FlatGeobuf')
+            Format of the file containing all the plots polygons
+        legacy_shp: bolean
+            If True, the plots are also saved in All_plots.shp
+        plot_shp: bolean
+            If True, one *.shp per plot is also saved in the folder SHP_files
+        cache: StageCache object or None
+            If given, the angle, the columns, the rows of every column and the
+            plots grid are read from this cache when their inputs did not
+            change, and saved in it otherwise (see EasyMPE_cache.py)
+        binary_key: str or None
+            Key of the binary image in the cache, the image is hashed if None
+        progress: function or None
+            Called as progress(stage, done, total) after the angle, the
+            columns, every column of rows, every plot and the metadata
+        cancel: threading.Event or None
+            The run stops at the next column or plot once it is set
+        save_whole: bolean
+            If True, every plot is also saved on a black image of the size of
+            the whole field (Plot_rows_original_whole) and the binary plots
+            are saved at this size too ; otherwise the binary plots are cut
+            as the plots of Plot_rows_original
         
     Outputs: none
     Returns number if there is an error which will trigger a pop up displaying
-    a message.
+    a message ('3' if the run has been cancelled).
     Returns 'OK' if the end has been reached.
     
     '''
@@ -59,155 +103,73 @@ def MPE(img, folder, original_img, YN_binary, nbOfRowPerPlot,
     #######################################################################
     
 
-    # get all coordinates of the white pixels i.e. plants
-    coords_angle = np.column_stack(np.where(img > 0))
-    # use these coordinates to compute a rotated bounding box that contains all
-    # coordinates
-    angle = cv2.minAreaRect(coords_angle)[-1]
-    # the 'cv2.minAreaRect' function returns values in the
-    # range [-90, 0[ ; we want it positive
-    if angle < -45:
-    	angle = -(90 + angle)     
-    # otherwise, just take the inverse of the angle to make
-    # it positive
-    else:
-    	angle = -angle
-    # if the rows are orginally horizontal, we want them to become vertical
-    if globalOrientation == 'H':
-        angle += 90
+    tracker = Progress(progress, cancel, stats)
+    # keys of the stages, every key depends on the ones before it
+    if cache is not None and binary_key is None:
+        binary_key = cache.key('binary_image', img)
+    angle_key = stage_key(cache, 'angle', binary_key, globalOrientation)
+    columns_key = stage_key(cache, 'columns', angle_key, COLUMN_STEP)
 
-    print('ANGLE: ' + str(angle))
-    
-    img_binary = img.copy()
-    img_rotated, add_y, add_x = rotate_bound(img.astype(np.uint8), angle, change_bigger = True)
-    cv2.imwrite(str(folder / 'Binary_straight.jpg'), img_rotated)
+    # estimate the orientation of the columns on a decimated binary ; the
+    # angle is the one needed to get the columns in a vertical state
+    angle_stage = run_stage(cache, angle_key, lambda: dict(zip(('angle', 'confidence'),
+                                                 estimate_angle(img, globalOrientation))))
+    angle, angle_confidence = float(angle_stage['angle']), float(angle_stage['confidence'])
+    if stats is not None:
+        stats['angle'] = angle
+        stats['angle_confidence'] = angle_confidence
 
-    # make a skeleton of the binary image so that clusters will be in the
-    # middle of the rows, then erode and dilate to erase weeds and connect
-    # broken lines
-    # parameters (horizontal array)
-    param_binaryErosion = np.ones((1, 20))
-    param_skeletonErosion = np.ones((1, 5))
-    param_skeletonDil = np.ones((1, 100))
-    # application
-    binary_erode = morphology.binary_erosion(img_rotated, selem = param_binaryErosion)
-    skeleton = morphology.skeletonize((binary_erode*1).astype(np.uint8))*255
-    cv2.imwrite(str(folder / 'Skeleton_original.jpg'), skeleton)
-    skeleton = morphology.binary_erosion(skeleton, selem = param_skeletonErosion)
-    skeleton = morphology.binary_dilation(skeleton, selem = param_skeletonDil)*255
-    cv2.imwrite(str(folder / 'Skeleton_manipulated.jpg'), skeleton)
-   
-    
-    #######################################################################
-    ########################### GET THE COLUMNS ###########################
-    #######################################################################
-    
-    # get local maxima on the whole binary picture
-    local_maxima = extrema.local_maxima(skeleton)
-    # sum the number of local maxima into a one-line array (i.e. number of
-    # maxima in each column)
-    sum_maxima = np.sum(local_maxima, axis = 0).astype(float)
-    # make a copy
-    sum_maxima_nan = sum_maxima.copy()
-    # replace 0 with NaN
-    sum_maxima_nan[sum_maxima == 0] = np.nan
-    # get the average number of maxmima for a column
-    mean_line = np.nanmean(sum_maxima_nan)
-    # erase all the values smaller than 1/3 of the average
-    sum_maxima[sum_maxima < mean_line/3] = 0
-    # draw the columns and save the corner points of each column area
-    img, cut_points, col_w, img_core_col = draw_separation_lines(sum_maxima, 
-                                                             rows_img = img_rotated,
-                                                             col = True) 
+    print('ANGLE: ' + str(angle) + ' (confidence: ' + str(round(angle_confidence, 2)) + ')')
+    tracker.report('angle', 1, 1)
+    if tracker.end('angle'):
+        return ('3')
     
+    img_binary = img.copy()
+    columns = run_stage(cache, columns_key, lambda: detect_columns(img, angle, folder), folder,
+                        ['Binary_straight.jpg', 'Skeleton_original.jpg', 'Skeleton_manipulated.jpg',
+                         'Binary_columns_straight.jpg', 'Binary_core_columns.jpg', 'Binary_core.jpg'])
     # if no points have been detected, it means the code is not working as it is
-    if cut_points == []:
+    if len(columns['columns_a']) == 0:
         return ('1')
+    columns_a, columns_b, img_core_col = columns['columns_a'], columns['columns_b'], columns['img_core_col']
+    tracker.report('columns', 1, 1)
+    if tracker.end('columns'):
+        return ('3')
     
-    # save the image with the columns delimited
-    cv2.imwrite(str(folder / 'Binary_columns_straight.jpg'), img)
-    cv2.imwrite(str(folder / 'Binary_core_columns.jpg'), img_core_col)
-
-    
-    ## rotate the points of the separation lines and get the lines equations 
-    center = (img_binary.shape[0]/2, img_binary.shape[1]/2)
-    cut_points = np.array(cut_points)
-    # subtraction of the black pixels which had been added for the rotation
-    cut_points[:, :, 0] = cut_points[:, :, 0] - add_x
-    cut_points[:, :, 1] = cut_points[:, :, 1] - add_y
-    # rotate the points back into the original angle
-    cut_points = rotate(center, cut_points, math.radians(angle))
-    # get the line equations from points
-    columns_a, columns_b = get_equations(cut_points)
-    # rotate back the core column image
-    img_core_col, _, _ = rotate_bound(img_core_col, -1*angle)
-    y = int((img_core_col.shape[0] - img_binary.shape[0])/2)
-    x = int((img_core_col.shape[1] - img_binary.shape[1])/2)
-    img_core_col = img_core_col[y:-y, x:-x]
-    img_core_col = cv2.resize(img_core_col, img_binary.shape[::-1]) 
-    cv2.imwrite(str(folder / 'Binary_core.jpg'), img_core_col)
-    
-    ## cut the columns
-    # create all the needed directories / check if existent / delete if necessary
-    if YN_binary == False:
-        sub_folder_columnOriginal = folder / str('Plot_columns_original')
-    sub_folder_columnBinary = folder / str('Plot_columns_binary')
-    sub_folder_columnCoreBinary = folder / str('Plot_columns_core')
-    if not(sub_folder_columnBinary.is_dir()):
+    ## get the columns
+    # the column images are kept in memory for the rows identification, the
+    # columns folders are only an export made in the background if asked
+    if save_columns:
         if YN_binary == False:
-            sub_folder_columnOriginal.mkdir()
-        sub_folder_columnBinary.mkdir()
-        sub_folder_columnCoreBinary.mkdir()
+            sub_folder_columnOriginal = folder / str('Plot_columns_original')
+        sub_folder_columnBinary = folder / str('Plot_columns_binary')
+        sub_folder_columnCoreBinary = folder / str('Plot_columns_core')
+        if not(sub_folder_columnBinary.is_dir()):
+            if YN_binary == False:
+                sub_folder_columnOriginal.mkdir()
+            sub_folder_columnBinary.mkdir()
+            sub_folder_columnCoreBinary.mkdir()
+        exporter = ThreadPoolExecutor(max_workers = workers or os.cpu_count() or 1)
     # initialization
     maxY, maxX = img_binary.shape
-    c = str(0).zfill(2) # only exists for saving names
     # for every detected column, with a step defined by the inputted number
-    # nbOfColumnPerPlot in the GUI
-    for k in range(0, len(columns_a), nbOfColumnPerPlot):
-        # try first as it is (i.e. with that step value)
-        try:
-            n = nbOfColumnPerPlot - 1 #bc we want the end line
-            pt1 = ((0 - columns_b[k][0])/columns_a[k][0], 0)
-            pt2 = ((0 - columns_b[k + n][1])/columns_a[k + n][1], 0) #could have done [k+n+1][0] -> equivalent
-            pt3 = ((maxY - columns_b[k + n][1])/columns_a[k + n][1], maxY)
-            pt4 = ((maxY - columns_b[k][0])/columns_a[k][0], maxY)
-            # all 4 points of one column, counter clock wise
-            roi_corners = np.array([[pt1, pt2, pt3, pt4]], dtype = np.int32)
-            # make a mask and crop out the current column
-            mask = np.zeros(img_binary.shape, dtype = np.uint8)
-            cv2.fillPoly(mask, roi_corners, (255,))
-            if YN_binary == False:
-                column_original = cv2.bitwise_and(original_img, original_img, mask = mask)
-                cv2.imwrite(str(sub_folder_columnOriginal / str('Plot_column_' + c + '_cropped.jpg')), column_original)
-            # apply the mask and save the images
-            column_binary = cv2.bitwise_and(img_binary, img_binary, mask = mask)   
-            cv2.imwrite(str(sub_folder_columnBinary / str('Plot_column_'+ c +'_cropped.jpg')), column_binary)
-            column_core = cv2.bitwise_and(img_core_col, img_core_col, mask = mask)
-            cv2.imwrite(str(sub_folder_columnCoreBinary / str('Plot_column_' + c + '_cropped.jpg')), column_core)
-            c = str(int(c) + 1).zfill(2)
-        # if the number inputed is not proportional to the detected number of columns
-        # then do one by one for what is left
-        except IndexError: 
-            # same as before but one detected column at a time
-            for i in range(k, len(columns_a)):
-                pt1 = ((0 - columns_b[i][0])/columns_a[i][0], 0)
-                pt2 = ((0 - columns_b[i][1])/columns_a[i][1], 0)
-                pt3 = ((maxY - columns_b[i][1])/columns_a[i][1], maxY)
-                pt4 = ((maxY - columns_b[i][0])/columns_a[i][0], maxY)
-                # 4 column points, counter clockwise
-                roi_corners = np.array([[pt1, pt2, pt3, pt4]], dtype = np.int32)
-                # mask making
-                mask = np.zeros(img_binary.shape, dtype = np.uint8)
-                cv2.fillPoly(mask, roi_corners, (255,))
-                if YN_binary == False:
-                    column_original = cv2.bitwise_and(original_img, original_img, mask = mask)
-                    cv2.imwrite(str(sub_folder_columnOriginal / str('Plot_column_' + str(c) + '_cropped.jpg')), column_original)
-                # applying mask and saving images
-                column_binary = cv2.bitwise_and(img_binary, mask)   
-                cv2.imwrite(str(sub_folder_columnBinary / str('Plot_column_'+ str(c) +'_cropped.jpg')), column_binary)
-                column_core = cv2.bitwise_and(img_core_col, img_core_col, mask = mask)
-                cv2.imwrite(str(sub_folder_columnCoreBinary / str('Plot_column_' + c + '_cropped.jpg')), column_core)
-                c = str(int(c) + 1).zfill(2)
+    # nbOfColumnPerPlot in the GUI ; all 4 points of one column, counter 
+    # clock wise
+    columns_pairs = line_pairs(len(columns_a), nbOfColumnPerPlot)
+    columns_corners = band_corners(columns_a, columns_b, columns_pairs, maxY)
+    
+    def export_column(nb):
+        """ Crop one column and save it in the columns folders"""
+        c = str(nb).zfill(2)
+        column_original, column_binary, column_core = crop_column(columns_corners[nb][None], 
+                            None if YN_binary else original_img, img_binary, img_core_col)
+        if YN_binary == False:
+            cv2.imwrite(str(sub_folder_columnOriginal / str('Plot_column_' + c + '_cropped.jpg')), column_original)
+        cv2.imwrite(str(sub_folder_columnBinary / str('Plot_column_'+ c +'_cropped.jpg')), column_binary)
+        cv2.imwrite(str(sub_folder_columnCoreBinary / str('Plot_column_' + c + '_cropped.jpg')), column_core)
+    if save_columns:
+        for nb in range(len(columns_corners)):
+            exporter.submit(export_column, nb)
         
     #######################################################################
     ############################# GET THE ROWS ############################
@@ -218,8 +180,6 @@ def MPE(img, folder, original_img, YN_binary, nbOfRowPerPlot,
     angle_horiz = angle + 90
     print('Horizontal angle : ' + str(angle_horiz))
     
-    # get all the files from the previous part, i.e. *binary* columns
-    files = list(sub_folder_columnCoreBinary.glob('*.jpg'))
     # make all the necessary folders etc
     sub_folder_horizontalColumn = folder / 'Horizontal_columns'
     if YN_binary == False:
@@ -228,207 +188,608 @@ def MPE(img, folder, original_img, YN_binary, nbOfRowPerPlot,
     else:
         sub_folder_rowOriginalWhole = folder / str('Plot_rows_binary_whole')
     sub_folder_rowBinary = folder / str('Plot_rows_binary')
-    sub_folder_SHP = folder / str('SHP_files')
+    sub_folder_SHP = folder / str('SHP_files') if plot_shp else None
     if not(sub_folder_horizontalColumn.is_dir()):
         sub_folder_horizontalColumn.mkdir()
         if YN_binary == False:
             sub_folder_rowOriginal.mkdir()
-            sub_folder_rowOriginalWhole.mkdir()
         sub_folder_rowBinary.mkdir()
+    if save_whole and YN_binary == False and not(sub_folder_rowOriginalWhole.is_dir()):
+        sub_folder_rowOriginalWhole.mkdir()
+    if plot_shp and not(sub_folder_SHP.is_dir()):
         sub_folder_SHP.mkdir()
     
-    # initialization
-    maxY, maxX = img.shape
+    # initialization (height of the rotated field image)
+    maxY = int(columns['rotated_height'])
     nbOfRowPerColumn = 0
-    intersection, intersection_geo = [], []
     nbOfColumn = len(columns_a)
-    # for every file in the column file
-    for nb in range(0, len(files)):
-        # get the column number
-        nb_column = str(nb).zfill(2)
-        ## identify the rows
-        # read the column file
-        file_img = cv2.imread(str(files[nb]), 0)
-        # rotate it until the column is horizontally oriented
-        column_binary_rotate, add_y, add_x = rotate_bound(file_img, angle_horiz, change_bigger = True)
-        # make the sum of all white pixels on one line
-        sum_rows = np.sum(column_binary_rotate, axis = 0).astype(float)
-        # make a copy and replace 0 by nan to get the mean value of the sum without 0
-        sum_rows_nan = sum_rows.copy()
-        sum_rows_nan[sum_rows == 0] = np.nan
-        mean_line = np.nanmean(sum_rows_nan)
-        # erase the values smaller than half of the mean
-        sum_rows[sum_rows < mean_line/2] = 0
-        # identify the rows with the changing pattern
-        _, cut_points, w = draw_separation_lines(np.array(sum_rows), 
-                                                 rows_img = column_binary_rotate)
-
+    # every column is processed independently, the results are merged in
+    # the column order
+    args = (folder, columns_corners, None if YN_binary else original_img, img_binary,
+            img_core_col, angle_horiz, maxY, nbOfRowPerPlot, YN_binary, cache, columns_key,
+            save_whole)
+    plots, plots_row_a, plots_row_b = [], [], []
+    for nb, rows in enumerate(run_columns(len(columns_corners), args, workers, pool_type, tracker)):
         # if not separation lines has been detected, the code is not working
         # as it is
-        if cut_points == []:
-        # save the output image with separation lines for rows
+        if rows is None:
+            if save_columns:
+                exporter.shutdown()
             return('2')
-        cv2.imwrite(str(sub_folder_horizontalColumn / str('Rows_horizontal_delimited_column_' + str(nb_column) + '.jpg')), column_binary_rotate)
-        
-        ## get the points in the original angle
-        # original center
-        center = (img_binary.shape[0]/2, img_binary.shape[1]/2)
-        cut_points = np.array(cut_points)
-        # points without the added black border (in rotate_bound)
-        cut_points[:, :, 0] = cut_points[:, :, 0] - add_x
-        cut_points[:, :, 1] = cut_points[:, :, 1] - add_y
-        # rotate the points
-        cut_points = rotate(center, cut_points, math.radians(angle_horiz))
-        # get equations based on the points
-        rows_a, rows_b = get_equations(cut_points)
-                
-        # initialization of various counts
-        c = str(0).zfill(2) # for file names
-        nbStartColumn = nb # start detected column number
-        nbEndColumn = int(nbStartColumn) + nbOfColumnPerPlot - 1 # end detected column
-        print('Column nb: ' + str(nb_column))
-
-        ### cut the rows
-        # read the original column image
-        current_column_binary = cv2.imread(str(sub_folder_columnBinary / files[nb].name), 0)
-        if YN_binary == False:
-            current_column_original = cv2.imread(str(sub_folder_columnOriginal / files[nb].name))
-        else:
-            current_column_original = cv2.imread(str(sub_folder_columnBinary / files[nb].name), 0)
-            
+        rows_a, rows_b, rows_pairs = rows
         # get the number of rows in this column
         nbOfRowPerColumn += len(rows_a)
-        
-        # for every row in that column, with a step defined by the inputted
-        # number nbOfRowPerPlot in the GUI
-        for k in range(0, len(rows_a), nbOfRowPerPlot):
-            # try with this step first
-            try:
-                ### get the cut points of the row
-                n = nbOfRowPerPlot - 1 # bc we want the end line of the end row
-                pt1 = ((0 - rows_b[k][0])/rows_a[k][0], 0)
-                pt2 = ((0 - rows_b[k + n][1])/rows_a[k + n][1], 0) #[k+n+1][0] would NOT be equivalent
-                pt3 = ((maxY - rows_b[k + n][1])/rows_a[k + n][1], maxY)
-                pt4 = ((maxY - rows_b[k][0])/rows_a[k][0], maxY)
-                # get all the points counter-clockwise
-                roi_corners = np.array([[pt1, pt2, pt3, pt4]], dtype = np.int32)
-                # fill a mask
-                mask = np.zeros(file_img.shape, dtype = np.uint8)
-                cv2.fillPoly(mask, roi_corners, (255,))
-                # apply the mask to the column images (binary)
-                row_binary = cv2.bitwise_and(current_column_binary, mask)  
-                cv2.imwrite(str(sub_folder_rowBinary / str('Plot_column_' + str(nb_column) + '_row_'+ str(c) + '_cropped.jpg')), row_binary)
-                # use a bounding box to only get the wanted part of the original
-                # image i.e. the row and not all the black pixels around
-                row_original = cv2.bitwise_and(current_column_original, current_column_original, mask = mask)
-                if YN_binary == False:
-                    # get the coords for which pixel value =/= 0
-                    coords = np.argwhere(row_original)
-                    # get the first pixels
-                    x0, y0, z = coords.min(axis = 0)
-                    # get the last pixels
-                    x1, y1, z = coords.max(axis = 0) + 1
-                    # crop
-                    row_original_cropped = row_original[x0:x1, y0:y1]
-                    # save
-                    cv2.imwrite(str(sub_folder_rowOriginal / str('Plot_column_' + str(nb_column) + '_row_' + str(c) + '_cropped.jpg')), row_original_cropped)
-                    cv2.imwrite(str(sub_folder_rowOriginalWhole / str('Plot_column_' + str(nb_column) + '_row_' + str(c) + '_whole_pic.jpg')), row_original)
-                # get the intersection of the lines between the considered
-                # column and row (i.e. the 4 cropping points)
-                inter, inter_geo = line_intersection(columns_a[nbStartColumn], columns_a[nbEndColumn],
-                        columns_b[nbStartColumn], columns_b[nbEndColumn], rows_a[k], rows_a[k + n],
-                        rows_b[k], rows_b[k + n], aff, y_offset, x_offset)
-                # if the georeferenced points exist
-                if type(inter_geo) != type(None):
-                    # make the shp files out of the 4 corner points
-                    make_shp(sub_folder_SHP, nb_column, c, inter_geo)
-                    # prepare the array to be saved
-                    inter_geo = [item for sublist in inter_geo for item in sublist]
-                    inter_geo.insert(0, c)
-                    inter_geo.insert(0, nb_column)
-                    intersection_geo.append(inter_geo)
-                # if not georeference, use pixel values
-                else :
-                    # make the shp files out of the 4 corner point
-                    make_shp(sub_folder_SHP, nb_column, c, inter)
-                # get the points in a 8-elements list (no more tuples)
-                inter = [item for sublist in inter for item in sublist]
-                # insert row number at the begining
-                inter.insert(0, c)
-                # insert column number at the beginning
-                inter.insert(0, nb_column)
-                # "save" the list into "intersection" list
-                intersection.append(inter)
-                # add up 1 element for the next row
-                c = str(int(c) + 1).zfill(2)
-            # if the number inputed is not proportional to the detected
-            # number of columns, then do one by one for what is left
-            except IndexError: 
-                for i in range(k, len(rows_a)):
-                    pt1 = ((0 - rows_b[i][0])/rows_a[i][0], 0)
-                    pt2 = ((0 - rows_b[i][1])/rows_a[i][1], 0)
-                    pt3 = ((maxY - rows_b[i][1])/rows_a[i][1], maxY)
-                    pt4 = ((maxY - rows_b[i][0])/rows_a[i][0], maxY)
-                    roi_corners = np.array([[pt1, pt2, pt3, pt4]], dtype = np.int32)
-                    mask = np.zeros(img_binary.shape, dtype = np.uint8)
-                    cv2.fillPoly(mask, roi_corners, (255,))
-                    row_binary = cv2.bitwise_and(current_column_binary, current_column_binary, mask = mask)   
-                    cv2.imwrite(str(sub_folder_rowBinary / str('Plot_column_' + str(nb_column) + '_row_' + str(c) +'_cropped.jpg')), row_binary)
-                    row_original = cv2.bitwise_and(current_column_original, current_column_original, mask = mask)
-                    if YN_binary == False:
-                        coords = np.argwhere(row_original)
-                        x0, y0, z = coords.min(axis = 0)
-                        x1, y1, z = coords.max(axis = 0) + 1   # slices are exclusive at the top
-                        row_original_cropped = row_original[x0:x1, y0:y1]
-                        cv2.imwrite(str(sub_folder_rowOriginal / str('Plot_column_' + str(nb_column) + '_row_' + str(c) + '_cropped.jpg')), row_original_cropped)
-                        cv2.imwrite(str(sub_folder_rowOriginalWhole / str('Plot_column_' + str(nb_column) + '_row_' + str(c) + '_whole_pic.jpg')), row_original)
-                    # get the intersection between column and row considered
-                    inter, inter_geo = line_intersection(columns_a[nbStartColumn], columns_a[nbEndColumn], 
-                                    columns_b[nbStartColumn], columns_b[nbEndColumn], rows_a[i], rows_a[i],
-                                    rows_b[i], rows_b[i], aff, y_offset, x_offset)
-                    if type(inter_geo) != type(None):
-                        # make the shp files out of the 4 corner points
-                        make_shp(sub_folder_SHP, nb_column, c, inter_geo)
-                        # prepare the array to be saved
-                        inter_geo = [item for sublist in inter_geo for item in sublist]
-                        inter_geo.insert(0, c)
-                        inter_geo.insert(0, nb_column)
-                        intersection_geo.append(inter_geo)
-                    # if not georeference, use pixel values
-                    else :
-                        # make the shp files out of the 4 corner point
-                        make_shp(sub_folder_SHP, nb_column, c, inter)
-                    inter = [item for sublist in inter for item in sublist]
-                    inter.insert(0, c)
-                    inter.insert(0, nb_column)
-                    intersection.append(inter)
-                    c = str(int(c) + 1).zfill(2)
-                    
-    ### make a shp file with all individual shp merged
-    # get all the shp absolute paths
-    individual_shp_files = os.listdir(sub_folder_SHP)
-    individual_shp_files = [str(sub_folder_SHP / f) for f in individual_shp_files if '.shp' in f]
-    # make a shp file with the meta of the individual shp
-    meta = fiona.open(individual_shp_files[0]).meta
-    # write all the individual shp into the merging file
-    with fiona.open(folder / 'All_plots.shp', 'w', **meta) as output:
-        for k in individual_shp_files:
-            with fiona.open(k) as f:
-                for features in f:
-                    output.write(features)               
+        # column number, row number, start and end rows of every plot
+        plots.append(np.column_stack((np.full(len(rows_pairs), nb), np.arange(len(rows_pairs)))))
+        plots_row_a.append(rows_a[rows_pairs])
+        plots_row_b.append(rows_b[rows_pairs])
+    if tracker.end('rows'):
+        if save_columns:
+            exporter.shutdown(cancel_futures = True)
+        return ('3')
+    plots = np.concatenate(plots)
+    plots_row_a, plots_row_b = np.concatenate(plots_row_a), np.concatenate(plots_row_b)
     
+    ## get the intersection of the lines between the column and row of every
+    ## plot (i.e. the 4 cropping points), all at once
+    # start and end detected columns of every plot
+    start_col = plots[:, 0]
+    end_col = start_col + nbOfColumnPerPlot - 1
+    columns_a, columns_b = np.asarray(columns_a), np.asarray(columns_b)
+    def compute_grid():
+        points, points_geo, valid = plot_corners(columns_a[start_col], columns_a[end_col],
+                        columns_b[start_col], columns_b[end_col], plots_row_a[:, 0], plots_row_a[:, 1],
+                        plots_row_b[:, 0], plots_row_b[:, 1], aff, y_offset, x_offset)
+        if points_geo is None:
+            points_geo = np.empty((0,))
+        return {'points': points, 'points_geo': points_geo, 'valid': valid}
+    # the rows only depend on the columns and on their corners
+    grid_key = stage_key(cache, 'plots', columns_key, columns_corners, nbOfRowPerPlot,
+                         aff, y_offset, x_offset)
+    grid = run_stage(cache, grid_key, compute_grid)
+    points, valid = grid['points'], grid['valid']
+    points_geo = grid['points_geo'] if grid['points_geo'].size else None
+    if not valid.all():
+        print(str(int(np.sum(~valid))) + ' plot(s) ignored : parallel column and row lines.')
+    plots, points = plots[valid], points[valid]
+    # column and row numbers (as in the file names) of every plot
+    names = np.char.zfill(plots.astype(str), 2)
+    # the polygons are made out of the 4 corner points, georeferenced if
+    # possible ; the points saved as polygons are also saved closed in the
+    # csv files
+    if points_geo is not None:
+        points_geo = points_geo[valid]
+        saved, saved_geo = points, np.concatenate((points_geo, points_geo[:, :1]), axis = 1)
+        polygons = saved_geo
+    else:
+        saved, saved_geo = np.concatenate((points, points[:, :1]), axis = 1), None
+        polygons = saved
+    # write all the plots in one pass
+    with PlotWriter(folder, vector_format, crs if points_geo is not None else None,
+                    legacy_shp, sub_folder_SHP) as writer:
+        for k, polygon in enumerate(polygons.tolist()):
+            writer.write(names[k, 0], names[k, 1], [tuple(pt) for pt in polygon])
+            tracker.report('plots', k + 1, len(polygons))
+            if tracker.cancelled():
+                break
+    if tracker.end('plots'):
+        if save_columns:
+            exporter.shutdown(cancel_futures = True)
+        return ('3')
+    # [[Column_nb, Row_nb, pt1_x, pt1_y, ...]] for the csv files
+    intersection = np.column_stack((names, saved.reshape(len(saved), -1).astype(str)))
+    intersection_geo = []
+    if saved_geo is not None:
+        intersection_geo = np.column_stack((names, saved_geo.reshape(len(saved_geo), -1).astype(str)))
+                    
     # get the average number of row per column
     nbOfRowPerColumn = nbOfRowPerColumn/nbOfColumn
     # save the metadata
     metadata(folder, field_image, noise, nbOfColumnPerPlot, 
              nbOfRowPerPlot, globalOrientation, sub_folder_rowBinary, sub_folder_SHP, angle, 
-             nbOfColumn, nbOfRowPerColumn, intersection, aff, intersection_geo)
+             nbOfColumn, nbOfRowPerColumn, intersection, aff, intersection_geo,
+             angle_confidence, writer.path, legacy_shp)
+    tracker.report('metadata', 1, 1)
+    # wait for the columns export
+    if save_columns:
+        exporter.shutdown()
+    tracker.end('metadata')
     return ('OK')
 
 ###############################################################################
 ################################### ANNEXES ###################################
 ###############################################################################
     
+def detect_columns(img, angle, folder):
+    """ Used in MPE
+    Find the columns of the binary image of the field and save the images of
+    each step in 'folder'
+    
+    Inputs : 3
+        img : list of list
+            binary image of the field
+        angle : float
+            angle needed to get the columns in a vertical state
+        folder : Path object
+            absolute path to the folder in which all is saved
+    
+    Output : 1
+        columns : dict
+            equations of the columns limits ('columns_a', 'columns_b', see
+            get_equations, empty if no column has been detected), image of
+            the core of the columns ('img_core_col') and height of the
+            rotated image ('rotated_height')
+    """
+    img_rotated, add_y, add_x = rotate_bound(img.astype(np.uint8), angle, change_bigger = True)
+    cv2.imwrite(str(folder / 'Binary_straight.jpg'), img_rotated)
+
+    # number of plant rows crossing every column of pixels (see
+    # column_profile)
+    sum_maxima = column_profile(img_rotated, folder)
+    # make a copy
+    sum_maxima_nan = sum_maxima.copy()
+    # replace 0 with NaN
+    sum_maxima_nan[sum_maxima == 0] = np.nan
+    # get the average number of maxmima for a column
+    mean_line = np.nanmean(sum_maxima_nan)
+    # erase all the values smaller than 1/3 of the average
+    sum_maxima[sum_maxima < mean_line/3] = 0
+    # draw the columns and save the corner points of each column area
+    img_lines, cut_points, col_w, img_core_col = draw_separation_lines(sum_maxima, 
+                                                             rows_img = img_rotated,
+                                                             col = True) 
+    
+    # if no points have been detected, it means the code is not working as it is
+    if len(cut_points) == 0:
+        return {'columns_a': np.empty((0, 2)), 'columns_b': np.empty((0, 2)),
+                'img_core_col': np.empty((0, 0), dtype = np.uint8),
+                'rotated_height': img_lines.shape[0]}
+    
+    # save the image with the columns delimited
+    cv2.imwrite(str(folder / 'Binary_columns_straight.jpg'), img_lines)
+    cv2.imwrite(str(folder / 'Binary_core_columns.jpg'), img_core_col)
+
+    ## rotate the points of the separation lines and get the lines equations 
+    center = (img.shape[0]/2, img.shape[1]/2)
+    cut_points = np.array(cut_points)
+    # subtraction of the black pixels which had been added for the rotation
+    cut_points[:, :, 0] = cut_points[:, :, 0] - add_x
+    cut_points[:, :, 1] = cut_points[:, :, 1] - add_y
+    # rotate the points back into the original angle
+    cut_points = rotate(center, cut_points, math.radians(angle))
+    # get the line equations from points
+    columns_a, columns_b = get_equations(cut_points)
+    # rotate back the core column image
+    img_core_col, _, _ = rotate_bound(img_core_col, -1*angle)
+    y = int((img_core_col.shape[0] - img.shape[0])/2)
+    x = int((img_core_col.shape[1] - img.shape[1])/2)
+    img_core_col = img_core_col[y:-y, x:-x]
+    img_core_col = cv2.resize(img_core_col, img.shape[::-1]) 
+    cv2.imwrite(str(folder / 'Binary_core.jpg'), img_core_col)
+    return {'columns_a': columns_a, 'columns_b': columns_b, 'img_core_col': img_core_col,
+            'rotated_height': img_lines.shape[0]}
+
+def column_profile(img, folder = None, step = COLUMN_STEP):
+    """ Used in detect_columns
+    Number of plant rows crossing every column of pixels of the straight
+    binary image. \n
+    It gives the profile that the skeleton of the plant rows gave before
+    (erosion 1x20, skeletonize, erosion 1x5, dilation 1x100, local maxima)
+    without any skeleton : once the parts narrower than 20 px are erased,
+    every plant row is one run of pixels along the y axis, so its skeleton is
+    one pixel per column, found as the first pixel of the run. The erosion
+    1x5 of these pixels is made at full resolution with OpenCV, then the
+    image is decimated along the x axis only (the plant rows are counted at
+    full resolution) and the dilation 1x100 is made on the decimated image.
+    
+    Inputs : 3
+        img : array
+            straight binary image (columns in a vertical state)
+        folder : Path object or None
+            if given, the plant rows and the connected lines are saved in
+            Skeleton_original.jpg and Skeleton_manipulated.jpg
+        step : int
+            decimation along the x axis
+    
+    Output : 1
+        sum_maxima : array of float
+            number of plant rows in every column of pixels of img
+    """
+    binary = (img != 0).astype(np.uint8)
+    # erase weeds and gaps
+    binary = cv2.erode(binary, np.ones((1, 20), np.uint8))
+    # first pixel of every plant row
+    lines = binary.copy()
+    lines[1:] &= 1 - binary[:-1]
+    del binary
+    if folder is not None:
+        cv2.imwrite(str(folder / 'Skeleton_original.jpg'), lines*255)
+    # erase the small lines, then keep one pixel out of 'step' along x (the
+    # middle one, so that the profile is not shifted)
+    lines = cv2.erode(lines, np.ones((1, 5), np.uint8))
+    lines = np.ascontiguousarray(lines[:, step//2::step])
+    # connect the broken lines (size in full resolution pixels)
+    lines = cv2.dilate(lines, np.ones((1, max(1, round(100/step)) | 1), np.uint8))
+    if folder is not None:
+        cv2.imwrite(str(folder / 'Skeleton_manipulated.jpg'), 
+                    cv2.resize(lines*255, (img.shape[1], img.shape[0]), interpolation = cv2.INTER_NEAREST))
+    # sum of every column, back to full resolution
+    profile = np.repeat(cv2.reduce(lines, 0, cv2.REDUCE_SUM, dtype = cv2.CV_32S)[0], step)
+    sum_maxima = np.zeros(img.shape[1])
+    sum_maxima[:len(profile)] = profile[:img.shape[1]]
+    return sum_maxima
+
+def identify_rows(nb, folder, columns_corners, original_img, img_binary, img_core_col,
+                  angle_horiz, maxY, nbOfRowPerPlot, YN_binary, cache = None, columns_key = None,
+                  save_whole = False, stop = None):
+    """ Used in MPE, once per column (see run_columns)
+    Identify the rows of one column, crop and save its plots. The columns are
+    independent from each other.
+    
+    Inputs : 14
+        nb : int
+            number of the column
+        folder : Path object
+            absolute path to the folder in which all is saved
+        columns_corners : array of shape (n, 4, 2)
+            the 4 corners of every column (see crop_column)
+        original_img, img_binary, img_core_col : list of list
+            images of the whole field (original_img is None if the original
+            image is a binary)
+        angle_horiz : float
+            angle needed to get the rows in a vertical state
+        maxY : int
+            height of the rotated field image
+        nbOfRowPerPlot : int
+            number of rows per microplot
+        YN_binary : bolean
+            equals True if the original image is a binary
+        cache : StageCache object or None
+            cache of the run, the rows of the column are read from it if the
+            columns did not change
+        columns_key : str or None
+            key of the columns stage in the cache
+        save_whole : bolean
+            if True, the plots are also saved on images of the size of the
+            field (see MPE), which costs a pass over the whole field per plot
+        stop : Event or None
+            set by run_columns once a previous column has no row (or the run
+            is cancelled), nothing more is saved for this column
+    
+    Output : 1
+        rows : tuple or None
+            (rows_a, rows_b, rows_pairs) equations of the rows limits (see
+            get_equations) and first and last row of every plot of the column
+            (see line_pairs), None if no row has been detected or if stopped
+    """
+    stopped = lambda: stop is not None and stop.is_set()
+    if stopped():
+        return None
+    # folders made in MPE
+    if YN_binary == False:
+        sub_folder_rowOriginal = folder / str('Plot_rows_original')
+        sub_folder_rowOriginalWhole = folder / str('Plot_rows_original_whole')
+    sub_folder_rowBinary = folder / str('Plot_rows_binary')
+    # get the column number
+    nb_column = str(nb).zfill(2)
+    ## identify the rows
+    # cut the column out of the images in memory, on its bounding window
+    # only : the memory used by a column does not depend on the field size
+    images = [img_binary, img_core_col] + ([] if original_img is None else [original_img])
+    crops, column_window = crop_polygon(columns_corners[nb][None], *images)
+    current_column_binary, file_img = crops[:2]
+    current_column_original = None if original_img is None else crops[2]
+    y0, _, x0, _ = column_window
+    # the rows of the column are read from the cache if possible
+    rows_key = stage_key(cache, 'rows', columns_key, nb, columns_corners[nb])
+    rows = run_stage(cache, rows_key, lambda: detect_rows(nb, folder, file_img, column_window, angle_horiz),
+                     folder, ['Horizontal_columns/Rows_horizontal_delimited_column_' + nb_column + '.jpg'])
+    # if not separation lines has been detected, the code is not working
+    # as it is
+    if len(rows['rows_a']) == 0:
+        return None
+    rows_a, rows_b = rows['rows_a'], rows['rows_b']
+    if stopped():
+        return None
+            
+    print('Column nb: ' + str(nb_column))
+
+    ### cut the rows
+    if YN_binary == True:
+        current_column_original = current_column_binary
+    # for every row in that column, with a step defined by the inputted
+    # number nbOfRowPerPlot in the GUI
+    rows_pairs = line_pairs(len(rows_a), nbOfRowPerPlot)
+    # corners in the column window
+    rows_corners = band_corners(rows_a, rows_b, rows_pairs, maxY) - np.array([x0, y0], dtype = np.int32)
+    for k in range(len(rows_pairs)):
+        # a serial run would not have reached this column
+        if stopped():
+            return None
+        c = str(k).zfill(2) # for file names
+        # apply the mask to the column images, on the bounding rectangle of
+        # the row only
+        (row_binary, row_original), (ry0, ry1, rx0, rx1) = crop_polygon(rows_corners[k][None], current_column_binary, 
+                                                                         current_column_original)
+        # use a bounding box to only get the wanted part of the original
+        # image i.e. the row and not all the black pixels around
+        by0, by1, bx0, bx1 = nonzero_box(row_original)
+        if save_whole:
+            # window of the row in the field images
+            window = (ry0 + y0, ry1 + y0, rx0 + x0, rx1 + x0)
+            row_binary = paste_roi(row_binary, window, img_binary.shape)
+        else:
+            row_binary = row_binary[by0:by1, bx0:bx1]
+        cv2.imwrite(str(sub_folder_rowBinary / str('Plot_column_' + str(nb_column) + '_row_'+ str(c) + '_cropped.jpg')), 
+                    row_binary)
+        if YN_binary == False:
+            # save
+            cv2.imwrite(str(sub_folder_rowOriginal / str('Plot_column_' + str(nb_column) + '_row_' + str(c) + '_cropped.jpg')),
+                        row_original[by0:by1, bx0:bx1])
+            if save_whole:
+                cv2.imwrite(str(sub_folder_rowOriginalWhole / str('Plot_column_' + str(nb_column) + '_row_' + str(c) + '_whole_pic.jpg')), 
+                            paste_roi(row_original, window, original_img.shape))
+    return rows_a, rows_b, rows_pairs
+
+def detect_rows(nb, folder, column_core, window, angle_horiz):
+    """ Used in identify_rows
+    Find the rows of one column and save the image of the column with its rows
+    in the folder Horizontal_columns. Only the bounding window of the column
+    is rotated.
+    
+    Inputs : 5
+        nb : int
+            number of the column
+        folder : Path object
+            absolute path to the folder in which all is saved
+        column_core : list of list
+            core image of the field on the bounding window of the column,
+            black out of the column (see crop_polygon)
+        window : tuple
+            (y0, y1, x0, x1) position of the window in the field images
+        angle_horiz : float
+            angle needed to get the rows in a vertical state
+    
+    Output : 1
+        rows : dict
+            equations of the rows limits ('rows_a', 'rows_b', see get_equations),
+            empty if no row has been detected
+    """
+    # rotate the column until it is horizontally oriented
+    column_binary_rotate, add_y, add_x = rotate_bound(column_core, angle_horiz, change_bigger = True)
+    # make the sum of all white pixels on one line
+    sum_rows = np.sum(column_binary_rotate, axis = 0).astype(float)
+    # make a copy and replace 0 by nan to get the mean value of the sum without 0
+    sum_rows_nan = sum_rows.copy()
+    sum_rows_nan[sum_rows == 0] = np.nan
+    mean_line = np.nanmean(sum_rows_nan)
+    # erase the values smaller than half of the mean
+    sum_rows[sum_rows < mean_line/2] = 0
+    # identify the rows with the changing pattern
+    _, cut_points, w = draw_separation_lines(np.array(sum_rows), 
+                                             rows_img = column_binary_rotate)
+    if len(cut_points) == 0:
+        return {'rows_a': np.empty((0, 2)), 'rows_b': np.empty((0, 2))}
+    cv2.imwrite(str(folder / 'Horizontal_columns' / str('Rows_horizontal_delimited_column_' + str(nb).zfill(2) + '.jpg')), column_binary_rotate)
+    
+    ## get the points in the original angle
+    # center of the window
+    center = (column_core.shape[0]/2, column_core.shape[1]/2)
+    cut_points = np.array(cut_points)
+    # points without the added black border (in rotate_bound)
+    cut_points[:, :, 0] = cut_points[:, :, 0] - add_x
+    cut_points[:, :, 1] = cut_points[:, :, 1] - add_y
+    # rotate the points, then put them in the field images
+    cut_points = rotate(center, cut_points, math.radians(angle_horiz))
+    cut_points[:, :, 0] += window[2]
+    cut_points[:, :, 1] += window[0]
+    # get equations based on the points
+    rows_a, rows_b = get_equations(cut_points)
+    return {'rows_a': rows_a, 'rows_b': rows_b}
+
+def run_columns(nb_columns, args, workers = None, pool_type = 'thread', tracker = None):
+    """ Used in MPE
+    Run identify_rows for every column on a pool of threads or processes ;
+    the results are given in the column order, as a serial run would.
+    
+    Inputs : 5
+        nb_columns : int
+            number of columns
+        args : tuple
+            all the inputs of identify_rows except the column number
+        workers : int or None
+            number of workers (all the cores if None)
+        pool_type : str ('thread' or 'process')
+            type of the pool ; processes only get the images once
+        tracker : Progress object or None
+            progress of the columns ('rows' stage) and cancellation, the
+            columns not started yet are dropped once the run is cancelled
+    
+    The columns still running after the first column without any row (or
+    once cancelled) are stopped before saving their plots.
+    
+    Output : 1
+        results : list
+            output of identify_rows for every column, stopped after the first
+            column without any row (or once cancelled)
+    """
+    workers = workers or os.cpu_count() or 1
+    if pool_type == 'process':
+        stop = multiprocessing.Event()
+        pool = ProcessPoolExecutor(max_workers = workers, initializer = _set_column_args,
+                                   initargs = (args, stop))
+        futures = [pool.submit(_identify_rows_worker, nb) for nb in range(nb_columns)]
+    else:
+        stop = threading.Event()
+        pool = ThreadPoolExecutor(max_workers = workers)
+        futures = [pool.submit(identify_rows, nb, *args, stop = stop) for nb in range(nb_columns)]
+    results = []
+    try:
+        for future in futures:
+            results.append(future.result())
+            # same stop as in a serial run
+            if results[-1] is None:
+                break
+            if tracker is not None:
+                tracker.report('rows', len(results), nb_columns)
+                if tracker.cancelled():
+                    break
+    finally:
+        stop.set()
+        for future in futures:
+            future.cancel()
+        pool.shutdown()
+    return results
+
+# inputs of identify_rows in the processes of run_columns
+_column_args = None
+_column_stop = None
+
+def _set_column_args(args, stop):
+    global _column_args, _column_stop
+    _column_args, _column_stop = args, stop
+
+def _identify_rows_worker(nb):
+    return identify_rows(nb, *_column_args, stop = _column_stop)
+
+def crop_column(roi_corners, original_img, img_binary, img_core_col):
+    """ Black out everything outside of one column in the images of the field,
+    the mask is only made on the bounding rectangle of the column (see
+    crop_polygon)
+    
+    Inputs : 4
+        roi_corners : array of shape (1, 4, 2)
+            the 4 corners of the column, counter clockwise
+        original_img : list of list or None
+            original image (None if the original image is a binary)
+        img_binary : list of list
+            binary image
+        img_core_col : list of list
+            binary image of the core of the columns
+    
+    Outputs : 3
+        column_original, column_binary, column_core : list of list
+            the column in each image, full size ; column_original is None if
+            original_img is None
+    """
+    images = [img_binary, img_core_col] + ([] if original_img is None else [original_img])
+    crops, window = crop_polygon(roi_corners, *images)
+    column_binary, column_core = [paste_roi(crop, window, img_binary.shape) for crop in crops[:2]]
+    column_original = None
+    if original_img is not None:
+        column_original = paste_roi(crops[2], window, original_img.shape)
+    return column_original, column_binary, column_core
+
+def crop_polygon(roi_corners, *images):
+    """ Cut a polygon out of images of the same size. Only the bounding 
+    rectangle of the polygon (inside the images) is masked : the cost depends
+    on the polygon area, not on the image size. \n
+    The pixels are the same as with a mask of the size of the whole image.
+    
+    Inputs : 2 or more
+        roi_corners : array of shape (1, n, 2)
+            the corners (x, y) of the polygon, int32
+        images : list of list
+            images to cut (2D or 3D), all of the same height and width
+    
+    Outputs : 2
+        crops : list of list of list
+            the bounding rectangle of the polygon in every image, with black
+            pixels outside of the polygon
+        window : tuple
+            (y0, y1, x0, x1) position of the bounding rectangle in the images
+    """
+    h, w = images[0].shape[:2]
+    # bounding rectangle of the polygon, inside the images
+    x0 = int(min(max(roi_corners[..., 0].min(), 0), w))
+    x1 = int(min(max(roi_corners[..., 0].max() + 1, x0), w))
+    y0 = int(min(max(roi_corners[..., 1].min(), 0), h))
+    y1 = int(min(max(roi_corners[..., 1].max() + 1, y0), h))
+    if x1 == x0 or y1 == y0:
+        return [image[y0:y1, x0:x1].copy() for image in images], (y0, y1, x0, x1)
+    # mask in the coordinates of the bounding rectangle
+    mask = np.zeros((y1 - y0, x1 - x0), dtype = np.uint8)
+    cv2.fillPoly(mask, roi_corners - np.array([x0, y0], dtype = np.int32), (255,))
+    crops = []
+    for image in images:
+        crop = np.ascontiguousarray(image[y0:y1, x0:x1])
+        crops.append(cv2.bitwise_and(crop, crop, mask = mask))
+    return crops, (y0, y1, x0, x1)
+
+def paste_roi(crop, window, shape):
+    """ Put a crop made by crop_polygon back into a black image of the size
+    'shape' (same as masking the whole image) """
+    y0, y1, x0, x1 = window
+    image = np.zeros(shape, dtype = crop.dtype)
+    image[y0:y1, x0:x1] = crop
+    return image
+
+def crop_nonzero(image):
+    """ Smallest part of an image containing all its non-black pixels """
+    y0, y1, x0, x1 = nonzero_box(image)
+    return image[y0:y1, x0:x1]
+
+def nonzero_box(image):
+    """ Position (y0, y1, x0, x1) of the smallest part of an image
+    containing all its non-black pixels, the whole image if it is black """
+    filled = image if image.ndim == 2 else image.any(axis = 2)
+    rows = np.flatnonzero(filled.any(axis = 1))
+    cols = np.flatnonzero(filled.any(axis = 0))
+    if len(rows) == 0:
+        return 0, image.shape[0], 0, image.shape[1]
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+def estimate_angle(img, globalOrientation, size = 1024):
+    """ Estimate the angle needed to get the columns of the field in a vertical
+    state, using the variance of the projection profile : once the columns are
+    vertical, the sum of the white pixels of every image column alternates 
+    between the columns and the gaps between them. \n
+    The binary is first decimated so that its biggest side is at most 'size'
+    pixels : the cost and the memory used do not depend on the field size.
+    
+    Inputs : 3
+        img : list of list
+            binary image of the field
+        globalOrientation : str ('V' or 'H')
+            global orientation of the columns as inputted by the user, the
+            angle is searched 45 degrees around it
+        size : int
+            biggest side (px) of the decimated binary
+    
+    Outputs : 2
+        angle : float
+            angle (degrees) by which the image has to be rotated
+        confidence : float
+            between 0 and 1, share of the best profile variance above the
+            median variance of all tested angles ; 0 if the best angle is at
+            the limit of the searched range (no clear orientation)
+    """
+    # decimate the binary, the mean of the pixels is kept (INTER_AREA)
+    rows, cols = img.shape[:2]
+    coeff = min(1., size/max(rows, cols))
+    small = cv2.resize(img.astype(np.uint8), (max(1, int(cols*coeff)), max(1, int(rows*coeff))),
+                       interpolation = cv2.INTER_AREA)
+    def profile_variance(angles):
+        variances = []
+        for a in angles:
+            rotated, _, _ = rotate_bound(small, a, change_bigger = True)
+            variances.append(np.var(rotated.sum(axis = 0, dtype = np.float64)))
+        return np.array(variances)
+    # if the columns are orginally horizontal, we want them to become vertical
+    center = 90. if globalOrientation == 'H' else 0.
+    # one degree steps, then refine around the best angle
+    angles = np.arange(center - 45, center + 46, 1.)
+    variances = profile_variance(angles)
+    best = int(np.argmax(variances))
+    if variances[best] <= 0:
+        return center, 0.
+    confidence = float((variances[best] - np.median(variances))/variances[best])
+    if best in (0, len(angles) - 1):
+        confidence = 0.
+    fine_angles = np.linspace(angles[best] - 1, angles[best] + 1, 41)
+    angle = float(fine_angles[np.argmax(profile_variance(fine_angles))])
+    return angle, confidence
+
 def rotate_bound(image, angle, change_bigger = None):
     """ Rotate an image, change the size if inputted to makes sure all pixels 
     are still displayed in the output
@@ -481,29 +842,29 @@ def rotate_bound(image, angle, change_bigger = None):
 def rotate(origin, points, angle):
     """
     Rotate a list of list of 4 points, counterclockwise, by a given angle around
-    a given origin. The y axis is considered going downward.
+    a given origin. The y axis is considered going downward. \n
+    All the points are rotated at once ; the products of the rotation matrix
+    are written out so that the rounding is the same as point by point.
     
     Inputs : 3
         origin : tuple
             coordinates of the origin around which the rotation will be done
-        points : list of list of list, as [[[px, py]]]
-            points that will be rotated
+        points : array of shape (n, 4, 2), as [[[px, py]]]
+            points that will be rotated, modified in place
         angle : int
             angle in radians of the needed rotation
     Output : 1
-        points : list of list
+        points : array of shape (n, 4, 2)
+            rotated points, truncated to integers
             
     """
     oy, ox = origin
-    # iterate throught all the elements of points
-    for column in range(len(points)):
-        for point in range(len(points[column])):
-            px, py = points[column][point]
-            # rotate the points according to the center and angle
-            qx = ox + math.cos(angle) * (px - ox) - math.sin(angle) * (py - oy)
-            qy = oy + math.sin(angle) * (px - ox) + math.cos(angle) * (py - oy)
-            # save the new values
-            points[column][point] = int(qx), int(qy)
+    cos, sin = math.cos(angle), math.sin(angle)
+    px = points[..., 0].astype(float)
+    py = points[..., 1].astype(float)
+    # rotation matrix [[cos, -sin], [sin, cos]] applied around the origin
+    points[..., 0] = (ox + cos*(px - ox) - sin*(py - oy)).astype(int)
+    points[..., 1] = (oy + sin*(px - ox) + cos*(py - oy)).astype(int)
     return points
 
 def draw_separation_lines(img, rows_img, col = None):
@@ -519,8 +880,10 @@ def draw_separation_lines(img, rows_img, col = None):
     Outputs :
         img : list of list
             image processed, on which separation lines have been drawn
-        cut_points : list of list
-            coordinates of where the separation lines have been drawn
+        cut_points : array of shape (n, 4, 2)
+            coordinates of where the separation lines have been drawn (start
+            line top and bottom, end line top and bottom), empty if nothing
+            has been found
         width : int
             average width of the distance between the following separation lines
             (average width of the space "columns" between separation lines)
@@ -531,92 +894,54 @@ def draw_separation_lines(img, rows_img, col = None):
     # all together, similar clusters are considered as one. This is to avoid 
     # broken lines to be treated as several column/row when they belong to the
     # same area
-    cut_points, start, end = [], [], []
     if col == True:
         # initialization for later (img with only the core of the column)
         img_core_col = rows_img.copy()
     # search for situations, in the "1-row array crushed image", that shows a
     # change i.e. pixels as : 000001111 or 11110000
-    for i in range(len(img) - 1):
-        # search for 01 situations
-        if img[i] == 0 and img[i+1] != 0:
-            # "start" contains all the x positions of start points of a "crushed"
-            # cluster merged in the "1-row array crushed image"
-            start.append(i)
-        # search for 10 situation
-        elif img[i] != 0 and img[i+1] == 0:
-            # "end" contains all the x positions of end points of a "crushed"
-            # cluster merged in the "1-row array crushed image"
-            end.append(i)
-    cut_points = []
+    filled = np.asarray(img) != 0
+    # "start" contains all the x positions of start points (01 situations) of
+    # a "crushed" cluster merged in the "1-row array crushed image"
+    start = np.flatnonzero(~filled[:-1] & filled[1:])
+    # "end" contains all the x positions of end points (10 situations)
+    end = np.flatnonzero(filled[:-1] & ~filled[1:])
     maxY = img.shape[0]
     img = rows_img
     # if no element has been identified at all (black image, not cluster)
     if len(start) == 0:
-        return(img, [], 0)
+        # same outputs as below, the core image of the columns is empty
+        if col == True:
+            return(img, np.empty((0, 4, 2), dtype = int), 0, None)
+        return(img, np.empty((0, 4, 2), dtype = int), 0)
     # if more than 2 elements has been identified
     elif len(start) > 2:
-        # start at the second element and finishes at the second-to-last
-        # because first and last are special cases
-        for k in range(1, len(start) - 1):
-            # save all the start and end points
-            cut_points.append([])
-            # calculate a margin so that the drawn lines are in the middle of
-            # the end line of the previous element and the start line of the 
-            # following element (centers lines between elements)
-            margin_start = int((start[k] - end[k - 1])/2)
-            margin_end = int((start[k + 1] - end[k])/2)
-            # change the start coordinate values to the center values using - margin
-            cut_points[-1].append((start[k] - margin_start, 0))
-            cut_points[-1].append((start[k] - margin_start, maxY))
-            # draw the start lines
-            cv2.line(img, cut_points[-1][0], cut_points[-1][1], (255,), 3)
-            # change the end coordinate values to the center values using + margin
-            cut_points[-1].append((end[k] + margin_end, 0))
-            cut_points[-1].append((end[k] + margin_end, maxY))
-            # draw the end lines
-            cv2.line(img, cut_points[-1][2], cut_points[-1][3], (255,), 3)
-            # if it is the second element, there is no element before
-            if k == 1:
-                # for afterwards, value of margin used for the second column is saved
-                # (start and end margin of the first column = start margin of the second column)
-                margin_firstColumn = margin_start
-            if k == len(start) - 2:
-                # for afterwards, value of margin used for the second-to-last is saved
-                # (start and end margin of the last column = end margin of the
-                # second-to-lat column)
-                margin_lastColumn = margin_end
-            if col == True:
-                # erase data outside of the core of the col
-                img_core_col[0:maxY, end[k]:start[k+1]] = 0
-        # make the same for special cases i.e. add margins and draw first and
-        # last separation lines with the values saved before
-        margin = margin_firstColumn
-        cut_points.insert(0, [(start[0] - margin, 0), (start[0] - margin, maxY), (end[0] + margin, 0), (end[0] + margin, maxY)])
-        cv2.line(img, cut_points[0][0], cut_points[0][1], (255,), 3)
-        cv2.line(img, cut_points[0][2], cut_points[0][3], (255,), 3)
+        # calculate margins so that the lines are in the middle of the end
+        # line of the previous element and the start line of the following
+        # element (centers lines between elements) ; the first and last 
+        # elements use the margins of the second and second-to-last elements
+        inner = np.arange(1, len(start) - 1)
+        margin_start = ((start[inner] - end[inner - 1])/2).astype(int)
+        margin_end = ((start[inner + 1] - end[inner])/2).astype(int)
+        margin_start = np.concatenate(([margin_start[0]], margin_start, [margin_end[-1]]))
+        margin_end = np.concatenate(([margin_start[0]], margin_end, [margin_end[-1]]))
+        # margin of the last element, for the width
+        margin = margin_end[-1]
+        # lines positions, start and end
+        start_lines = start - margin_start
+        end_lines = np.append(end[:len(start) - 1], end[-1]) + margin_end
         if col == True:
-            # erase data outside of the core of the first col (on the left and right)
+            # erase data outside of the core of the cols
             img_core_col[0:maxY, 0:start[0]] = 0
-            img_core_col[0:maxY, end[0]:start[1]] = 0
-        # do last column
-        margin = margin_lastColumn
-        cut_points.insert(len(cut_points), [(start[-1] - margin, 0), (start[-1] - margin, maxY), (end[-1] + margin, 0), (end[-1] + margin, maxY)])
-        cv2.line(img, cut_points[-1][0], cut_points[-1][1], (255,), 3)
-        cv2.line(img, cut_points[-1][2], cut_points[-1][3], (255,), 3)
-        if col == True:
-            # erase data outside of the core of the last col
+            for k in range(len(start) - 1):
+                img_core_col[0:maxY, end[k]:start[k+1]] = 0
             img_core_col[0:maxY, end[-1]:end[-1] + margin] = 0
     # if only two elements are detected
     elif len(start) == 2 :
         # the margin is then the center value of second line start position
         # and the first line end position
         margin = (start[1] - end[0])/2
-        # calculate the position and draw them
-        for i in range(2):
-            cut_points.append([(int(start[i] - margin), 0), (int(start[i] - margin), maxY), (int(end[i] + margin), 0), (int(end[i] + margin), maxY)])
-            cv2.line(img, cut_points[-1][0], cut_points[-1][1], (255,), 3)
-            cv2.line(img, cut_points[-1][2], cut_points[-1][3], (255,), 3)
+        start_lines = (start - margin).astype(int)
+        end_lines = (end[[0, 1]] + margin).astype(int)
         if col == True:
             img_core_col[0:maxY, 0:start[0]] = 0
             img_core_col[0:maxY, end[0]:start[1]] = 0
@@ -625,10 +950,17 @@ def draw_separation_lines(img, rows_img, col = None):
     else:
         # margin decided arbitrarly : 1/4 of the width of the element
         margin = int((end[0] - start[0])/4)
-        # separation points are calculated and drawn
-        cut_points.append([(start[0] - margin , 0), (start[0] - margin, maxY), (end[0] + margin, 0), (end[0] + margin, maxY)])
-        cv2.line(img, cut_points[0][0], cut_points[0][1], (255,), 3)
-        cv2.line(img, cut_points[0][2], cut_points[0][3], (255,), 3)
+        start_lines = start - margin
+        end_lines = end[[0]] + margin
+    # separation points : top and bottom of the start and end lines
+    cut_points = np.zeros((len(start), 4, 2), dtype = int)
+    cut_points[:, :2, 0] = start_lines[:, None]
+    cut_points[:, 2:, 0] = end_lines[:, None]
+    cut_points[:, 1::2, 1] = maxY
+    # draw the separation lines
+    for points in cut_points.tolist():
+        cv2.line(img, tuple(points[0]), tuple(points[1]), (255,), 3)
+        cv2.line(img, tuple(points[2]), tuple(points[3]), (255,), 3)
     # average value of the width (margin excluded) of every elements identified
     # on the "1-row array crushed image"
     width = (sum(end) - sum(start))/len(start) + margin
@@ -638,164 +970,14 @@ def draw_separation_lines(img, rows_img, col = None):
         return (img, cut_points, width)
 
 
-def get_equations(points):
-    """ Calculate affine equations of inputted points
-    
-    Input : 1
-        points : list of list 
-            ex : [[[x1, y1], [x2, y2]], [[xx1, yy1], [xx2, yy2]]] for 2 identified
-            elements 
-            Contains coordinates of separation lines i.e. 
-            [[[start points x, y], [end points x, y]] [...], [...]]            
-    Output : 2
-        columns_a : list of list
-            Contains all the a coefficients of an affine equation (y = ax + b)
-            of all the calculated lines, in the same order as the input
-        columns_b : list of list
-            Contains all the b coefficients of an affine equation (y = ax + b)
-            of the all the calculated lines, in the same order as the input"""
-    columns_a, columns_b = [], []
-    # iterate throught points
-    for k in points:
-        # calculate the a coefficients of start and end separation lines of this element
-        a1 = (k[0][1] - k[1][1])/(k[0][0] - k[1][0])
-        a2 = (k[2][1] - k[3][1])/(k[2][0] - k[3][0])
-        columns_a.append([a1, a2])
-        # then calculate the b coefficients of start and end separation lines
-        # using the a coeff calculated before
-        b1 = k[0][1] - a1*k[0][0]
-        b2 = k[2][1] - a2*k[2][0]
-        columns_b.append([b1, b2])
-    return (columns_a, columns_b)
-
-def line_intersection(startCol_a, endCol_a, startCol_b, endCol_b, startRow_a, endRow_a,
-                      startRow_b, endRow_b, aff, y_offset, x_offset):
-    '''Is used in "get the rows" part of the class "Cluster Window"
-    It gets the insection point of lines (here columns and rows), 
-    i.e. the 4 corners of the plot
-    Note : we have y = a*x + b for an affine equation
-    Note: "start" and "end" refers here to the considered plot here
-    Note : the 2 element in every column/row parameters are the line delimiting
-        the column/rows when oriented horizontally (separating lines are vertical)
-        Element 0 : the first line ("on the left side") 
-        Element 1 : the second line ("on the right side")
-        When a parameters are considered, the two value are either identical or
-        very close.
-    
-    Inputs : 11
-        startCol_a : list of 2 elements
-            list of the a parameter for the start column
-        endCol_a : list of two elements
-            list of the a parameter for the end column
-        startCol_b : list of 2 elements
-            list of the b parameter for the start column 
-        endCol_b : list of 2 elements
-            list of the b parameter for the end column
-        startRow_a : list of 2 elements
-            list of the a parameter for the start row
-        endRow_a : list of 2 elements
-            list of the a parameter for the end row
-        startRow_b : list of 2 elements
-            list of the b parameter for the start row
-        endRow_b : list of 2 elements
-            list of the b parameter for the end row
-        aff : Affine object OR int (0)
-            Affine transformation matrix associated with the original image
-            georeferencement, project the calculated points into its CRS
-            Equals zero if the original image is not georeferenced
-        - Following inputs are the number of pixels cropped in the very first 
-        step of the program (at binarization) to make the running time faster
-        y_offset : int
-            top pixels
-        x_offset :
-            left pixels
-
-    Outputs : 1
-        [pt4, pt3, pt2, pt1, pt4_geo, pt3_geo, pt2_geo, pt1_geo]
-        list of 8 tuple-elements
-            corners of the plot, clockwise
-            first 4 points are pixels coordinates
-            last 4 points are georeferenced (equals 0 if the original image is
-            not georeferenced) 
-        '''
-    # if the a parameter is the same, then there is no crossing points
-    # should never happen
-    if startCol_a[0] == startRow_a[0]:
-        print ("These lines are parallel.")
-        return None
-    # caculate the common point between the lines
-    # x = (b1 - b2) / (a2 - a1)
-    # y = a1 * x + b1
-    x1 = (startRow_b[0] - startCol_b[0])/(startCol_a[0] - startRow_a[0])
-    y1 = (startRow_a[0] * x1 + startRow_b[0])
-    x2 = (endRow_b[1] - startCol_b[0])/(startCol_a[1] - endRow_a[0])
-    y2 = endRow_a[0] * x2 + endRow_b[1]
-    x3 = (endRow_b[1] - endCol_b[1])/(endCol_a[1] - endRow_a[1])
-    y3 = endRow_a[1] * x3 + endRow_b[1]
-    x4 = (startRow_b[0] - endCol_b[1])/(endCol_a[0] - startRow_a[1])
-    y4 = startRow_a[0] * x4 + startRow_b[0]
-    # calculate the non-georeferenced coordinates of the plot
-    # no affine transformation applied ; -1*y because for images the axis goes down
-    pt1 = (x1 + x_offset, - y1 - y_offset)
-    pt2 = (x2 + x_offset, - y2 - y_offset)
-    pt3 = (x3 + x_offset, - y3 - y_offset)
-    pt4 = (x4 + x_offset, - y4 - y_offset)
-    # if aff = 0, it means the original image was not georeferenced
-    if aff == 0:
-        # return the points clock wise 
-        return ([pt4, pt3, pt2, pt1], None)
-    # if the original is georeferenced, get the coord in the original geotiff
-    # system, i.e. multiply by the affine transformation matrix
-    else:
-        # georeferenced points
-        pt1_geo = (x1 + x_offset, y1 + y_offset)*aff
-        pt2_geo = (x2 + x_offset, y2 + y_offset)*aff
-        pt3_geo = (x3 + x_offset, y3 + y_offset)*aff
-        pt4_geo = (x4 + x_offset, y4 + y_offset)*aff
-        #return both points
-        return ([pt4, pt3, pt2, pt1], [pt4_geo, pt3_geo, pt2_geo, pt1_geo])
-
-def make_shp(folder, nbCol, nbRow, points):
-    '''Is used in "get the rows" part of the class "Cluster Window"
-    Makes *.shp files according to inputted points in a CLOCKWISE order
-    
-    Inputs : 4
-        folder : path object
-            Absolute path to the folder where to save the *.shp
-        nbCol : int
-            number of the considered column (used in the file names)
-        nbRow : int
-            number of the considered row (used in the file names)
-        points : list of 4 tuple-elements
-            points used to define the polygon area
-    
-    Outputs : none
-    '''
-    #get the saving name of the file
-    save_path = folder / str('Col_' + str(nbCol) + '_row_' + str(nbRow) + '.shp')
-    # "close" the shp byt adding the start point at the end
-    points.append(points[0])
-    # write a new shp file as a polygon shape
-    w = shapefile.Writer(str(save_path), shapeType = 5)
-    # make the geometry out of the points list
-    w.poly([points])
-    # fields definition : 
-    # column number field
-    w.field('Col_nb','N', '40')
-    # row number field
-    w.field('Row_nb','N', '40')
-    # save values into fields
-    w.record(int(nbCol), int(nbRow))
-    # close the *.shp, thus saving it
-    w.close()
-
 def metadata(main_folder, field_image, noise, ColPerPlot, 
              RowPerPlot, orientation, rows_folder, SHP_folder, angle, 
-             nbOfColumn, nbOfRowPerColumn, inter, aff, inter_geo):
+             nbOfColumn, nbOfRowPerColumn, inter, aff, inter_geo, 
+             angle_confidence = None, plots_file = None, legacy_shp = True):
     ''' Used in the very last part of the class "ClusterWindow" 
     Gather and save the metadata in a txt file.
     
-    Inputs : 15
+    Inputs : 18
         main_folder : Path object
             absolute path to the whole directory containing all saved files
         field_image : Path object
@@ -812,8 +994,9 @@ def metadata(main_folder, field_image, noise, ColPerPlot,
         rows_folder : Path object
             absolute path to the folder containing the cropped plot in the
             binary image
-        SHP_folder : Path object
-            absolute path to the folder containing the *.shp files
+        SHP_folder : Path object or None
+            absolute path to the folder containing the *.shp files of every
+            plot, None if they have not been saved
         angle : float
             value of the angle needed to rotate the image horizontally (degrees)
         nbOfColumn : int
@@ -841,6 +1024,12 @@ def metadata(main_folder, field_image, noise, ColPerPlot,
             ex for the rows "0" and "1" of the column "0" :
                 [[0;0;3111.57;-1854.42;2248.22;-1525.92;2673.94;-419.76;3536.17;-751.17;3111.57;-1854.42],
                  [0;1;2247.05;-1526.05;1372.21;-1188.63;1797.99;-82.50;2673.17;-419.03;2247.05;-1526.05]]
+        angle_confidence : float or None
+            confidence of the estimated angle (see estimate_angle)
+        plots_file : Path object or None
+            absolute path to the file containing all the plots polygons
+        legacy_shp : bolean
+            True if All_plots.shp has been saved
     
     Outputs : none'''
     # writes the metadata text file
@@ -863,18 +1052,26 @@ def metadata(main_folder, field_image, noise, ColPerPlot,
         f.write('\n\n## Files paths')
         f.write('\nMain folder: ')
         f.write(str(main_folder))
-        f.write('\nShapefile with all the plots: ')
-        f.write(str(main_folder / 'All_plots.shp'))
+        if plots_file is not None:
+            f.write('\nFile with all the plots: ')
+            f.write(str(plots_file))
+        if legacy_shp:
+            f.write('\nShapefile with all the plots: ')
+            f.write(str(main_folder / 'All_plots.shp'))
         f.write('\nBinary plots folder: ')
         f.write(str(rows_folder))
-        f.write('\nSHP folder: ')
-        f.write(str(SHP_folder))
+        if SHP_folder is not None:
+            f.write('\nSHP folder: ')
+            f.write(str(SHP_folder))
         f.write('\n\n## Calculated metadata')
         if aff != 0:
             f.write('\nTransform affine matrix:\n')
             f.write(str(aff))
         f.write('\nAngle (compared to an horizontal line): ')
         f.write(str(angle))
+        if angle_confidence is not None:
+            f.write('\nAngle confidence (0 to 1): ')
+            f.write(str(round(angle_confidence, 3)))
         f.write('\nNumber of column(s): ')
         f.write(str(nbOfColumn))
         f.write('\nAverage number of row(s): ')
@@ -885,7 +1082,7 @@ def metadata(main_folder, field_image, noise, ColPerPlot,
     inter = np.array(inter)
     np.savetxt(csv_file, inter, delimiter = ',', newline='\n', header = 'Column;Row;pt1_x;pt1_y;pt2_x;pt2_y;pt3_x;pt3_y;pt4_x;pt4_y', comments = '', fmt='%s')
 
-    if inter_geo != []:
+    if len(inter_geo) != 0:
         csv_file = main_folder / "Intersection_points_georeferenced.csv"
         inter = np.array(inter)
         np.savetxt(csv_file, inter_geo, delimiter = ',', newline='\n', header = 'Column;Row;pt1_x;pt1_y;pt2_x;pt2_y;pt3_x;pt3_y;pt4_x;pt4_y', comments = '', fmt='%s')
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+2019, L. Tresch for University of Tokyo, Field Phenomics Research Laboratory
+Please read the read_me.txt for furter information.
+Annex code to MPE_main.py
+
+Progress, timing and cancellation of the stages of MPE and of the reverse
+calculation, so that they can run out of the GUI thread : the progress is
+sent to a function (a Qt signal in the GUI), the time of every stage is kept
+and the run stops at the next check once the cancel event is set.
+"""
+###############################################################################
+##################################### ENV #####################################
+###############################################################################
+
+import time
+
+###############################################################################
+#################################### CODE #####################################
+###############################################################################
+
+class Progress:
+    """ Follows the stages of one run
+
+    Inputs : 3
+        progress : function or None
+            called as progress(stage, done, total) during the run
+        cancel : threading.Event or None
+            set (by another thread) to stop the run
+        stats : dict or None
+            filled with the time (s) of every stage ('timings')
+    """
+
+    def __init__(self, progress = None, cancel = None, stats = None):
+        self.progress = progress
+        self.cancel = cancel
+        self.timings = {}
+        if stats is not None:
+            stats['timings'] = self.timings
+        self.start = time.perf_counter()
+
+    def report(self, stage, done, total):
+        """ Send the progress of a stage (done out of total steps)"""
+        if self.progress is not None:
+            self.progress(stage, done, total)
+
+    def end(self, stage):
+        """ Keep the time of a stage (since the end of the previous one) and
+        tell if the run has been cancelled"""
+        now = time.perf_counter()
+        self.timings[stage] = round(now - self.start, 3)
+        self.start = now
+        return self.cancelled()
+
+    def cancelled(self):
+        return self.cancel is not None and self.cancel.is_set()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+2019, L. Tresch for University of Tokyo, Field Phenomics Research Laboratory
+Please read the read_me.txt for furter information.
+Annex code to MPE_main.py
+
+Access to the field image through rasterio windows, so that orthomosaics
+bigger than what OpenCV (or the RAM) can decode at once can be used.
+"""
+###############################################################################
+##################################### ENV #####################################
+###############################################################################
+
+from pathlib import Path
+import threading
+import cv2, numpy as np, rasterio
+from rasterio.windows import Window
+
+###############################################################################
+#################################### CODE #####################################
+###############################################################################
+
+class FieldRaster:
+    """ Field image opened once with rasterio. \n
+    The whole image is never decoded : the display uses decimated reads (the
+    overviews of the file are used if they exist) and the processing only
+    reads the bounding window of the field at full resolution. \n
+    Images are returned in 8 bits with the channel order of OpenCV : BGR, or
+    gray for one-band images (binaries)."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.src = rasterio.open(self.path)
+        self.width, self.height = self.src.width, self.src.height
+        self.count = self.src.count
+        # georeferencement, None if the image is not georeferenced
+        self.transform = self.src.transform
+        self.crs = self.src.crs
+        # bands displayed, and values displayed in black and white (see
+        # display_range)
+        self.display_indexes = [1, 2, 3] if self.count >= 3 else [1, 1, 1]
+        self._display_range = None
+        # the viewer reads tiles from other threads, a rasterio dataset is
+        # read by one thread at a time
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.src.close()
+
+    def read(self, indexes, **kwargs):
+        """ Same as rasterio's read, one thread at a time"""
+        with self.lock:
+            return self.src.read(indexes, **kwargs)
+
+    def display_size(self, displaySize):
+        """ Size of the image once resized to fit the screen, the biggest side
+        being 'displaySize' pixels long
+
+        Input : 1
+            displaySize : int
+                maximum size (px) of the displayed image
+
+        Outputs : 3
+            W, H : int
+                width and height of the displayed image
+            coeff : float
+                resizing coefficient (displayed size / original size)
+        """
+        if self.height >= self.width: # if the picture's height is bigger than its width
+            H = displaySize
+            coeff = H/self.height
+            W = int(coeff*self.width)
+        else: # if width is bigger than height
+            W = displaySize
+            coeff = W/self.width
+            H = int(coeff*self.height)
+        return W, H, coeff
+
+    def read_display(self, displaySize):
+        """ Read the whole image, decimated to fit the screen
+
+        Input : 1
+            displaySize : int
+                maximum size (px) of the displayed image
+
+        Outputs : 2
+            img : array
+                8 bits BGR image (as cv2.imread would give) of the size
+                given by display_size
+            coeff : float
+                resizing coefficient (displayed size / original size)
+        """
+        W, H, coeff = self.display_size(displaySize)
+        img = self.read(self.display_indexes, out_shape = (3, H, W))
+        img = to_cv2(img)
+        # display in 8 bits
+        if img.dtype == np.uint16:
+            img = (img >> 8).astype(np.uint8)
+        elif img.dtype != np.uint8:
+            img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+        return np.ascontiguousarray(img), coeff
+
+    def read_tile(self, level, row, col, size):
+        """ Read one tile of the image pyramid used by the viewer (see
+        EasyMPE_viewer.py), decimated if it is not at full resolution
+
+        Inputs : 4
+            level : int
+                level of the pyramid, the resolution is divided by 2**level
+            row, col : int
+                position of the tile in the level
+            size : int
+                size (px) of the tiles
+
+        Output : 1
+            img : array
+                8 bits BGR tile, smaller than size x size on the right and
+                bottom borders of the image
+        """
+        step = 2**level
+        x0, y0 = col*size*step, row*size*step
+        w, h = min(size*step, self.width - x0), min(size*step, self.height - y0)
+        out_shape = (3, max(1, -(-h//step)), max(1, -(-w//step)))
+        img = to_cv2(self.read(self.display_indexes, window = Window(x0, y0, w, h),
+                                   out_shape = out_shape))
+        # same values for all the tiles
+        low, high = self.display_range()
+        if img.dtype == np.uint16:
+            img = (img >> 8).astype(np.uint8)
+        elif (low, high) != (0, 255):
+            img = cv2.convertScaleAbs(img, alpha = 255/max(high - low, 1e-12),
+                                      beta = -255*low/max(high - low, 1e-12))
+        return np.ascontiguousarray(img)
+
+    def display_range(self):
+        """ Values displayed in black and white in the tiles, computed once
+        on a decimated read : (0, 1) for 0/1 binaries, (0, 255) for other 8
+        bits images, minimum and maximum values otherwise"""
+        if self._display_range is None:
+            W, H, _ = self.display_size(512)
+            img = self.read(self.display_indexes, out_shape = (3, max(H, 1), max(W, 1)))
+            if img.dtype == np.uint8:
+                self._display_range = (0, 1) if img.max() == 1 else (0, 255)
+            else:
+                self._display_range = (float(img.min()), float(img.max()))
+        return self._display_range
+
+    def to_8bits(self, img):
+        """ Values of the image in 8 bits : 16 bits images are shifted as
+        cv2.imread does, integer values which already fit in 8 bits (0/1
+        binaries...) are kept and the other ones are scaled between the minimum and
+        maximum values of the image (see display_range)"""
+        if img.dtype == np.uint8:
+            return img
+        low, high = self.display_range()
+        if np.issubdtype(img.dtype, np.integer) and low >= 0 and high <= 255:
+            return np.clip(img, 0, 255).astype(np.uint8)
+        if img.dtype == np.uint16:
+            return (img >> 8).astype(np.uint8)
+        return cv2.convertScaleAbs(np.clip(img, low, high), alpha = 255/max(high - low, 1e-12),
+                                   beta = -255*low/max(high - low, 1e-12))
+
+    def read_field(self, roi_corners):
+        """ Read the bounding window of a polygon at full resolution and
+        black out what is outside the polygon
+
+        Input : 1
+            roi_corners : array of shape (1, n, 2)
+                polygon corners (x, y) in pixels of the full image
+
+        Outputs : 3
+            masked_image : array
+                bounding window of the polygon, with black pixels outside of
+                the polygon : 8 bits BGR image, or 8 bits gray image for
+                one-band images (see to_8bits)
+            y_window, x_window : int
+                position of the window top left corner in the full image
+        """
+        # bounding window of the polygon, inside the image
+        x0 = int(min(max(roi_corners[0, :, 0].min(), 0), self.width - 1))
+        y0 = int(min(max(roi_corners[0, :, 1].min(), 0), self.height - 1))
+        x1 = int(max(min(roi_corners[0, :, 0].max() + 1, self.width), x0 + 1))
+        y1 = int(max(min(roi_corners[0, :, 1].max() + 1, self.height), y0 + 1))
+        window = Window(x0, y0, x1 - x0, y1 - y0)
+        if self.count == 1:
+            img = self.to_8bits(self.read(1, window = window))
+        else:
+            # gray and alpha, RGB, RGBA... : 3 channels as cv2.imread gives
+            img = self.to_8bits(to_cv2(self.read(self.display_indexes, window = window)))
+        # make the mask in the window coordinates and apply it
+        mask = np.zeros(img.shape[:2], dtype = np.uint8)
+        cv2.fillPoly(mask, roi_corners - np.array([x0, y0], dtype = np.int32), (255,))
+        masked_image = cv2.bitwise_and(img, img, mask = mask)
+        return masked_image, y0, x0
+
+def to_cv2(bands):
+    """ Convert a rasterio array (bands, rows, columns) in RGB(A) order to an
+    OpenCV image (rows, columns, channels) in BGR(A) order, or a 2D array for
+    one-band images """
+    if bands.shape[0] == 1:
+        return bands[0]
+    img = np.moveaxis(bands, 0, -1)
+    if img.shape[2] >= 3:
+        img = np.concatenate((img[:, :, 2::-1], img[:, :, 3:]), axis = 2)
+    return np.ascontiguousarray(img)
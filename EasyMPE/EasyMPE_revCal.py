@@ -10,16 +10,432 @@ Reverse calculation code is based on Pix4D outputs and Pix4D explanations.
 ##################################### ENV #####################################
 ###############################################################################
 
+import csv
 import numpy as np
-import glob
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import rasterio
-import rasterstats as rs
+from rasterio import features, windows
+from rasterio.errors import WindowError
+import shapely
+from shapely.geometry import shape
+from shapely.strtree import STRtree
+from EasyMPE_progress import Progress
 
 ###############################################################################
 ##################################### CODE ####################################
 ###############################################################################
 
-def ReverseCalculation(folder, p4dProjFold, rawImgFold):
+# number of projected corners (pairs of plots and raw images x 4) computed at once
+CHUNK_SIZE = 2**20
+# size of the DSM tiles read at once
+TILE_SIZE = 2048
+# number of threads reading the size of the raw images
+IO_WORKERS = 8
+# number of best views of every plot written in reverse_cal_best_views.csv
+TOP_VIEWS = 3
+# weights of the view quality scores (distance to the principal point, area
+# of the plot in the image, view angle, margin to the image border)
+VIEW_WEIGHTS = {'center': 0.25, 'area': 0.25, 'angle': 0.25, 'margin': 0.25}
+
+def project_plots(corners, pmatrices):
+    '''Project the corners of plots in raw images, all at once
+    
+    Inputs : 2
+        corners : array of shape (..., 4, 4)
+            homogeneous coordinates (x, y, z, 1) of the 4 corners of the plots,
+            offset substracted
+        pmatrices : array of shape (..., 3, 4)
+            PMatrix of the raw images, broadcasted with the plots (e.g.
+            corners[:, None] and pmatrices[None] for all the pairs)
+    
+    Outputs : 2
+        uv : array of shape (..., 4, 2)
+            pixel coordinates (u, v) of every corner
+        valid : array of shape (...)
+            False if a corner could not be projected (no DSM value, corner
+            on the focal plane)'''
+    P = pmatrices[..., None, :, :]
+    X = corners[..., :, None, :]
+    # terms added one by one, in the order of the previous loop (same rounding)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        h = P[..., 0]*X[..., 0] + P[..., 1]*X[..., 1] + P[..., 2]*X[..., 2] + P[..., 3]*X[..., 3]
+        uv = h[..., :2]/h[..., 2:]
+        valid = np.isfinite(uv).all(axis = (-2, -1))
+        uv[~valid] = 0
+    return uv.astype(int), valid
+
+def camera_footprints(pmatrices, width, height, z_min, z_max):
+    '''Ground footprint of every raw image : the rays of the 4 corners of the
+    image cross the planes z_min and z_max, every point of the ground seen in
+    the image between these heights is in the convex hull of the 8 points.
+    
+    Inputs : 5
+        pmatrices : array of shape (m, 3, 4)
+            PMatrix of every raw image
+        width, height : arrays of int
+            size of every raw image
+        z_min, z_max : float
+            lowest and highest heights of the plots (offset substracted)
+    
+    Output : 1
+        footprints : array of m shapely Polygons or None
+            None when the footprint is not bounded (the horizon or the camera
+            itself is in the image, or singular PMatrix)'''
+    M, p4 = pmatrices[:, :, :3], pmatrices[:, :, 3]
+    footprints = np.full(len(pmatrices), None, dtype = object)
+    ok = np.abs(np.linalg.det(M)) > 1e-12
+    if not ok.any():
+        return footprints
+    M_inv = np.linalg.inv(M[ok])
+    # camera centers and directions of the rays of the image corners
+    centers = -np.einsum('mij,mj->mi', M_inv, p4[ok])
+    frame = np.zeros((ok.sum(), 4, 3))
+    frame[:, 1:3, 0] = width[ok, None]
+    frame[:, 2:, 1] = height[ok, None]
+    frame[:, :, 2] = 1
+    rays = np.einsum('mij,mkj->mki', M_inv, frame)
+    # the 4 rays must cross the planes on the same side of the camera
+    bounded = ((rays[:, :, 2] > 0).all(axis = 1) | (rays[:, :, 2] < 0).all(axis = 1)) \
+              & ((centers[:, 2] < z_min) | (centers[:, 2] > z_max))
+    z = np.array([z_min, z_max])
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        t = (z[None, :, None] - centers[:, None, None, 2])/rays[:, None, :, 2]
+    points = centers[:, None, None, :2] + t[..., None]*rays[:, None, :, :2]
+    hulls = shapely.convex_hull(shapely.multipoints(points[bounded].reshape((-1, 8, 2))))
+    footprints[np.flatnonzero(ok)[bounded]] = hulls
+    return footprints
+
+def candidate_pairs(corners, pmatrices, width, height, prune = True):
+    '''Pairs of plots and raw images to test : the plots crossing the
+    footprint of the image (STRtree of the footprints), or all the pairs if
+    prune is False. Plots without height are left out.
+    
+    Inputs : 5
+        corners : array of shape (n, 4, 4)
+            homogeneous coordinates of the corners of the plots
+        pmatrices : array of shape (m, 3, 4)
+            PMatrix of every raw image
+        width, height : arrays of int
+            size of every raw image
+        prune : bolean
+            if False, all the pairs are returned
+    
+    Outputs : 2
+        plots, images : arrays of int
+            plot and raw image of every pair, sorted plot by plot, then raw
+            image by raw image'''
+    known = np.flatnonzero(np.isfinite(corners[:, 0, 2]))
+    if not prune or len(known) == 0:
+        plots, images = np.meshgrid(known, np.arange(len(pmatrices)), indexing = 'ij')
+        return plots.ravel(), images.ravel()
+    z = corners[known, 0, 2]
+    footprints = camera_footprints(pmatrices, width, height, z.min(), z.max())
+    has_footprint = np.array([footprint is not None for footprint in footprints], bool)
+    bounded = np.flatnonzero(has_footprint)
+    # convex hull of the corners, whatever the order of the points
+    plot_hulls = shapely.convex_hull(shapely.multipoints(corners[known, :, :2]))
+    plots, images = STRtree(footprints[bounded]).query(plot_hulls, predicate = 'intersects')
+    plots, images = known[plots], bounded[images]
+    # images without footprint are tested with every plot
+    unbounded = np.flatnonzero(~has_footprint)
+    plots = np.concatenate((plots, np.repeat(known, len(unbounded))))
+    images = np.concatenate((images, np.tile(unbounded, len(known))))
+    order = np.lexsort((images, plots))
+    return plots[order], images[order]
+
+def plots_in_images(corners, pmatrices, width, height, prune = True, tracker = None):
+    '''Pixel coordinates of the plots in the raw images in which their
+    bounding box fits (see candidate_pairs for the pairs tested)
+    
+    Inputs : 6
+        see candidate_pairs
+        tracker : Progress object or None
+            progress of the chunks ('projection' stage) and cancellation
+    
+    Outputs : 3 (None if cancelled)
+        plots, images : arrays of int
+            plot and raw image of every pair, sorted plot by plot, then raw
+            image by raw image
+        uv : array of shape (k, 4, 2)
+            pixel coordinates of the 4 corners of the plot in the image'''
+    plots, images = candidate_pairs(corners, pmatrices, width, height, prune)
+    inside = np.zeros(len(plots), bool)
+    uv = np.zeros((len(plots), 4, 2), int)
+    # pairs are projected by chunks to bound the memory used
+    chunk = max(1, CHUNK_SIZE // 4)
+    for k in range(0, len(plots), chunk):
+        uv[k:k + chunk], valid = project_plots(corners[plots[k:k + chunk]], pmatrices[images[k:k + chunk]])
+        # get maximum and minimum coordinates
+        max_u, min_u = uv[k:k + chunk, :, 0].max(axis = 1), uv[k:k + chunk, :, 0].min(axis = 1)
+        max_v, min_v = uv[k:k + chunk, :, 1].max(axis = 1), uv[k:k + chunk, :, 1].min(axis = 1)
+        # if the calculated coordinates (bounding box) are in the image
+        inside[k:k + chunk] = valid & (0 < min_u) & (min_u < max_u) & (max_u < width[images[k:k + chunk]]) \
+                                    & (0 < min_v) & (min_v < max_v) & (max_v < height[images[k:k + chunk]])
+        if tracker is not None:
+            tracker.report('projection', min(k + chunk, len(plots)), len(plots))
+            if tracker.cancelled():
+                return None
+    return plots[inside], images[inside], uv[inside]
+
+def view_scores(corners, pmatrices, width, height, plots, images, uv):
+    '''Quality of the views of the plots in the raw images (see
+    plots_in_images), every score being in [0, 1], 1 for the best view
+    
+    Inputs : 7
+        corners, pmatrices, width, height : see candidate_pairs
+        plots, images, uv : see plots_in_images
+    
+    Outputs : 2
+        score : array of float
+            weighted sum of the scores (see VIEW_WEIGHTS)
+        scores : dict of arrays
+            'center' : 1 - distance of the plot center to the principal point
+                (relatively to the half diagonal of the image)
+            'area' : area of the plot in the image, relatively to its largest
+                area in all the images
+            'angle' : cosinus of the angle between the vertical and the line
+                from the plot center to the camera (1 for a nadir view)
+            'margin' : distance of the plot to the image border, relatively
+                to half the shorter side of the image (1 at most)'''
+    M, p4 = pmatrices[:, :, :3], pmatrices[:, :, 3]
+    # principal point (image of the principal axis) and camera center
+    principal = np.einsum('mij,mj->mi', M, M[:, 2])
+    principal = principal[:, :2]/principal[:, 2:]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        centers = -np.einsum('mij,mj->mi', np.linalg.pinv(M), p4)
+    scores = {}
+    w, h = width[images], height[images]
+    center_uv = uv.mean(axis = 1)
+    distance = np.hypot(*(center_uv - principal[images]).T)
+    scores['center'] = np.clip(1 - distance/np.hypot(w/2, h/2), 0, 1)
+    # shoelace formula
+    u, v = uv[:, :, 0].astype(float), uv[:, :, 1].astype(float)
+    area = np.abs((u*np.roll(v, -1, axis = 1) - np.roll(u, -1, axis = 1)*v).sum(axis = 1))/2
+    largest = np.zeros(len(corners))
+    np.maximum.at(largest, plots, area)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        scores['area'] = np.nan_to_num(area/largest[plots])
+    view = centers[images] - corners[plots, :, :3].mean(axis = 1)
+    scores['angle'] = np.clip(np.abs(view[:, 2])/np.linalg.norm(view, axis = 1), 0, 1)
+    margin = np.minimum(np.minimum(u.min(axis = 1), v.min(axis = 1)),
+                        np.minimum(w - u.max(axis = 1), h - v.max(axis = 1)))
+    scores['margin'] = np.clip(margin/(np.minimum(w, h)/2), 0, 1)
+    score = sum(VIEW_WEIGHTS[key]*scores[key] for key in VIEW_WEIGHTS)
+    return score, scores
+
+def best_views(plots, score, top_k = TOP_VIEWS):
+    '''Rank the views of every plot by decreasing score
+    
+    Inputs : 3
+        plots : array of int
+            plot of every view, sorted
+        score : array of float
+            score of every view (see view_scores)
+        top_k : int
+            number of views kept for every plot
+    
+    Outputs : 2
+        kept : array of int
+            index of the kept views, plot by plot, best view first
+        rank : array of int
+            rank of these views (0 : best view)'''
+    order = np.lexsort((-score, plots))
+    # position of every view among the views of its plot
+    first = np.searchsorted(plots[order], plots[order])
+    rank = np.arange(len(order)) - first
+    keep = rank < top_k
+    return order[keep], rank[keep]
+
+def plots_mean_z(polygons, DSM, tile = TILE_SIZE):
+    '''Mean value of the DSM in every plot, all the plots in one pass : the
+    plot numbers are rasterized on the DSM grid tile by tile and the values
+    are summed by plot. Only the tiles covering the plots are read. Same
+    pixels as rasterstats.zonal_stats (pixels centers), sums in 64 bits.
+    
+    Inputs : 3
+        polygons : list of dict
+            GeoJSON like polygons of the plots, in the CRS of the DSM
+        DSM : Path
+            absolute path to the DSM file
+        tile : int
+            size (pixels) of the tiles read at once
+    
+    Output : 1
+        mean_z : array of shape (n,)
+            mean of the valid pixels (centers) of every plot, nan if the plot
+            has no valid pixel'''
+    coords = [np.array(polygon['coordinates'][0], dtype = float) for polygon in polygons]
+    bounds = np.array([np.concatenate((c.min(axis = 0), c.max(axis = 0))) for c in coords]).reshape((-1, 4))
+    # plots touching each other are rasterized separately, a pixel being
+    # counted in every plot containing it
+    layers = plot_layers(polygons)
+    sums, counts = np.zeros(len(polygons) + 1), np.zeros(len(polygons) + 1)
+    with rasterio.open(DSM) as src:
+        # pixels covered by the extent of all the plots
+        extent = windows.from_bounds(*bounds[:, :2].min(axis = 0), *bounds[:, 2:].max(axis = 0),
+                                     transform = src.transform)
+        col_off, row_off = np.floor(extent.col_off), np.floor(extent.row_off)
+        extent = windows.Window(col_off, row_off, np.ceil(extent.col_off + extent.width) - col_off,
+                                np.ceil(extent.row_off + extent.height) - row_off)
+        try:
+            extent = extent.intersection(windows.Window(0, 0, src.width, src.height))
+        except WindowError:
+            # the plots are not on the DSM
+            return np.full(len(polygons), np.nan)
+        for row in range(int(extent.row_off), int(extent.row_off + extent.height), tile):
+            for col in range(int(extent.col_off), int(extent.col_off + extent.width), tile):
+                window = windows.Window(col, row, min(tile, extent.col_off + extent.width - col),
+                                        min(tile, extent.row_off + extent.height - row))
+                left, bottom, right, top = windows.bounds(window, src.transform)
+                # plots crossing the tile
+                inside = np.flatnonzero((bounds[:, 0] <= right) & (bounds[:, 2] >= left)
+                                        & (bounds[:, 1] <= top) & (bounds[:, 3] >= bottom))
+                if len(inside) == 0:
+                    continue
+                values = src.read(1, window = window)
+                valid = np.ones(values.shape, bool)
+                if src.nodata is not None:
+                    valid &= values != src.nodata
+                if np.issubdtype(values.dtype, np.floating):
+                    valid &= ~np.isnan(values)
+                for layer in np.unique(layers[inside]):
+                    # plot number + 1 of every pixel (0 : no plot)
+                    ids = features.rasterize(((polygons[k], k + 1) for k in inside[layers[inside] == layer]),
+                                             out_shape = values.shape, dtype = 'int32',
+                                             transform = windows.transform(window, src.transform))
+                    keep = valid & (ids > 0)
+                    sums += np.bincount(ids[keep], weights = values[keep], minlength = len(sums))
+                    counts += np.bincount(ids[keep], minlength = len(counts))
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return (sums/counts)[1:]
+
+def plot_layers(polygons):
+    '''Sort the plots in layers of plots not touching each other (greedy
+    coloring, a few layers for a grid of plots)
+    
+    Input : 1
+        polygons : list of dict
+            GeoJSON like polygons of the plots
+    
+    Output : 1
+        layers : array of int
+            layer of every plot'''
+    geoms = [shape(polygon) for polygon in polygons]
+    tree = STRtree(geoms)
+    layers = np.full(len(geoms), -1)
+    for k, geom in enumerate(geoms):
+        used = set(layers[tree.query(geom, predicate = 'intersects')])
+        layers[k] = min(set(range(len(used) + 1)) - used)
+    return layers
+
+def cached_mean_z(cache_file, geo_coords, polygons, DSM):
+    '''Mean value of the DSM in every plot (see plots_mean_z), saved in
+    'cache_file' and read again as long as the plots and the DSM are the same
+    
+    Inputs : 4
+        cache_file : Path
+            *.npz file keeping the results between two runs
+        geo_coords : array
+            georeferenced corners of the plots
+        polygons : list of dict
+            GeoJSON like polygons of the plots
+        DSM : Path
+            absolute path to the DSM file
+    
+    Output : 1
+        mean_z : array of shape (n,)'''
+    key = str(Path(DSM).resolve()), Path(DSM).stat().st_mtime_ns, Path(DSM).stat().st_size
+    if cache_file.exists():
+        try:
+            with np.load(cache_file) as cache:
+                if tuple(cache['key'].tolist()) == tuple(str(k) for k in key) \
+                   and np.array_equal(cache['geo_coords'], geo_coords):
+                    return cache['mean_z']
+        except (OSError, KeyError, ValueError):
+            # unreadable cache, computed again
+            pass
+    mean_z = plots_mean_z(polygons, DSM)
+    np.savez(cache_file, key = np.array([str(k) for k in key]), geo_coords = geo_coords, mean_z = mean_z)
+    return mean_z
+
+def read_size(path):
+    '''Width and height of an image (open does not load the image into memory)'''
+    with rasterio.open(path, mode = "r") as src_raw_img:
+        return src_raw_img.width, src_raw_img.height
+
+def pix4d_sizes(p4dProjFold):
+    '''Width and height of the raw images written by Pix4D in the calibrated
+    camera parameters file (lines 'image_name width height'), if any
+    
+    Input : 1
+        p4dProjFold : Path
+            Pix4D project folder
+    
+    Output : 1
+        sizes : dict
+            (width, height) of every raw image name'''
+    sizes = {}
+    for params in sorted(p4dProjFold.glob('1_initial/params/*calibrated_camera_parameters*.txt')):
+        with open(params) as f:
+            for line in f:
+                items = line.split()
+                if len(items) == 3 and items[1].isdigit() and items[2].isdigit():
+                    try:
+                        # lines of numbers (K matrix, distortion...) are not images
+                        float(items[0])
+                    except ValueError:
+                        sizes[items[0]] = int(items[1]), int(items[2])
+    return sizes
+
+def raw_images_size(names, rawImgFold, p4dProjFold, cache_file, workers = IO_WORKERS):
+    '''Width and height of the raw images, taken in order from the cache file,
+    from the Pix4D camera parameters, or read in the images themselves (a pool
+    of threads reads them at the same time). The cache file is updated.
+    
+    Inputs : 5
+        names : list of str
+            names of the raw images
+        rawImgFold : Path
+            absolute path to the folder containing raw drone images
+        p4dProjFold : Path
+            Pix4D project folder
+        cache_file : Path
+            csv file keeping the sizes between two runs (path, width, height)
+        workers : int
+            number of threads reading the images
+    
+    Outputs : 2
+        width, height : arrays of int'''
+    paths = [str(Path(rawImgFold).resolve() / name) for name in names]
+    sizes = {}
+    if cache_file.exists():
+        try:
+            with open(cache_file, newline = '') as f:
+                sizes = {line[0]: (int(line[1]), int(line[2])) for line in csv.reader(f) if len(line) == 3}
+        except (OSError, ValueError):
+            # unreadable cache, sizes are read again
+            sizes = {}
+    missing = [k for k, path in enumerate(paths) if path not in sizes]
+    if missing:
+        from_pix4d = pix4d_sizes(p4dProjFold)
+        for k in missing:
+            if names[k] in from_pix4d:
+                sizes[paths[k]] = from_pix4d[names[k]]
+        to_read = [paths[k] for k in missing if paths[k] not in sizes]
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            sizes.update(zip(to_read, pool.map(read_size, to_read)))
+        try:
+            with open(cache_file, 'w', newline = '') as f:
+                csv.writer(f).writerows([path, w, h] for path, (w, h) in sorted(sizes.items()))
+        except OSError:
+            # read-only project, nothing is kept
+            pass
+    width, height = np.array([sizes[path] for path in paths], dtype = int).reshape((-1, 2)).T
+    return width, height
+
+def ReverseCalculation(folder, p4dProjFold, rawImgFold, top_k = TOP_VIEWS, progress = None,
+                       cancel = None, stats = None):
     '''Used in "Application" from the class "MainWindow" of MPE_MAIN.py
     Contains all the code to reverse calculate the images
     
@@ -34,88 +450,98 @@ def ReverseCalculation(folder, p4dProjFold, rawImgFold):
     PMat : Path
         absolute path to the PMatrix file
     rawImgFold : Path
-        absolute path to the folder containing raw drone images'''
+        absolute path to the folder containing raw drone images
+    top_k : int
+        number of best views of every plot written in
+        reverse_cal_best_views.csv
+    progress : function or None
+        called as progress(stage, done, total) after every stage and every
+        chunk of projected plots
+    cancel : threading.Event or None
+        the run stops at the next stage or chunk once it is set
+    stats : dict or None
+        filled with the time (s) of every stage ('timings')
     
+    Output : 1
+    csv_file : Path or None
+        reverse_cal_outputs.csv, None if the run has been cancelled'''
+    
+    tracker = Progress(progress, cancel, stats)
+
     # get corners' coordinates files
     csv_georef = folder / 'Intersection_points_georeferenced.csv'
     
     # read the coordinates file
-    geo_coords = np.loadtxt(csv_georef, dtype = float, delimiter = ',', skiprows = 1)
+    geo_coords = np.loadtxt(csv_georef, dtype = float, delimiter = ',', skiprows = 1, ndmin = 2)
     coords_id = np.array(geo_coords)[:, :2].astype(int)
+    # plots polygons (closed)
+    polygons = [{'type': 'Polygon', 'coordinates': [pts.reshape((-1, 2)).tolist()]} for pts in geo_coords[:, 2:]]
     geo_coords = np.array(geo_coords)[:,2:10]
     
     # get Pix4d output files
-    offset = glob.glob(str(p4dProjFold) +  '\\1_initial\\params\\*offset*')[0]
-    PMat = glob.glob(str(p4dProjFold) +  '\\1_initial\\params\\*pmatrix*')[0]
-    DSM = glob.glob(str(p4dProjFold) +  '\\3_dsm_ortho\\1_dsm\\*dsm.tif')[0]
+    p4dProjFold = Path(p4dProjFold)
+    offset = sorted(p4dProjFold.glob('1_initial/params/*offset*'))[0]
+    PMat = sorted(p4dProjFold.glob('1_initial/params/*pmatrix*'))[0]
+    DSM = sorted(p4dProjFold.glob('3_dsm_ortho/1_dsm/*dsm.tif'))[0]
 
     # read the offset file
     offset_x, offset_y, offset_z = np.loadtxt(offset, dtype = float)
     
     # read PMatrix file
-    PMatrix_nb = np.loadtxt(PMat, dtype = float, delimiter = None, usecols = (1,2,3,4,5,6,7,8,9,10,11,12,))
-    PMatrix_names = np.loadtxt(PMat, dtype = str, delimiter = None, usecols = 0)
+    PMatrix_nb = np.loadtxt(PMat, dtype = float, delimiter = None, usecols = (1,2,3,4,5,6,7,8,9,10,11,12,), ndmin = 2)
+    PMatrix_names = np.loadtxt(PMat, dtype = str, delimiter = None, usecols = 0, ndmin = 1)
+    pmatrices = PMatrix_nb.reshape((-1, 3, 4))
+    
+    # get the mean value of z in every plot (nan if out of the DSM), computed
+    # once for the plots and the DSM of the folder
+    all_mean_z = cached_mean_z(folder / 'reverse_cal_mean_z.npz', geo_coords, polygons, DSM)
+    tracker.report('mean_z', 1, 1)
+    if tracker.end('mean_z'):
+        return None
+    
+    # size of every raw image, kept in the Pix4D project between two runs
+    width, height = raw_images_size(PMatrix_names, rawImgFold, p4dProjFold,
+                                    p4dProjFold / 'EasyMPE_raw_images_size.csv')
+    tracker.report('raw_images', 1, 1)
+    if tracker.end('raw_images'):
+        return None
+    
+    # homogeneous coordinates of the corners, offset substracted
+    corners = np.ones((len(coords_id), 4, 4))
+    corners[:, :, :2] = geo_coords.reshape((-1, 4, 2)) - (offset_x, offset_y)
+    corners[:, :, 2] = (all_mean_z - offset_z)[:, None]
+    
+    # plots and raw images in which they are, same order as before : plot by
+    # plot, then raw image by raw image
+    pairs = plots_in_images(corners, pmatrices, width, height, tracker = tracker)
+    if tracker.end('projection') or pairs is None:
+        return None
+    plots, images, uv = pairs
     
     # create the list summarizing all outputs
     output_list = []
-    
-    for k in range(len(coords_id)):
-        col, row = coords_id[k]
-        
-        # get the mean value of z in the considered shp
-        current_shp = folder / 'SHP_files' / str('Col_' + str(col).zfill(2) +'_row_' + str(row).zfill(2) +'.shp')
-        mean_z = rs.zonal_stats(str(current_shp), DSM, stats = 'mean')[0]['mean']
-        
-        # get the georeferenced points and organize them
-        all_geo_coords = geo_coords[k]
-        all_geo_coords = all_geo_coords.reshape((4, 2))
-        # substract the offset
-        all_geo_coords[:, 0] = all_geo_coords[:, 0] - offset_x
-        all_geo_coords[:, 1] = all_geo_coords[:, 1] - offset_y
-        # get the z values
-        z_coords = np.array([mean_z - offset_z]*4).reshape(4, 1)
-        # concatenate all the needed coordinates
-        all_geo_coords = np.concatenate((all_geo_coords, z_coords, np.ones((4, 1))), axis = 1)
-                
-        for name in range(len(PMatrix_names)):
-            current_coord = []
-            
-            # get the PMatrix values from the designated file for a particular
-            # raw image
-            pmat = PMatrix_nb[name].reshape((3,4))  
-            
-            # apply the PMatrix
-            new_coord = pmat*[coord.reshape((1,4)) for coord in all_geo_coords]
-            
-            # get all 4 corners pixel coordinates
-            for c in new_coord :
-                new_x, new_y, new_z = sum(c[0]), sum(c[1]), sum(c[2])
-                u, v = int(new_x / new_z), int(new_y / new_z)
-                current_coord.append((u, v))
-            current_coord = np.array(current_coord)
-            # get maximum and minimum coordinates
-            max_u, min_u = np.max(current_coord[:, 0]), np.min(current_coord[:, 0])
-            max_v, min_v = np.max(current_coord[:, 1]), np.min(current_coord[:, 1])
-    
-        	# build up the next 
-            current_img = rawImgFold / PMatrix_names[name]
-            # open the original image (open does not load the image into memory)
-            src_raw_img = rasterio.open(current_img, mode = "r")
-            # if the calculated coordinates (bounding box) are in the image
-            if 0 < min_u < max_u < src_raw_img.width and 0 < min_v < max_v < src_raw_img.height :
-     	    # get all the needed info in separate elements of the list
-                current_tmp = [col, row, PMatrix_names[name]] + [item for sublist in current_coord for item in sublist]
-                # add it to the general list that will later be saved
-                output_list.append(current_tmp)
-                src_raw_img.close()
-            # if not, then move to the next raw image
-            else :
-                src_raw_img.close()
-                pass
+    for plot, name, points in zip(plots, images, uv):
+        col, row = coords_id[plot]
+        # get all the needed info in separate elements of the list
+        output_list.append([col, row, PMatrix_names[name]] + points.ravel().tolist())
             
     # create output file and save it as csv
     csv_file = folder / 'reverse_cal_outputs.csv'
     np.savetxt(csv_file, output_list, delimiter = ',', newline='\n', header = 'Column,Row,raw_img,pt1_u,pt1_v,pt2_u,pt2_v,pt3_u,pt3_v,pt4_u,pt4_v', comments = '', fmt='%s')
     
+    # best views of every plot, so that only these raw images are cropped
+    score, scores = view_scores(corners, pmatrices, width, height, plots, images, uv)
+    kept, rank = best_views(plots, score, top_k)
+    best_list = []
+    for k, r in zip(kept, rank):
+        col, row = coords_id[plots[k]]
+        best_list.append([col, row, r + 1, PMatrix_names[images[k]], '%.4f' % score[k]]
+                         + ['%.4f' % scores[key][k] for key in VIEW_WEIGHTS] + uv[k].ravel().tolist())
+    np.savetxt(folder / 'reverse_cal_best_views.csv', best_list, delimiter = ',', newline='\n',
+               header = 'Column,Row,rank,raw_img,score,center,area,angle,margin,pt1_u,pt1_v,pt2_u,pt2_v,pt3_u,pt3_v,pt4_u,pt4_v',
+               comments = '', fmt='%s')
+    tracker.report('best_views', 1, 1)
+    tracker.end('best_views')
+    
     # return the csv file name
     return (csv_file)
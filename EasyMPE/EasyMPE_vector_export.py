@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+2019, L. Tresch for University of Tokyo, Field Phenomics Research Laboratory
+Please read the read_me.txt for furter information.
+Annex code to MPE_main.py
+
+Export of the plots polygons : all the plots are written in one pass to one
+layer (GeoPackage or FlatGeobuf, both with a spatial index), and to the
+legacy shapefiles only if asked.
+"""
+###############################################################################
+##################################### ENV #####################################
+###############################################################################
+
+import fiona, shapefile
+
+###############################################################################
+#################################### CODE #####################################
+###############################################################################
+
+# file extension of the supported formats
+EXTENSIONS = {'GPKG': '.gpkg', 'FlatGeobuf': '.fgb'}
+# attributes of every plot, same as the legacy *.shp files
+SCHEMA = {'geometry': 'Polygon', 'properties': {'Col_nb': 'int', 'Row_nb': 'int'}}
+
+class PlotWriter:
+    """ Streaming writer of the plots polygons. \n
+    Polygons are written as they come to 'All_plots.gpkg' (or '.fgb') ;
+    'All_plots.shp' and one *.shp per plot ('SHP_files' folder, as the
+    previous versions did) are only written if asked."""
+
+    def __init__(self, folder, driver = 'GPKG', crs = None, legacy_shp = False,
+                 plot_shp_folder = None):
+        """
+        Inputs : 5
+            folder : Path object
+                folder in which the files are saved
+            driver : str
+                'GPKG' or 'FlatGeobuf'
+            crs : CRS object or None
+                CRS of the coordinates (None if the image is not georeferenced)
+            legacy_shp : bolean
+                if True, All_plots.shp is also written
+            plot_shp_folder : Path object or None
+                if given, one *.shp per plot is written in this folder
+        """
+        if driver not in EXTENSIONS:
+            raise ValueError('Unknown vector format: ' + str(driver))
+        self.path = folder / str('All_plots' + EXTENSIONS[driver])
+        self.plot_shp_folder = plot_shp_folder
+        if self.path.exists():
+            self.path.unlink()
+        # the GDAL drivers make the spatial index when the layer is closed
+        self.layers = [fiona.open(self.path, 'w', driver = driver, schema = SCHEMA,
+                                  crs = crs, layer = 'plots')]
+        if legacy_shp:
+            self.layers.append(fiona.open(folder / 'All_plots.shp', 'w', driver = 'ESRI Shapefile',
+                                          schema = SCHEMA, crs = crs))
+        self.nb = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, nbCol, nbRow, points):
+        """ Write one plot
+
+        Inputs : 3
+            nbCol, nbRow : str or int
+                column and row numbers of the plot
+            points : list of tuples
+                corners of the plot, clockwise, the first point being
+                repeated at the end (closed polygon)
+        """
+        record = {'geometry': {'type': 'Polygon', 'coordinates': [points]},
+                  'properties': {'Col_nb': int(nbCol), 'Row_nb': int(nbRow)}}
+        for layer in self.layers:
+            layer.write(record)
+        if self.plot_shp_folder is not None:
+            make_shp(self.plot_shp_folder, nbCol, nbRow, points)
+        self.nb += 1
+
+    def close(self):
+        for layer in self.layers:
+            layer.close()
+        self.layers = []
+
+def make_shp(folder, nbCol, nbRow, points):
+    '''Is used in "get the rows" part of the class "Cluster Window"
+    Makes *.shp files according to inputted points in a CLOCKWISE order
+
+    Inputs : 4
+        folder : path object
+            Absolute path to the folder where to save the *.shp
+        nbCol : int
+            number of the considered column (used in the file names)
+        nbRow : int
+            number of the considered row (used in the file names)
+        points : list of tuple-elements
+            points used to define the polygon area, closed
+
+    Outputs : none
+    '''
+    #get the saving name of the file
+    save_path = folder / str('Col_' + str(nbCol) + '_row_' + str(nbRow) + '.shp')
+    # write a new shp file as a polygon shape
+    w = shapefile.Writer(str(save_path), shapeType = 5)
+    # make the geometry out of the points list
+    w.poly([points])
+    # fields definition :
+    # column number field
+    w.field('Col_nb','N', '40')
+    # row number field
+    w.field('Row_nb','N', '40')
+    # save values into fields
+    w.record(int(nbCol), int(nbRow))
+    # close the *.shp, thus saving it
+    w.close()
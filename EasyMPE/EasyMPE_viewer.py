@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+2019, L. Tresch for University of Tokyo, Field Phenomics Research Laboratory
+Please read the read_me.txt for furter information.
+Annex code to MPE_main.py
+
+Zoomable viewer of the main window, used to draw the field and to review the
+binary. The image is shown as a pyramid of tiles (every level halves the
+resolution) : only the tiles of the visible part, at the level of the zoom,
+are read, and the last read tiles are kept in a LRU cache. The memory used
+does not depend on the size of the image, and the whole image is never
+decoded. The tiles are read on a pool of threads, a dark placeholder being
+shown until they arrive, so that the GUI does not wait for the disk. The
+scene is in pixels of the full resolution image, so that the field corners
+are placed at full precision.
+"""
+###############################################################################
+##################################### ENV #####################################
+###############################################################################
+
+import math, traceback
+from collections import OrderedDict
+import numpy as np, cv2
+from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGraphicsPathItem
+from PyQt5.QtGui import QImage, QPixmap, QPainter, QPainterPath, QPen, QColor, QPolygonF
+from PyQt5.QtCore import Qt, QPointF, QRectF, QRunnable, QThreadPool, pyqtSignal
+
+###############################################################################
+#################################### CODE #####################################
+###############################################################################
+
+# size (px) of the tiles
+TILE_SIZE = 256
+# number of tiles kept in memory (about 50 MB of BGR tiles)
+CACHE_TILES = 256
+# number of threads reading the tiles
+READ_THREADS = 2
+# color of a tile not read yet
+PLACEHOLDER_COLOR = QColor(40, 40, 40)
+# zoom of the wheel
+ZOOM_STEP = 1.25
+# a press moved by less than this (screen px) is a click, not a pan
+CLICK_DISTANCE = 4
+
+class TileViewer(QGraphicsView):
+    """ Viewer of a field image (FieldRaster) or of an image in memory. \n
+    Mouse wheel : zoom. Drag : pan. (F)it : whole image. \n
+    In the drawing mode (start_drawing), every click adds a corner of the
+    field ; (R)estart clears the corners, (Q)uit and (D)one emit the signals
+    cancelled and drawn (with the corners in full resolution pixels). \n
+    In the review mode (start_review), (A)ccept and (R)etry emit the signals
+    accepted and retried."""
+    drawn = pyqtSignal(list)
+    cancelled = pyqtSignal()
+    accepted = pyqtSignal()
+    retried = pyqtSignal()
+    # tile read by a TileReader (key, QImage, None if it was not read)
+    tile_read = pyqtSignal(tuple, object)
+
+    def __init__(self, parent = None, tile_size = TILE_SIZE, cache_tiles = CACHE_TILES):
+        super(TileViewer, self).__init__(parent)
+        self.tile_size = tile_size
+        self.cache_tiles = cache_tiles
+        self.tiles = OrderedDict()
+        self.items = {}
+        # tiles being read, and tiles of the visible part
+        self.pending = set()
+        self.wanted = set()
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(READ_THREADS)
+        self.tile_read.connect(self.tile_arrived)
+        self.read_tile = None
+        self.img_width = self.img_height = 0
+        self.unit = 1
+        self.levels = 1
+        self.source = 0
+        self.mode = None
+        self.points = []
+        self.press = None
+        self.setScene(QGraphicsScene(self))
+        self.setDragMode(QGraphicsView.ScrollHandDrag)
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+        self.setRenderHint(QPainter.SmoothPixmapTransform)
+        self.setBackgroundBrush(QColor(0, 0, 0))
+        self.setFocusPolicy(Qt.StrongFocus)
+        # corners of the field, over the tiles
+        self.outline = QGraphicsPathItem()
+        pen = QPen(QColor(255, 0, 255), 2)
+        pen.setCosmetic(True)
+        self.outline.setPen(pen)
+        self.outline.setZValue(1)
+        self.scene().addItem(self.outline)
+
+    def set_raster(self, field_raster):
+        """ Show a field image, read tile by tile (see FieldRaster.read_tile)"""
+        self.set_source(field_raster.width, field_raster.height, field_raster.read_tile)
+
+    def set_array(self, img, unit = 1):
+        """ Show an image in memory (BGR or gray), one of its pixels being
+        'unit' pixels of the scene (i.e. of the full resolution image)"""
+        def read_tile(level, row, col, size):
+            step = 2**level
+            tile = img[row*size*step:(row + 1)*size*step, col*size*step:(col + 1)*size*step]
+            if step == 1:
+                return tile
+            h, w = tile.shape[:2]
+            return cv2.resize(tile, (max(1, -(-w//step)), max(1, -(-h//step))),
+                              interpolation = cv2.INTER_AREA)
+        self.set_source(img.shape[1], img.shape[0], read_tile, unit)
+
+    def set_source(self, width, height, read_tile, unit = 1):
+        """ Show any image given by a function reading its tiles
+
+        Inputs : 4
+            width, height : int
+                size of the image
+            read_tile : function
+                read_tile(level, row, col, size) gives the tile as an 8 bits
+                BGR or gray array (see FieldRaster.read_tile)
+            unit : int
+                size of one pixel of the image in the scene
+        """
+        for item in self.items.values():
+            self.scene().removeItem(item)
+        self.items.clear()
+        self.tiles.clear()
+        # the reads of the previous image still running are dropped at their
+        # arrival (see tile_arrived)
+        self.pending.clear()
+        self.wanted = set()
+        # the tiles of the previous image are never mixed with the new ones
+        self.source += 1
+        self.img_width, self.img_height, self.read_tile, self.unit = width, height, read_tile, unit
+        self.levels = max(1, math.ceil(math.log2(max(width, height, 1)/self.tile_size)) + 1)
+        self.scene().setSceneRect(QRectF(0, 0, width*unit, height*unit))
+        self.fit()
+
+    def fit(self):
+        """ Zoom out to see the whole image"""
+        self.fitInView(self.scene().sceneRect(), Qt.KeepAspectRatio)
+        self.update_tiles()
+        self.update_outline()
+
+    def start_drawing(self):
+        self.mode = 'draw'
+        self.points = []
+        self.update_outline()
+        self.setFocus()
+
+    def start_review(self):
+        self.mode = 'review'
+        self.points = []
+        self.update_outline()
+        self.setFocus()
+
+    def stop(self):
+        self.mode = None
+
+    ## tiles
+
+    def update_tiles(self):
+        """ Show the tiles of the visible part of the image, at the level of
+        the zoom, and remove the other ones from the scene"""
+        if self.read_tile is None:
+            return
+        # image pixels per screen pixel
+        zoom = self.transform().m11()*self.unit
+        level = min(max(int(math.floor(math.log2(1/zoom))), 0) if zoom > 0 else 0, self.levels - 1)
+        span = self.tile_size*2**level
+        visible = self.mapToScene(self.viewport().rect()).boundingRect()
+        col0 = max(int(visible.left()/self.unit//span), 0)
+        row0 = max(int(visible.top()/self.unit//span), 0)
+        col1 = min(int(visible.right()/self.unit//span), (self.img_width - 1)//span)
+        row1 = min(int(visible.bottom()/self.unit//span), (self.img_height - 1)//span)
+        wanted = {(self.source, level, row, col) for row in range(row0, row1 + 1)
+                  for col in range(col0, col1 + 1)}
+        # a new set, the readers check it from their threads
+        self.wanted = wanted
+        for key in list(self.items):
+            if key not in wanted:
+                self.scene().removeItem(self.items.pop(key))
+        for key in wanted:
+            if key in self.items:
+                continue
+            _, _, row, col = key
+            item = QGraphicsPixmapItem(self.tile(key))
+            item.setPos(col*span*self.unit, row*span*self.unit)
+            item.setScale(2**level*self.unit)
+            item.setTransformationMode(Qt.SmoothTransformation if level else Qt.FastTransformation)
+            self.scene().addItem(item)
+            self.items[key] = item
+
+    def tile(self, key):
+        """ Tile from the LRU cache, or a placeholder of the size of the tile
+        while it is read in the background (see tile_arrived)"""
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+        _, level, row, col = key
+        if key not in self.pending:
+            self.read_later(key)
+        span = self.tile_size*2**level
+        w = min(span, self.img_width - col*span)
+        h = min(span, self.img_height - row*span)
+        placeholder = QPixmap(max(1, -(-w//2**level)), max(1, -(-h//2**level)))
+        placeholder.fill(PLACEHOLDER_COLOR)
+        return placeholder
+
+    def tile_arrived(self, key, image):
+        """ Connected to tile_read : keep the tile in the LRU cache and show
+        it if it is still visible"""
+        if key not in self.pending:
+            # tile of a previous image
+            return
+        self.pending.discard(key)
+        if image is None:
+            # not visible anymore when its turn came, but visible again
+            if key in self.items:
+                self.read_later(key)
+            return
+        if image.isNull():
+            # not readable, the placeholder stays
+            return
+        self.tiles[key] = QPixmap.fromImage(image)
+        if len(self.tiles) > self.cache_tiles:
+            self.tiles.popitem(last = False)
+        if key in self.items:
+            self.items[key].setPixmap(self.tiles[key])
+
+    def read_later(self, key):
+        """ Read a tile on the pool of threads"""
+        self.pending.add(key)
+        self.pool.start(TileReader(key, self.read_tile, self.tile_size, self))
+
+    ## events
+
+    def wheelEvent(self, event):
+        factor = ZOOM_STEP if event.angleDelta().y() > 0 else 1/ZOOM_STEP
+        self.scale(factor, factor)
+        self.update_tiles()
+        self.update_outline()
+
+    def scrollContentsBy(self, dx, dy):
+        super(TileViewer, self).scrollContentsBy(dx, dy)
+        self.update_tiles()
+
+    def resizeEvent(self, event):
+        super(TileViewer, self).resizeEvent(event)
+        self.update_tiles()
+
+    def mousePressEvent(self, event):
+        self.press = event.pos()
+        super(TileViewer, self).mousePressEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        super(TileViewer, self).mouseReleaseEvent(event)
+        if self.press is None or event.button() != Qt.LeftButton:
+            return
+        moved = (event.pos() - self.press).manhattanLength()
+        self.press = None
+        if self.mode == 'draw' and moved < CLICK_DISTANCE:
+            point = self.mapToScene(event.pos())
+            # full resolution pixel, inside the image
+            x = min(max(int(point.x()), 0), self.img_width*self.unit - 1)
+            y = min(max(int(point.y()), 0), self.img_height*self.unit - 1)
+            self.points.append((x, y))
+            self.update_outline()
+
+    def keyPressEvent(self, event):
+        key = event.text().lower()
+        if self.mode == 'draw':
+            if key == 'r':
+                self.points = []
+                self.update_outline()
+            elif key == 'q':
+                self.mode = None
+                self.points = []
+                self.update_outline()
+                self.cancelled.emit()
+            elif key == 'd':
+                self.drawn.emit(list(self.points))
+        elif self.mode == 'review':
+            if key == 'a':
+                self.mode = None
+                self.accepted.emit()
+            elif key == 'r':
+                self.mode = None
+                self.retried.emit()
+        if key == 'f':
+            self.fit()
+        super(TileViewer, self).keyPressEvent(event)
+
+    def update_outline(self):
+        """ Draw the clicked corners, linked in the order of the clicks and
+        closed by the last line"""
+        path = QPainterPath()
+        if self.points:
+            path.addPolygon(QPolygonF([QPointF(x, y) for x, y in self.points + self.points[:1]]))
+            # a mark on every corner, of a constant size on the screen
+            radius = 4/max(self.transform().m11(), 1e-12)
+            for x, y in self.points:
+                path.addEllipse(QPointF(x, y), radius, radius)
+        self.outline.setPath(path)
+
+class TileReader(QRunnable):
+    """ Reads one tile of a TileViewer in a thread of its pool and sends it
+    with the signal tile_read of the viewer. The tiles which are not visible
+    anymore when their turn comes are not read."""
+
+    def __init__(self, key, read_tile, size, viewer):
+        super(TileReader, self).__init__()
+        self.key, self.read_tile, self.size = key, read_tile, size
+        self.viewer = viewer
+
+    def run(self):
+        image = None
+        _, level, row, col = self.key
+        if self.key in self.viewer.wanted:
+            try:
+                image = to_qimage(self.read_tile(level, row, col, self.size))
+            except Exception:
+                traceback.print_exc()
+                image = QImage()
+        self.viewer.tile_read.emit(self.key, image)
+
+def to_qimage(tile):
+    """ QImage of a 8 bits BGR, BGRA or gray array (a QImage, unlike a
+    QPixmap, can be made out of the GUI thread)"""
+    if tile.ndim == 3:
+        tile = cv2.cvtColor(tile, cv2.COLOR_BGRA2RGB if tile.shape[2] == 4 else cv2.COLOR_BGR2RGB)
+    tile = np.ascontiguousarray(tile)
+    h, w = tile.shape[:2]
+    image_format = QImage.Format_Grayscale8 if tile.ndim == 2 else QImage.Format_RGB888
+    # the copy owns its data, the array can be freed
+    return QImage(tile.data, w, h, tile.strides[0], image_format).copy()
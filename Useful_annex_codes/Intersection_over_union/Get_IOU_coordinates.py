@@ -4,49 +4,113 @@ Created on Sun Jan  6 12:23:21 2019
 
 @author: leatr
 
-get the 4 coordinates of the MPE microplots (to use on the folder
-“Plot_rows_original_whole” i.e. with a black background of the whole image) by
-opening the image and finding a bounding box.
+get the 4 coordinates of the MPE microplots, written as (y, x) pixels in a
+text file for IOU_ratio.py:
+    - from the EasyMPE output folder: the corners are read in
+    Intersection_points_non_georeferenced.csv (no image is opened). They are in
+    the pixels of the whole field image; set 'offset' to get them in the
+    pixels of the Plot_rows_original_whole images.
+    - from a folder of images with a black background of the whole image
+    (i.e. “Plot_rows_original_whole”): the 4 extreme points of the plot are
+    found in the bounding box of its non-zero pixels only.
 """
 ###############################################################################
 #################################### ENV ######################################
 ###############################################################################
 
-import os, cv2, numpy as np
+import cv2, numpy as np
 from pathlib import Path
 
 ###############################################################################
 ################################## INPUTS #####################################
 ###############################################################################
-# micro plots folder
-folder = Path(r'D:/LEA/2017MEMURO_sugarbeat_production/IOU/Program_made_plots')
+# EasyMPE output folder or micro plots images folder
+folder = Path(r'D:/LEA/2017MEMURO_sugarbeat_production/Micro_plots_sugarbeat_production_memuro_20170616_Ins1X5RAW_30m_transparent_mosaic_group1')
 # handmade or program?
 TYPE = 'program_made_LATEST'
 # folder where the txt file will be saved
 main_folder = Path(r'D:/LEA/2017MEMURO_sugarbeat_production/IOU')
+# (x, y) pixels substracted to the corners read in the EasyMPE outputs, i.e.
+# the top left corner of the field drawn in the image ((0, 0) to keep the
+# pixels of the whole field image)
+offset = (0, 0)
 
 ###############################################################################
 ################################### CODE ######################################
 ###############################################################################
 
-nb = 0
-print(main_folder)
-print(TYPE)
-with open(main_folder / str('coordinates_' + TYPE + '.txt'), 'w') as f:
-    for k in os.listdir(folder):
-        if not '.tiff' in k:
-            pass
-        img = cv2.imread(str(folder / k))
-        coords = np.argwhere(img)
-        y0, x0, z = coords.min(axis = 0)
-        y1, x1, z = coords.max(axis = 0)
-        c = np.where(coords[:,1] == x0)
-        y_xmin, x_xmin = coords[int(c[0][0])][0], x0
-        c = np.where(coords[:,1] == x1)
-        y_xmax, x_xmax = coords[int(c[0][-1])][0], x1
-        c = np.where(coords[:, 0] == y0)
-        y_ymin, x_ymin = y0, coords[int(c[0][0])][1]
-        c = np.where(coords[:, 0] == y1)
-        y_ymax, x_ymax = y1, coords[int(c[0][-1])][1]
-        f.write(str(nb) + ' ; ' + str([(y_ymin, x_ymin), (y_xmax, x_xmax), (y_ymax, x_ymax), (y_xmin, x_xmin)]) + '\n')
-        nb += 1
\ No newline at end of file
+def corners_from_outputs(folder, offset = (0, 0)):
+    '''Corners of all the plots, read in the EasyMPE outputs
+
+    Inputs : 2
+        folder : Path
+            EasyMPE output folder
+        offset : tuple
+            (x, y) pixels substracted to the corners
+
+    Outputs : 2
+        names : list of str
+            Col_00_row_00 name of every plot
+        corners : array of shape (n, 4, 2)
+            (y, x) of the corners of every plot, the highest one first and
+            then clockwise (same order as corners_from_image)'''
+    csv_file = folder / 'Intersection_points_non_georeferenced.csv'
+    coords = np.loadtxt(csv_file, dtype = float, delimiter = ',', skiprows = 1, ndmin = 2)
+    names = [str('Col_' + str(int(c)).zfill(2) + '_row_' + str(int(r)).zfill(2)) for c, r in coords[:, :2]]
+    points = coords[:, 2:10].reshape((-1, 4, 2))
+    # the y axis of the outputs goes up
+    x, y = points[:, :, 0] - offset[0], - points[:, :, 1] - offset[1]
+    # clockwise in the image (y going down) around the center of the plot
+    angle = np.arctan2(y - y.mean(axis = 1, keepdims = True), x - x.mean(axis = 1, keepdims = True))
+    order = np.argsort(angle, axis = 1)
+    x, y = np.take_along_axis(x, order, axis = 1), np.take_along_axis(y, order, axis = 1)
+    # highest corner first
+    first = np.argmin(y, axis = 1)[:, None]
+    order = (first + np.arange(4)) % 4
+    x, y = np.take_along_axis(x, order, axis = 1), np.take_along_axis(y, order, axis = 1)
+    return names, np.stack((y, x), axis = 2)
+
+def corners_from_image(path):
+    '''Extreme points of the non-zero pixels of an image
+
+    Input : 1
+        path : Path
+            image of the plot (black background)
+
+    Output : 1
+        corners : list of tuples or None
+            (y, x) of the highest, rightmost, lowest and leftmost points, None
+            if the image is empty'''
+    img = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        return None
+    if img.ndim == 3:
+        # non-zero in any channel
+        img = np.bitwise_or.reduce(cv2.split(img))
+    if cv2.countNonZero(img) == 0:
+        return None
+    # bounding box of the non-zero pixels, the points are searched in it only
+    x0, y0, w, h = cv2.boundingRect(img)
+    crop = img[y0:y0 + h, x0:x0 + w] != 0
+    # first pixel of the top row, last pixel of the right column...
+    top = (y0, x0 + np.argmax(crop[0]))
+    right = (y0 + h - 1 - np.argmax(crop[::-1, -1]), x0 + w - 1)
+    bottom = (y0 + h - 1, x0 + w - 1 - np.argmax(crop[-1, ::-1]))
+    left = (y0 + np.argmax(crop[:, 0]), x0)
+    return [tuple(int(v) for v in p) for p in (top, right, bottom, left)]
+
+if __name__ == '__main__':
+    print(main_folder)
+    print(TYPE)
+    with open(main_folder / str('coordinates_' + TYPE + '.txt'), 'w') as f:
+        if (folder / 'Intersection_points_non_georeferenced.csv').exists():
+            names, corners = corners_from_outputs(folder, offset)
+            for name, points in zip(names, corners):
+                f.write(name + ' ; ' + str([(round(float(y), 3), round(float(x), 3)) for y, x in points]) + '\n')
+        else:
+            for k in sorted(folder.iterdir()):
+                if k.suffix.lower() not in ('.tif', '.tiff', '.jpg', '.jpeg', '.png'):
+                    continue
+                points = corners_from_image(k)
+                if points is not None:
+                    f.write(k.stem + ' ; ' + str(points) + '\n')
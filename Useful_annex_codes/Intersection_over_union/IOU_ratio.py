@@ -4,23 +4,38 @@ Created on Sun Jan  6 09:03:21 2019
 
 @author: leatr
 
-calculate the Intersection Over Union ratio based on specific inputs
-Text file must have 8 columns as:
-    y_1, x_1, y_2, x_2, y_3, x_3, y_4, x_4
-which can be obtained by running:
-    - Get_IOU_coordinates.py over the Plot_original_whole folder of the EasyMPE
-    output
-    - get_coordinates_from_shp.py over the SHP_files folder of the EasyMPE output
-    (georeferenced coordinates will be outputted, which might be less precise as
-    the coordinates will not have decimals)
+calculate the Intersection Over Union ratio of the program made plots and of
+the handmade plots.
+Every set of plots can be:
+    - a text file with one plot per line written as:
+        id ; [(y_1, x_1), (y_2, x_2), (y_3, x_3), (y_4, x_4)]
+    which can be obtained by running:
+        - Get_IOU_coordinates.py over the EasyMPE output folder (or over the
+        Plot_original_whole folder)
+        - get_coordinates_from_shp.py over the SHP_files folder of the EasyMPE
+        output (georeferenced coordinates will be outputted, which might be
+        less precise as the coordinates will not have decimals)
+    - a vector file (All_plots.gpkg, *.shp...) or a folder of *.shp files
+Both sets must be in the same coordinates (pixels or CRS).
+
+The plots are matched by their position, not by the order of the files: the
+handmade plots crossing every program made plot are found with an STRtree and
+two plots are matched if each one is the best IOU of the other. All the IOU
+are computed at once with vectorized shapely functions.
+Two files are written: the IOU of every plot (unmatched plots included) and a
+summary (number of plots, of matched plots, mean and median IOU).
 """
 ###############################################################################
 #################################### ENV ######################################
 ###############################################################################
 
-from shapely.geometry import Polygon
+import ast, os, re
+from pathlib import Path
+import fiona
 import numpy as np
-from path import Path
+import shapely
+from shapely.geometry import shape
+from shapely.strtree import STRtree
 
 ###############################################################################
 ################################## INPUTS #####################################
@@ -28,40 +43,113 @@ from path import Path
 
 FIELDNAME = '2017_Memuro_production_LATEST'
 
-f_prog = open(r'D:/LEA/2017MEMURO_sugarbeat_production/IOU/coordinates_program_made_LATEST.txt', 'r')
-box_prog = f_prog.readlines()
-
-f_hand = open(r'D:/LEA/2017MEMURO_sugarbeat_production/IOU/coordinates_handmade_LATEST.txt', 'r')
-box_handmade = f_hand.readlines()
+# program made plots (text file, vector file or folder of *.shp files)
+prog_file = Path(r'D:/LEA/2017MEMURO_sugarbeat_production/IOU/coordinates_program_made_LATEST.txt')
+# handmade plots (text file, vector file or folder of *.shp files)
+hand_file = Path(r'D:/LEA/2017MEMURO_sugarbeat_production/IOU/coordinates_handmade_LATEST.txt')
+# folder where the results are saved
+save_folder = Path(r'D:\LEA\Semi_automatic_segmentation\IOU_results_and_codes')
 
 ###############################################################################
 #################################### CODE ######################################
 ###############################################################################
 
-def intersection_over_union(boxA, boxB):
-    # use coordinates to make a linear ring
-    a = Polygon(boxA)
-    b = Polygon(boxB)
-    # get the intersection of both box
-    inter = a.intersection(b).area
-    # and the union
-    union = a.union(b).area
-    #calculate the inter over union percent
-    iou = inter/union 
-    iou = "%.3f" % iou
-    # return
-    return (a.area, b.area, "%.3f" % inter, "%.3f" % union, iou)
-
-rows_csv = []
-for k in range(len(box_prog)):
-    boxA = eval(box_prog[k][:-1].split(' ; ')[1])
-    boxB = eval(box_handmade[k][:-1].split(' ; ')[1])
-    A_area, B_area, inter, union, iou = intersection_over_union(boxA, boxB)
-    values = [str(k), float(A_area), float(B_area), float(inter), float(union), float(iou)]
-    rows_csv.append(values)
-
-csvfile = Path(r'D:\LEA\Semi_automatic_segmentation\IOU_results_and_codes\iou_'+FIELDNAME+'.csv')
-np.savetxt(csvfile, rows_csv, delimiter = ';', newline='\n', header = 'Plot;Program_box_area;Handmade_box_area;Intersection;Union;IOU', comments = '', fmt='%s')
-
-f_prog.close()
-f_hand.close()
+def read_plots(path):
+    '''Read a set of plots
+
+    Input : 1
+        path : Path
+            text file, vector file or folder of *.shp files
+
+    Outputs : 2
+        ids : array of str
+            identificator of every plot (id of the text file, Col_00_row_00
+            if the plots have the EasyMPE attributes, name of the *.shp file
+            or number of the feature)
+        plots : array of shapely Polygons'''
+    ids, plots = [], []
+    if os.path.isdir(path):
+        for inshape in sorted(Path(path).glob('*.shp')):
+            with fiona.open(inshape) as layer:
+                for feature in layer:
+                    ids.append(inshape.stem)
+                    plots.append(shape(feature['geometry']))
+    elif Path(path).suffix.lower() == '.txt':
+        with open(path) as f:
+            for line in f:
+                if ';' not in line:
+                    continue
+                nb, points = line.split(';', 1)
+                # numpy scalars, as np.int64(3), are written as their value
+                points = re.sub(r'np\.\w+\(([^()]*)\)', r'\1', points)
+                ids.append(nb.strip())
+                plots.append(shapely.Polygon(ast.literal_eval(points.strip())))
+    else:
+        with fiona.open(path) as layer:
+            for nb, feature in enumerate(layer):
+                properties = dict(feature['properties'])
+                if 'Col_nb' in properties and 'Row_nb' in properties:
+                    ids.append(str('Col_' + str(properties['Col_nb']).zfill(2) +
+                                   '_row_' + str(properties['Row_nb']).zfill(2)))
+                else:
+                    ids.append(str(nb))
+                plots.append(shape(feature['geometry']))
+    return np.array(ids, dtype = str), np.array(plots, dtype = object)
+
+def match_plots(prog, hand):
+    '''Match the program made and handmade plots and compute their IOU
+
+    Inputs : 2
+        prog, hand : arrays of shapely Polygons
+            program made and handmade plots
+
+    Outputs : 4
+        i, j : arrays of int
+            indices of the matched program made and handmade plots
+        inter, union : arrays of float
+            areas of the intersection and of the union of the matched plots'''
+    # pairs of plots crossing each other
+    i, j = STRtree(hand).query(prog, predicate = 'intersects')
+    inter = shapely.area(shapely.intersection(prog[i], hand[j]))
+    union = shapely.area(prog[i]) + shapely.area(hand[j]) - inter
+    iou = inter/union
+    # a pair is kept if it is the best of both plots
+    best_prog = np.full(len(prog), -1.)
+    best_hand = np.full(len(hand), -1.)
+    np.maximum.at(best_prog, i, iou)
+    np.maximum.at(best_hand, j, iou)
+    keep = (iou > 0) & (iou == best_prog[i]) & (iou == best_hand[j])
+    i, j, inter, union = i[keep], j[keep], inter[keep], union[keep]
+    # ties : the first pair of every plot only
+    _, first = np.unique(i, return_index = True)
+    i, j, inter, union = i[first], j[first], inter[first], union[first]
+    _, first = np.unique(j, return_index = True)
+    return i[first], j[first], inter[first], union[first]
+
+if __name__ == '__main__':
+    prog_ids, prog = read_plots(prog_file)
+    hand_ids, hand = read_plots(hand_file)
+    i, j, inter, union = match_plots(prog, hand)
+    iou = inter/union
+
+    # IOU of every plot, unmatched plots at the end
+    rows_csv = [[prog_ids[a], hand_ids[b], '%.3f' % prog[a].area, '%.3f' % hand[b].area,
+                 '%.3f' % n, '%.3f' % u, '%.3f' % r] for a, b, n, u, r in zip(i, j, inter, union, iou)]
+    for a in np.setdiff1d(np.arange(len(prog)), i):
+        rows_csv.append([prog_ids[a], '', '%.3f' % prog[a].area, '', '', '', ''])
+    for b in np.setdiff1d(np.arange(len(hand)), j):
+        rows_csv.append(['', hand_ids[b], '', '%.3f' % hand[b].area, '', '', ''])
+    csvfile = save_folder / str('iou_' + FIELDNAME + '.csv')
+    np.savetxt(csvfile, rows_csv, delimiter = ';', newline='\n', header = 'Program_plot;Handmade_plot;Program_box_area;Handmade_box_area;Intersection;Union;IOU', comments = '', fmt='%s')
+
+    # summary
+    summary = [['Program_plots', len(prog)], ['Handmade_plots', len(hand)],
+               ['Matched_plots', len(i)], ['Unmatched_program_plots', len(prog) - len(i)],
+               ['Unmatched_handmade_plots', len(hand) - len(i)],
+               ['Mean_IOU', '%.3f' % iou.mean() if len(iou) else ''],
+               ['Median_IOU', '%.3f' % np.median(iou) if len(iou) else ''],
+               ['Min_IOU', '%.3f' % iou.min() if len(iou) else '']]
+    summaryfile = save_folder / str('iou_summary_' + FIELDNAME + '.csv')
+    np.savetxt(summaryfile, summary, delimiter = ';', newline='\n', header = 'Field;' + FIELDNAME, comments = '', fmt='%s')
+    print('IOU saved at: ' + str(csvfile))
+    print('Summary saved at: ' + str(summaryfile))
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+2019, L. Tresch for University of Tokyo, Field Phenomics Research Laboratory
+
+This code crops all the plots from all the raw drone images listed in the
+csv written by the reverse calculation of EasyMPE :
+- reverse_cal_outputs.csv (every raw image in which a plot is)
+- reverse_cal_best_views.csv (best views of every plot only)
+The csv should have the columns Column, Row, raw_img, pt1_u, pt1_v, pt2_u,
+pt2_v, pt3_u, pt3_v, pt4_u, pt4_v (',' or ';' separated).
+
+The rows are grouped by raw image: every image is decoded once (optionally at
+a reduced scale) and all its plots are cut on their bounding box, the pixels
+out of the plot being black. The plots can also be rectified (the plot is
+warped into a rectangle). Images are processed in parallel by a pool of
+processes.
+"""
+
+###############################################################################
+################################ ENVIRONMENT ##################################
+###############################################################################
+
+import csv, os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import cv2
+import numpy as np
+
+###############################################################################
+################################### INPUTS ####################################
+###############################################################################
+
+# folder with all the raw drone images
+raw_folder = Path(r'D:/LEA/2017MEMURO_sugarbeat_production/Raw_images')
+
+# csv file with the coordinates
+coord_file = Path(r'D:/LEA/2017MEMURO_sugarbeat_production/Micro_plots_sugarbeat_production_memuro_20170616_Ins1X5RAW_30m_transparent_mosaic_group1/reverse_cal_outputs.csv')
+
+# folder where the cropped images will be saved
+save_folder = Path(r'D:/LEA/2017MEMURO_sugarbeat_production/Raw_images_plots')
+
+# reduction of the raw images when they are decoded: 1 (full size), 2, 4 or 8
+# (faster for JPEG images, the crops are smaller)
+scale = 1
+
+# warp the plots into rectangles (True) or keep them as in the raw images,
+# masked (False)
+rectify = False
+
+# plots to crop, as a list of (column, row), None for all the plots
+# ex : plots = [(0, 0), (0, 1)]
+plots = None
+
+# number of processes (all the cores if None)
+workers = None
+
+###############################################################################
+#################################### CODE #####################################
+###############################################################################
+
+# cv2 reading flags of every scale
+READ_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+              4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+# columns of the corners in the csv
+CORNERS = ['pt1_u', 'pt1_v', 'pt2_u', 'pt2_v', 'pt3_u', 'pt3_v', 'pt4_u', 'pt4_v']
+
+def read_coordinates(coord_file, plots = None):
+    '''Read the csv once and group the plots by raw image
+
+    Inputs : 2
+        coord_file : Path
+            csv written by the reverse calculation
+        plots : list of tuples or None
+            (column, row) of the plots to keep, None for all the plots
+
+    Output : 1
+        images : dict
+            list of (column, row, corners) of every raw image name, corners
+            being an array of shape (4, 2)'''
+    with open(coord_file, newline = '') as f:
+        header = f.readline()
+        f.seek(0)
+        reader = csv.DictReader(f, delimiter = ';' if ';' in header else ',')
+        images = {}
+        for line in reader:
+            col, row = int(line['Column']), int(line['Row'])
+            if plots is not None and (col, row) not in plots:
+                continue
+            corners = np.array([int(line[key]) for key in CORNERS]).reshape((4, 2))
+            images.setdefault(line['raw_img'], []).append((col, row, corners))
+    return images
+
+def crop_plot(img, corners, rectify = False):
+    '''Cut one plot from a raw image
+
+    Inputs : 3
+        img : list of list
+            raw image
+        corners : array of shape (4, 2)
+            pixel coordinates of the plot corners in img
+        rectify : bolean
+            if True, the plot is warped into a rectangle (pt1 on the top left
+            corner, pt2 on the top right corner)
+
+    Output : 1
+        crop : list of list
+            bounding box of the plot, black out of the plot, or the rectified
+            plot'''
+    if rectify:
+        # size of the rectangle : longest sides of the plot
+        sides = np.hypot(*(corners - np.roll(corners, -1, axis = 0)).T)
+        w, h = int(round(max(sides[0], sides[2]))), int(round(max(sides[1], sides[3])))
+        dst = np.float32([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]])
+        matrix = cv2.getPerspectiveTransform(np.float32(corners), dst)
+        return cv2.warpPerspective(img, matrix, (w, h))
+    # bounding box of the plot, in the image
+    x0, y0 = np.maximum(corners.min(axis = 0), 0)
+    x1, y1 = np.minimum(corners.max(axis = 0) + 1, (img.shape[1], img.shape[0]))
+    crop = img[y0:y1, x0:x1].copy()
+    # mask of the size of the bounding box only
+    mask = np.zeros(crop.shape[:2], dtype = np.uint8)
+    cv2.fillPoly(mask, np.int32([corners - (x0, y0)]), 255)
+    crop[mask == 0] = 0
+    return crop
+
+def crop_image(raw_img_path, plots, save_folder, scale = 1, rectify = False):
+    '''Decode one raw image and save all its plots
+
+    Inputs : 5
+        raw_img_path : Path
+            absolute path to the raw image
+        plots : list of tuples
+            (column, row, corners) of every plot in this image
+        save_folder : Path
+            folder where the cropped images are saved
+        scale : int
+            reduction of the raw image (1, 2, 4 or 8)
+        rectify : bolean
+            see crop_plot
+
+    Output : 1
+        nb : int
+            number of saved plots'''
+    raw_img = cv2.imread(str(raw_img_path), READ_FLAGS[scale])
+    if raw_img is None:
+        print('Could not read ' + str(raw_img_path))
+        return 0
+    for col, row, corners in plots:
+        crop = crop_plot(raw_img, np.round(corners/scale).astype(int), rectify)
+        output_path = save_folder / str('Col_' + str(col) + '_row_' + str(row) +
+                                        '_from_' + raw_img_path.name)
+        cv2.imwrite(str(output_path), crop)
+    return len(plots)
+
+if __name__ == '__main__':
+    images = read_coordinates(coord_file, plots)
+    save_folder.mkdir(parents = True, exist_ok = True)
+    with ProcessPoolExecutor(max_workers = workers or os.cpu_count()) as pool:
+        jobs = [pool.submit(crop_image, raw_folder / name, images[name], save_folder, scale, rectify)
+                for name in sorted(images)]
+        nb = sum(job.result() for job in jobs)
+    print('Done. ' + str(nb) + ' plots cropped from ' + str(len(images)) + ' raw images.')
+    print('Output files at :')
+    print(str(save_folder))
@@ -4,15 +4,24 @@ Created on Sun Jan  6 21:31:35 2019
 
 @author: leatr
 
-Crops the inputted raster according to individual *.shp files using rasterio
+Crops the inputted raster according to the plots polygons using rasterio
 and Fiona (no GDAL).
+The plots can be given as the All_plots file of EasyMPE (*.gpkg, *.fgb or
+*.shp) or as a folder of individual *.shp files (SHP_files folder).
+The raster is opened once and only the window of every plot is read; every
+plot is saved in a compressed and tiled GeoTIFF of the size of its bounding
+box, the pixels out of the plot being set to the nodata value (0 if the
+raster has none). The files are written by a pool of threads.
 """
 ###############################################################################
 ################################# ENVIRONMENT #################################
 ###############################################################################
 
-import fiona, rasterio, rasterio.mask, os, sys
+import fiona, rasterio, os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from rasterio import features, windows
+from rasterio.errors import WindowError
 
 ###############################################################################
 #################################### INPUTS ###################################
@@ -20,55 +29,98 @@ from pathlib import Path
 
 # Path to the image to cut
 inraster = Path(r'D:/LEA/2017MEMURO_sugarbeat_hybrid/sugarbeat_hybrid_memuro_20170531_Ins1X5Raw_30m_transparent_mosaic_group1.tif')
-# Path to the _folder_ containing the shapefiles to cut the image with
-file_shp = Path(r'D:/LEA/2017MEMURO_sugarbeat_hybrid/Micro_plots_sugarbeat_hybrid_memuro_20170531_Ins1X5Raw_30m_transparent_mosaic_group1/SHP_files')
+# Path to the All_plots file (*.gpkg, *.fgb or *.shp) or to the _folder_
+# containing the shapefiles to cut the image with
+file_shp = Path(r'D:/LEA/2017MEMURO_sugarbeat_hybrid/Micro_plots_sugarbeat_hybrid_memuro_20170531_Ins1X5Raw_30m_transparent_mosaic_group1/All_plots.gpkg')
 # Path to the folder where the cut images will be saved
 output_folder  = Path(r'D:\LEA\2017MEMURO_sugarbeat_hybrid\IOU\Program_made_plots')
-# Crop to the bounding box? True or False
-bounding_box = False
+# Compression of the GeoTIFF files ('deflate', 'lzw', None...)
+compress = 'deflate'
+# Number of threads writing the files
+workers = 4
 
 ###############################################################################
 ##################################### CODE ####################################
 ###############################################################################
 
-if os.path.isdir(output_folder) == False:
-    os.makedirs(output_folder)
-    print(str(output_folder) + ' has been created.')
+def read_plots(file_shp):
+    '''Get the name and the geometry of every plot
 
-for k in os.listdir(file_shp):
-    if not '.shp' in k:
-        pass
+    Input : 1
+        file_shp : Path
+            All_plots file or folder of *.shp files
+
+    Output : 1
+        plots : list of tuples
+            (name, geometry) of every plot, the names being the ones of the
+            *.shp files of EasyMPE (Col_00_row_00)'''
+    plots = []
+    if os.path.isdir(file_shp):
+        for inshape in sorted(Path(file_shp).glob('*.shp')):
+            with fiona.open(inshape, "r") as shapefile:
+                for feature in shapefile:
+                    plots.append((inshape.stem, feature["geometry"]))
     else:
-        inshape = os.path.join(file_shp, k)
-        
-        # get the shp and make a polygon out of it
-        with fiona.open(inshape, "r") as shapefile:
-            features = [feature["geometry"] for feature in shapefile]
+        with fiona.open(file_shp, "r") as layer:
+            for feature in layer:
+                name = str('Col_' + str(feature['properties']['Col_nb']).zfill(2) +
+                           '_row_' + str(feature['properties']['Row_nb']).zfill(2))
+                plots.append((name, feature["geometry"]))
+    return plots
 
-        if bounding_box == False:
-            # apply the polygon to the raster
-            with rasterio.open(inraster) as src:
-                out_image, out_transform = rasterio.mask.mask(src, features,
-                                                                    crop = False)
-                out_meta = src.meta.copy()
-        elif bounding_box == True:
-            try:
-                with rasterio.open(inraster) as src:
-                    out_image, out_transform = rasterio.mask.mask(src, features,
-                                                                    crop = True)
-                    out_meta = src.meta.copy()
-                    out_meta['height'] = out_image.shape[1]
-                    out_meta['width'] = out_image.shape[2]
-            except ValueError:
-                sys.exit('''--- The shapefile does not overlap the raster. Please
-make sure the inputs are correct and the raster is georeferenced.''')
-                
-        else :
-            sys.exit('''--- Make sure you inputted either True or False 
-for the parameter "bounding_box".''')
+def cut_plot(src, geometry):
+    '''Read the window of one plot and mask the pixels out of the plot
+
+    Inputs : 2
+        src : rasterio dataset
+            raster to cut (opened once)
+        geometry : GeoJSON like dict
+            plot polygon, in the raster CRS
+
+    Outputs : 2
+        out_image : array of shape (bands, height, width)
+            bounding box of the plot
+        out_transform : Affine object
+            transform of the bounding box'''
+    # same window and mask as rasterio.mask.mask(crop = True)
+    window = features.geometry_window(src, [geometry])
+    out_transform = windows.transform(window, src.transform)
+    out_image = src.read(window = window)
+    outside = features.geometry_mask([geometry], out_shape = out_image.shape[1:],
+                                     transform = out_transform)
+    out_image[:, outside] = src.nodata if src.nodata is not None else 0
+    return out_image, out_transform
 
-        # save the output in a new file
-        output_name = os.path.join(output_folder, k.replace('.shp','.tiff'))
-        with rasterio.open(output_name, "w", **out_meta) as dest:
-            dest.write(out_image)
-        print('Image cut; available at: ' + output_name)
+def write_plot(output_name, out_image, out_meta):
+    with rasterio.open(output_name, "w", **out_meta) as dest:
+        dest.write(out_image)
+    print('Image cut; available at: ' + str(output_name))
+
+if __name__ == '__main__':
+    if os.path.isdir(output_folder) == False:
+        os.makedirs(output_folder)
+        print(str(output_folder) + ' has been created.')
+
+    plots = read_plots(file_shp)
+    with rasterio.open(inraster) as src, ThreadPoolExecutor(max_workers = workers) as pool:
+        meta = src.profile.copy()
+        meta.update(driver = 'GTiff', tiled = True, blockxsize = 256, blockysize = 256)
+        if compress is not None:
+            meta['compress'] = compress
+        writing = []
+        for name, geometry in plots:
+            try:
+                out_image, out_transform = cut_plot(src, geometry)
+            except WindowError:
+                print('--- ' + name + ' does not overlap the raster, it is skipped.')
+                continue
+            out_meta = dict(meta, height = out_image.shape[1], width = out_image.shape[2],
+                            transform = out_transform)
+            # reading is done here, the files are compressed and written by
+            # the threads ; a few plots at most wait in memory
+            writing.append(pool.submit(write_plot, Path(output_folder) / str(name + '.tiff'),
+                                       out_image, out_meta))
+            if len(writing) >= 2*workers:
+                writing.pop(0).result()
+        for job in writing:
+            job.result()